@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Compare the time of computing nearest neighbour distances and cluster
+neighbours of a single large point set by comparing all pairs of points, and
+in blocks using a spatial grid, in this process and in a pool of worker
+processes (default: one per CPU). The results are checked to be identical.
+
+Usage: python benchmarks/blocks.py [points] [processes]
+"""
+
+import math
+import os
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pointdensity import blocks
+from pointdensity import geometry
+
+
+def nearest_neighbours_pairwise(xs, ys):
+    """Reference implementation comparing all pairs of points"""
+    pts = list(zip(xs, ys))
+    distli = []
+    for i, (x, y) in enumerate(pts):
+        d2li = [(x - x2) ** 2 + (y - y2) ** 2 for j, (x2, y2) in enumerate(pts) if j != i]
+        distli.append(math.sqrt(min(d2li)) if d2li else None)
+    return distli
+
+
+def first_neighbours_pairwise(xs, ys, dist):
+    """Reference implementation comparing all pairs of points"""
+    pli = [geometry.Point(x, y) for x, y in zip(xs, ys)]
+    firstli = []
+    for i, p1 in enumerate(pli):
+        for j in range(i):
+            if p1 != pli[j] and p1.dist(pli[j]) <= dist:
+                firstli.append(j)
+                break
+        else:
+            firstli.append(-1)
+    return firstli
+
+
+def timed(f, *args, **kwargs):
+    t = time.perf_counter()
+    result = f(*args, **kwargs)
+    return result, time.perf_counter() - t
+
+
+def main():
+    npoints = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    r = random.Random(1)
+    xs = [r.uniform(0, 10000) for __ in range(npoints)]
+    ys = [r.uniform(0, 10000) for __ in range(npoints)]
+    dist = 20.0
+    sys.stdout.write("%d points\n" % npoints)
+    ref, t0 = timed(nearest_neighbours_pairwise, xs, ys)
+    res1, t1 = timed(blocks.shortest_distances, xs, ys, processes=1)
+    resp, tp = timed(blocks.shortest_distances, xs, ys, processes=processes)
+    assert ref == res1 == resp
+    sys.stdout.write("Nearest neighbour distances: all pairs %.2f s; grid, 1 process %.2f s; "
+                     "grid, %d processes %.2f s\n" % (t0, t1, processes, tp))
+    ref, t0 = timed(first_neighbours_pairwise, xs, ys, dist)
+    res1, t1 = timed(blocks.first_neighbours, xs, ys, dist, processes=1)
+    resp, tp = timed(blocks.first_neighbours, xs, ys, dist, processes=processes)
+    assert ref == res1 == resp
+    sys.stdout.write("Cluster neighbours: all pairs %.2f s; grid, 1 process %.2f s; "
+                     "grid, %d processes %.2f s\n" % (t0, t1, processes, tp))
+
+
+if __name__ == '__main__':
+    main()
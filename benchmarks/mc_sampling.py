@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Compare Monte Carlo sampling modes with respect to the width of the
+simulation envelope obtained per CPU-second.
+
+For each sampling mode, a synthetic profile is simulated a number of times.
+The statistic of interest is the mean distance to the profile border of the
+simulated points in a run; the envelope is the central 95% range of this
+statistic over all runs. A narrower envelope at the same CPU cost means that
+fewer runs are needed to estimate the expected value of the statistic with
+the same precision. The halton and stratified modes are not complete spatial
+randomness, so this does not apply to null envelopes (see sampling.py).
+
+Usage: python benchmarks/mc_sampling.py [runs] [points]
+"""
+
+import contextlib
+import io
+import math
+import os.path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pointdensity import core, sampling
+
+
+def write_profile(fn, npoints, seed=1):
+    r = random.Random(seed)
+    with open(fn, 'w') as f:
+        f.write("IMAGE bench.tif\nPROFILE_ID 1\nPIXELWIDTH 2.5 nm\nPROFILE_BORDER\n")
+        for k in range(32):
+            a = 2 * math.pi * k / 32
+            rr = 300 * (1 + 0.2 * math.sin(3 * a))
+            f.write("%.1f, %.1f\n" % (500 + rr * math.cos(a), 500 + rr * math.sin(a)))
+        f.write("END\nPOINTS\n")
+        n = 0
+        while n < npoints:
+            x, y = r.uniform(300, 700), r.uniform(300, 700)
+            f.write("%.3f, %.3f\n" % (x, y))
+            n += 1
+        f.write("END\n")
+
+
+def run(fn, mode, runs, npoints):
+    opt = core.OptionData()
+    opt.run_monte_carlo = True
+    opt.monte_carlo_runs = runs
+    opt.monte_carlo_sampling = mode
+    pro = core.ProfileData(fn, opt)
+    t = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pro.process(opt)
+    cpu = time.process_time() - t
+    stats = sorted(sum(pro.mcruns.border_distances(n)) / npoints
+                   for n in range(len(pro.mcruns)))
+    lo = stats[int(0.025 * (len(stats) - 1))]
+    hi = stats[int(math.ceil(0.975 * (len(stats) - 1)))]
+    return (hi - lo) * pro.pixelwidth, cpu
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 199
+    npoints = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "bench.pd")
+        write_profile(fn, npoints)
+        sys.stdout.write("%d runs, %d points per run\n" % (runs, npoints))
+        sys.stdout.write("%-12s %14s %10s %12s\n"
+                         % ("Mode", "Envelope (nm)", "CPU (s)", "Efficiency"))
+        baseline = None
+        for mode in sampling.sampling_modes:
+            random.seed(1)
+            width, cpu = run(fn, mode, runs, npoints)
+            # Efficiency is the inverse of variance times cost, relative
+            # to the uniform sampler; higher is better
+            efficiency = 1 / (width ** 2 * cpu)
+            if baseline is None:
+                baseline = efficiency
+            sys.stdout.write("%-12s %14.2f %10.2f %12.2f\n"
+                             % (mode, width, cpu, efficiency / baseline))
+
+
+if __name__ == '__main__':
+    main()
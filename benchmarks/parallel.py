@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Compare the wall-clock time of processing a batch of input files one at a
+time and in a pool of worker processes.
+
+A number of synthetic profiles are written to temporary files and processed
+with Monte Carlo simulations, first with one process and then with the given
+number of worker processes (default: one per CPU).
+
+Usage: python benchmarks/parallel.py [files] [processes] [runs]
+"""
+
+import contextlib
+import io
+import math
+import os
+import os.path
+import queue
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pointdensity import core
+from pointdensity.main import main_proc
+
+
+class Session:
+    """Stand-in for the GUI thread running a session"""
+    def __init__(self, opt):
+        self.opt = opt
+        self.process_queue = queue.Queue()
+
+
+def write_profile(fn, npoints, seed):
+    r = random.Random(seed)
+    with open(fn, 'w') as f:
+        f.write("IMAGE bench.tif\nPROFILE_ID %d\nPIXELWIDTH 2.5 nm\nPROFILE_BORDER\n" % seed)
+        for k in range(32):
+            a = 2 * math.pi * k / 32
+            rr = 300 * (1 + 0.2 * math.sin(3 * a))
+            f.write("%.1f, %.1f\n" % (500 + rr * math.cos(a), 500 + rr * math.sin(a)))
+        f.write("END\nPOINTS\n")
+        for __ in range(npoints):
+            f.write("%.3f, %.3f\n" % (r.uniform(300, 700), r.uniform(300, 700)))
+        f.write("END\n")
+
+
+def run(fli, outdir, processes, runs):
+    opt = core.OptionData()
+    opt.input_file_list = list(fli)
+    opt.output_dir = outdir
+    opt.output_file_format = 'csv'
+    opt.output_filename_date_suffix = False
+    opt.determine_interpoint_dists = True
+    opt.run_monte_carlo = True
+    opt.monte_carlo_runs = runs
+    opt.monte_carlo_seed = 1
+    opt.processes = processes
+    opt.stop_requested = False
+    t = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main_proc(Session(opt))
+    return time.perf_counter() - t
+
+
+def main():
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 99
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fli = []
+        for n in range(nfiles):
+            fn = os.path.join(tmpdir, "bench%04d.pd" % n)
+            write_profile(fn, 30, n + 1)
+            fli.append(fn)
+        t1 = run(fli, tmpdir, 1, runs)
+        tp = run(fli, tmpdir, processes, runs)
+    sys.stdout.write("%d files, %d Monte Carlo runs each\n" % (nfiles, runs))
+    sys.stdout.write("1 process: %.2f s; %d processes: %.2f s; speedup %.1fx\n"
+                     % (t1, processes, tp, t1 / tp))
+
+
+if __name__ == '__main__':
+    main()
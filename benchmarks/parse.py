@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Time parsing of large input files.
+
+A synthetic profile with the given number of particles (default 100000) is
+written to a temporary file, which is then parsed a number of times. Only
+parsing and checking of the parsed data and paths is timed, not further
+processing. This is done both without and with the profile cache.
+
+Usage: python benchmarks/parse.py [particles] [repeats]
+"""
+
+import contextlib
+import io
+import math
+import os.path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pointdensity import core
+
+
+def write_profile(fn, npoints, seed=1):
+    r = random.Random(seed)
+    with open(fn, 'w') as f:
+        f.write("IMAGE bench.tif\nPROFILE_ID 1\nPIXELWIDTH 2.5 nm\nPROFILE_BORDER\n")
+        for k in range(256):
+            a = 2 * math.pi * k / 256
+            f.write("%.1f, %.1f\n" % (5000 + 4000 * math.cos(a), 5000 + 4000 * math.sin(a)))
+        f.write("END\nPOINTS\n")
+        for __ in range(npoints):
+            f.write("%.3f, %.3f\n" % (r.uniform(1000, 9000), r.uniform(1000, 9000)))
+        f.write("END\n")
+
+
+def parse(fn, use_profile_cache=False):
+    opt = core.OptionData()
+    opt.use_profile_cache = use_profile_cache
+    pro = core.ProfileData(fn, opt)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pro._ProfileData__check_input()
+    return pro
+
+
+def main():
+    npoints = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, 'bench.pd')
+        write_profile(fn, npoints)
+        for use_profile_cache in (False, True):
+            if use_profile_cache:
+                parse(fn, True)  # create the cache
+            times = []
+            for __ in range(repeats):
+                t = time.perf_counter()
+                pro = parse(fn, use_profile_cache)
+                times.append(time.perf_counter() - t)
+            print("%s: %d particles parsed in %.3f s (best of %d), %.0f particles/s"
+                  % ("cached" if use_profile_cache else "text", len(pro.pli), min(times),
+                     repeats, len(pro.pli) / min(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare returning a processed profile from a worker process as a pickled
+ProfileData object and as the ProfileResults object that the process pool
+returns.
+
+A synthetic profile with the given number of particles (default 20000) is
+written to a temporary file and processed in a worker process, with
+nearest neighbour interpoint distances. The size of the result and the time
+to pickle it in the worker and unpickle it in this process are compared.
+
+Usage: python benchmarks/payload.py [particles]
+"""
+
+import contextlib
+import io
+import multiprocessing
+import os.path
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pointdensity import core
+from pointdensity import parallel
+from parse import write_profile
+
+
+def process_and_pickle(fn):
+    """Process the profile in fn, and return it pickled as a ProfileData
+    and as a ProfileResults object, with the times taken to pickle them.
+    """
+    opt = core.OptionData()
+    opt.determine_interpoint_dists = True
+    pro = core.ProfileData(fn, opt)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pro.process(opt)
+    t = time.perf_counter()
+    pickled_profile = pickle.dumps(pro, pickle.HIGHEST_PROTOCOL)
+    t_profile = time.perf_counter() - t
+    t = time.perf_counter()
+    pickled_results = pickle.dumps(parallel.ProfileResults(pro), pickle.HIGHEST_PROTOCOL)
+    t_results = time.perf_counter() - t
+    return len(pro.pli), pickled_profile, t_profile, pickled_results, t_results
+
+
+def main():
+    npoints = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, 'bench.pd')
+        write_profile(fn, npoints)
+        with multiprocessing.Pool(1) as pool:
+            n, pickled_profile, t_dump_profile, pickled_results, t_dump_results = \
+                pool.apply(process_and_pickle, (fn,))
+    t = time.perf_counter()
+    pro = pickle.loads(pickled_profile)
+    t_load_profile = time.perf_counter() - t
+    t = time.perf_counter()
+    results = pickle.loads(pickled_results)
+    t_load_results = time.perf_counter() - t
+    assert [p.dist_to_path for p in pro.pli] == [p.dist_to_path for p in results.pli]
+    sys.stdout.write("%d particles\n" % n)
+    sys.stdout.write("Pickled ProfileData: %d bytes; pickle %.3f s, unpickle %.3f s\n"
+                     % (len(pickled_profile), t_dump_profile, t_load_profile))
+    sys.stdout.write("Pickled ProfileResults: %d bytes; pickle %.3f s, unpickle %.3f s\n"
+                     % (len(pickled_results), t_dump_results, t_load_results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+import array
+import math
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+from . import geometry
+from . import payload
+
+
+#
+# Block-partitioned distance computations for large point sets.
+#
+# The query points are split into blocks of consecutive indices, and each
+# block is processed separately, either in this process or in a pool of
+# worker processes. The coordinates are placed in shared memory once per
+# computation (see payload.py), so that only block bounds are sent to the
+# workers. Nearest neighbours are found using a spatial grid rather than by
+# comparing each pair of points. Each distance is computed with the same
+# expression as in the straightforward computation, and results are
+# collected in block order, so the results are identical to those of the
+# serial computation.
+#
+
+# Fewer query points than this are always processed in this process
+min_pool_points = 2000
+
+_shared = {}
+_state = {}
+_payload = None
+
+
+def shortest_distances(xs, ys, xs2=None, ys2=None, mode='nearest neighbour',
+                       processes=1, stop=None):
+    """Return the shortest distances between the points given by the
+    coordinate sequences xs and ys, or from these to the points given by
+    xs2 and ys2. In mode 'all', these are the distances between all pairs of
+    points: from each point to each point in (xs2, ys2), or between each
+    unordered pair of points in (xs, ys) in the order (0, 1), (0, 2), ...,
+    (1, 2), ... In mode 'nearest neighbour', they are the distances from
+    each point to its nearest neighbour, or None for points without any
+    neighbour. Return None if stop() returns True.
+    """
+    same = xs2 is None
+    shared = {'x': array.array('d', xs), 'y': array.array('d', ys)}
+    if not same:
+        shared['x2'] = array.array('d', xs2)
+        shared['y2'] = array.array('d', ys2)
+    task = '%s %s' % ('pairs' if mode == 'all' else 'nearest', 'same' if same else 'other')
+    return _run(task, shared, len(xs), processes, stop)
+
+
+def lateral_distances(projections, border, projections2=None, processes=1, stop=None):
+    """Return the lateral distances along border between all pairs of points
+    given by their projections on border (as (point, segment) tuples returned
+    by Point.project_on_closed_path()), or from each of these points to each
+    point given by projections2, in the order of shortest_distances().
+    Return None if stop() returns True.
+    """
+    return _run_lateral('latpairs', projections, border, projections2, processes, stop)
+
+
+def nearest_lateral_neighbours(projections, border, projections2=None, processes=1,
+                               stop=None):
+    """Return, for each point given by its projection on border as in
+    lateral_distances(), a (distance, index) tuple of the lateral distance to
+    and index of its nearest neighbour among the other points, or among the
+    points given by projections2; or None if there is no neighbour. Return
+    None if stop() returns True.
+    """
+    return _run_lateral('latnearest', projections, border, projections2, processes, stop)
+
+
+def _run_lateral(kind, projections, border, projections2, processes, stop):
+    same = projections2 is None
+    shared = _projection_arrays(projections, '')
+    if not same:
+        shared.update(_projection_arrays(projections2, '2'))
+    shared['bx'] = array.array('d', [p.x for p in border])
+    shared['by'] = array.array('d', [p.y for p in border])
+    task = '%s %s' % (kind, 'same' if same else 'other')
+    return _run(task, shared, len(projections), processes, stop)
+
+
+def first_neighbours(xs, ys, dist, processes=1, stop=None):
+    """Return, for each point given by the coordinate sequences xs and ys,
+    the lowest index of a preceding point that has other coordinates and is
+    within distance dist, or -1 if there is none. Return None if stop()
+    returns True.
+    """
+    shared = {'x': array.array('d', xs), 'y': array.array('d', ys),
+              'dist': array.array('d', [dist])}
+    return _run('first', shared, len(xs), processes, stop)
+
+
+def process_count(processes):
+    """Return the number of worker processes to use (0 means one per CPU)"""
+    if processes <= 0:
+        return os.cpu_count() or 1
+    return processes
+
+
+def _projection_arrays(projections, suffix):
+    return {'px' + suffix: array.array('d', [pr.x for pr, seg in projections]),
+            'py' + suffix: array.array('d', [pr.y for pr, seg in projections]),
+            'seg' + suffix: array.array('q', [seg for pr, seg in projections])}
+
+
+def _run(task, shared, n, processes, stop):
+    """Run task for each block of query indices in range(n), and return the
+    concatenated results, or None if stop() returns True between blocks.
+    """
+    processes = process_count(processes)
+    if n < min_pool_points:
+        processes = 1
+    nblocks = processes * 8 if processes > 1 else max(1, n // 256)
+    size = max(1, -(-n // nblocks))
+    bounds = [(task, i, min(i + size, n)) for i in range(0, n, size)]
+    results = []
+    if processes == 1:
+        _init(shared)
+        try:
+            for b in bounds:
+                if stop is not None and stop():
+                    return None
+                results.extend(_process_block(b))
+        finally:
+            _init({})
+        return results
+    data = payload.ArrayPayload.from_arrays(shared)
+    shm = data.share()
+    data.close()
+    try:
+        pool = multiprocessing.Pool(processes, initializer=_attach, initargs=(shm.name,))
+        try:
+            for r in pool.imap(_process_block, bounds):
+                if stop is not None and stop():
+                    return None
+                results.extend(r)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shm.close()
+        shm.unlink()
+    return results
+
+
+def _init(shared):
+    global _shared, _state
+    _shared = dict(shared)
+    _state = {}
+
+
+def _attach(name):
+    """Initialize a worker process with the arrays in the shared memory
+    block named name. The worker keeps the block attached until it exits.
+    """
+    global _payload
+    _payload = payload.ArrayPayload.attach(name)
+    _init(_payload.arrays)
+    multiprocessing.util.Finalize(None, _detach, exitpriority=0)
+
+
+def _detach():
+    _init({})
+    _payload.close()
+
+
+def _process_block(bounds):
+    task, i0, i1 = bounds
+    kind, which = task.split(' ') if ' ' in task else (task, 'same')
+    same = which == 'same'
+    if kind == 'pairs':
+        return _pairs(i0, i1, same)
+    if kind == 'nearest':
+        return _nearest(i0, i1, same)
+    if kind == 'latpairs':
+        return _lateral_pairs(i0, i1, same)
+    if kind == 'latnearest':
+        return _lateral_nearest(i0, i1, same)
+    if kind == 'first':
+        return _first(i0, i1)
+    raise ValueError("unknown task '%s'" % task)
+
+
+def _pairs(i0, i1, same):
+    xs, ys = _shared['x'], _shared['y']
+    xs2, ys2 = (xs, ys) if same else (_shared['x2'], _shared['y2'])
+    sqrt = math.sqrt
+    n2 = len(xs2)
+    distli = []
+    for i in range(i0, i1):
+        x, y = xs[i], ys[i]
+        distli.extend(sqrt((x - xs2[j]) ** 2 + (y - ys2[j]) ** 2)
+                      for j in range(i + 1 if same else 0, n2))
+    return distli
+
+
+class _Grid:
+    """Indices of points binned in square cells of size s"""
+    def __init__(self, xs, ys, s=None):
+        n = len(xs)
+        self.minx, self.miny = (min(xs), min(ys)) if n else (0.0, 0.0)
+        w = max(xs) - self.minx if n else 0.0
+        h = max(ys) - self.miny if n else 0.0
+        if s is None:
+            if w > 0 and h > 0:
+                s = 1.5 * math.sqrt(w * h / n)
+            else:
+                s = max(w, h) / max(n, 1)
+        self.s = s if s > 0 else 1.0
+        self.nx = int(w / self.s) + 1
+        self.ny = int(h / self.s) + 1
+        self.cells = {}
+        for j in range(n):
+            self.cells.setdefault(self.cell(xs[j], ys[j]), []).append(j)
+
+    def cell(self, x, y):
+        return int(math.floor((x - self.minx) / self.s)), int(math.floor((y - self.miny) / self.s))
+
+    def ring(self, cx, cy, r):
+        """Yield the point indices in the cells at Chebyshev distance r from
+        cell (cx, cy).
+        """
+        get = self.cells.get
+        if r == 0:
+            yield from get((cx, cy), ())
+            return
+        for i in range(cx - r, cx + r + 1):
+            yield from get((i, cy - r), ())
+            yield from get((i, cy + r), ())
+        for j in range(cy - r + 1, cy + r):
+            yield from get((cx - r, j), ())
+            yield from get((cx + r, j), ())
+
+    def max_ring(self, cx, cy):
+        return max(abs(cx), abs(cx - self.nx + 1), abs(cy), abs(cy - self.ny + 1))
+
+
+def _grid(name, xs, ys, s=None):
+    if name not in _state:
+        _state[name] = _Grid(xs, ys, s)
+    return _state[name]
+
+
+def _nearest(i0, i1, same):
+    xs, ys = _shared['x'], _shared['y']
+    xs2, ys2 = (xs, ys) if same else (_shared['x2'], _shared['y2'])
+    if len(xs2) == 0:
+        return [None] * (i1 - i0)
+    grid = _grid('grid2', xs2, ys2)
+    s = grid.s
+    distli = []
+    for i in range(i0, i1):
+        x, y = xs[i], ys[i]
+        ex = i if same else -1
+        cx, cy = grid.cell(x, y)
+        best = float('inf')
+        for r in range(0, grid.max_ring(cx, cy) + 1):
+            for j in grid.ring(cx, cy, r):
+                if j != ex:
+                    d2 = (x - xs2[j]) ** 2 + (y - ys2[j]) ** 2
+                    if d2 < best:
+                        best = d2
+            # Points in cells further out are farther away than r * s
+            if best <= (r * s * (1 - 1e-9)) ** 2:
+                break
+        distli.append(math.sqrt(best) if best < float('inf') else None)
+    return distli
+
+
+def _border():
+    if 'border' not in _state:
+        border = geometry.SegmentedPath([geometry.Point(x, y)
+                                         for x, y in zip(_shared['bx'], _shared['by'])])
+        _state['border'] = border, border.perimeter()
+    return _state['border']
+
+
+def _projections(suffix):
+    key = 'projections' + suffix
+    if key not in _state:
+        _state[key] = [(geometry.Point(x, y), seg) for x, y, seg in
+                       zip(_shared['px' + suffix], _shared['py' + suffix],
+                           _shared['seg' + suffix])]
+    return _state[key]
+
+
+def _lateral_pairs(i0, i1, same):
+    border, perimeter = _border()
+    prli = _projections('')
+    prli2 = prli if same else _projections('2')
+    distli = []
+    for i in range(i0, i1):
+        pr, seg = prli[i]
+        for pr2, seg2 in prli2[i + 1 if same else 0:]:
+            distli.append(geometry.lateral_dist_between_projections(
+                pr, seg, pr2, seg2, border, perimeter))
+    return distli
+
+
+def _lateral_nearest(i0, i1, same):
+    border, perimeter = _border()
+    prli = _projections('')
+    prli2 = prli if same else _projections('2')
+    distli = []
+    for i in range(i0, i1):
+        pr, seg = prli[i]
+        mindist = float(sys.maxsize)
+        minj = None
+        for j, (pr2, seg2) in enumerate(prli2):
+            if same and j == i:
+                continue
+            d = geometry.lateral_dist_between_projections(pr, seg, pr2, seg2, border, perimeter)
+            if d < mindist:
+                mindist = d
+                minj = j
+        distli.append((mindist, minj) if mindist < float(sys.maxsize) else None)
+    return distli
+
+
+def _first(i0, i1):
+    xs, ys = _shared['x'], _shared['y']
+    dist = _shared['dist'][0]
+    if dist <= 0:
+        # Points within distance 0 have the same coordinates
+        return [-1] * (i1 - i0)
+    # With cells slightly larger than dist, all points within dist are in
+    # the same or adjacent cells
+    grid = _grid('grid', xs, ys, dist * (1 + 1e-9))
+    sqrt = math.sqrt
+    firstli = []
+    for i in range(i0, i1):
+        x, y = xs[i], ys[i]
+        cx, cy = grid.cell(x, y)
+        first = -1
+        for cell in ((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+            for j in grid.cells.get(cell, ()):
+                if j >= i or (first != -1 and j >= first):
+                    continue
+                x2, y2 = xs[j], ys[j]
+                if (x != x2 or y != y2) and sqrt((x - x2) ** 2 + (y - y2) ** 2) <= dist:
+                    first = j
+        firstli.append(first)
+    return firstli
@@ -0,0 +1,169 @@
+import array
+import hashlib
+import os
+import os.path
+import random
+import struct
+import sys
+
+
+#
+# On-disk checkpoints of completed Monte Carlo runs.
+#
+# Each profile has its own append-only checkpoint file, named by a key
+# derived from the contents of the input file, the options that affect the
+# simulations and the random seed. A checkpoint file consists of a header
+# followed by one record per completed run. Each record is prefixed by its
+# length, so that a record that was only partially written (e.g. because the
+# session was killed) is simply ignored when the file is read.
+#
+# Sessions without a random seed draw a seed of their own for each profile,
+# which is kept in the header, so that a resumed session continues the same
+# simulations while separate sessions are independent. The checkpoint of a
+# profile is removed once its results have been saved.
+#
+
+_magic = b'PDMC'
+_format_version = 1
+_relations = ('simulated - simulated', 'simulated - particle', 'particle - simulated')
+_dist_types = ('dist', 'latdist')
+
+# Options that affect the outcome of the simulations
+_key_options = ('spatial_resolution', 'shell_width', 'monte_carlo_simulation_window',
+                'monte_carlo_strict_location', 'monte_carlo_sampling',
+                'determine_interpoint_dists', 'interpoint_dist_mode',
+                'interpoint_shortest_dist', 'interpoint_lateral_dist')
+
+
+def simulation_key(content_digest, opt):
+    """Return a key identifying the simulations of a profile with the
+    input file contents content_digest, using the options in opt.
+    """
+    h = hashlib.sha256()
+    h.update(content_digest.encode())
+    for optstr in _key_options:
+        h.update(("%s=%r;" % (optstr, getattr(opt, optstr))).encode())
+    for rel in _relations:
+        h.update(("%s=%r;" % (rel, opt.interpoint_relations[rel])).encode())
+    h.update(("seed=%r;version=%d" % (opt.monte_carlo_seed, _format_version)).encode())
+    return h.hexdigest()
+
+
+def run_seed(key, n):
+    """Return the random seed of Monte Carlo run n of the profile
+    simulations identified by key.
+    """
+    return int.from_bytes(hashlib.sha256(("%s:%d" % (key, n)).encode()).digest()[:8],
+                          'little')
+
+
+def remove(fn):
+    """Remove the checkpoint file fn, if there is one"""
+    if not fn:
+        return
+    try:
+        os.remove(fn)
+    except OSError:
+        pass  # not written, or already removed
+
+
+class RunCheckpoint:
+    def __init__(self, dirname, key):
+        self.fn = os.path.join(dirname, key + '.mcrun')
+        self.key = key.encode()
+        self.session_seed = None
+
+    def session_key(self):
+        """Return the key from which the runs of a session without a random
+        seed are seeded: the simulation key combined with the seed drawn
+        for the session, or kept in the checkpoint file of a resumed session.
+        Call after load().
+        """
+        if self.session_seed is None:
+            self.session_seed = random.getrandbits(64)
+        return "%s:%d" % (self.key.decode(), self.session_seed)
+
+    def load(self):
+        """Return a dict of the completed runs in the checkpoint file, with
+        the run number as key and a tuple of simulated point coordinates (as
+        a list of (x, y) tuples) and interpoint distances (as a dict with
+        the same layout as a run in ProfileData.mcli) as value.
+        """
+        runs = {}
+        try:
+            with open(self.fn, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return runs
+        header = struct.pack('<4sI', _magic, _format_version) + self.key
+        if not data.startswith(header) or len(data) < len(header) + 8:
+            return runs
+        self.session_seed, = struct.unpack_from('<Q', data, len(header))
+        pos = len(header) + 8
+        while pos + 4 <= len(data):
+            size, = struct.unpack_from('<I', data, pos)
+            if pos + 4 + size > len(data):
+                break  # incomplete record
+            n, pli, distd = self.__unpack_run(data[pos + 4:pos + 4 + size])
+            runs[n] = pli, distd
+            pos += 4 + size
+        if pos < len(data):
+            # Discard the incomplete record, so that new records can be
+            # appended
+            try:
+                with open(self.fn, 'r+b') as f:
+                    f.truncate(pos)
+            except IOError:
+                pass
+        return runs
+
+    def save(self, n, pli, rund):
+        """Append run number n, with simulated points pli and interpoint
+        distances in the relation dicts of rund, to the checkpoint file.
+        """
+        parts = [struct.pack('<II', n, len(pli)),
+                 array.array('d', [c for p in pli for c in (p.x, p.y)]).tobytes()]
+        for rel in _relations:
+            for dist_type in _dist_types:
+                parts.append(struct.pack('<I', len(rund[rel][dist_type])))
+                for distli in rund[rel][dist_type]:
+                    parts.append(struct.pack('<I', len(distli)))
+                    parts.append(array.array('d', distli).tobytes())
+        record = b''.join(parts)
+        try:
+            if not os.path.exists(self.fn):
+                os.makedirs(os.path.dirname(self.fn) or '.', exist_ok=True)
+                with open(self.fn, 'wb') as f:
+                    f.write(struct.pack('<4sI', _magic, _format_version) + self.key +
+                            struct.pack('<Q', self.session_seed or 0))
+            with open(self.fn, 'ab') as f:
+                f.write(struct.pack('<I', len(record)) + record)
+                f.flush()
+                os.fsync(f.fileno())
+        except IOError:
+            sys.stdout.write("Warning: Unable to write Monte Carlo checkpoint to '%s'.\n"
+                             % self.fn)
+
+    @staticmethod
+    def __unpack_run(record):
+        n, npoints = struct.unpack_from('<II', record, 0)
+        pos = 8
+        coords = array.array('d')
+        coords.frombytes(record[pos:pos + 16 * npoints])
+        pos += 16 * npoints
+        pli = list(zip(coords[0::2], coords[1::2]))
+        distd = {}
+        for rel in _relations:
+            distd[rel] = {}
+            for dist_type in _dist_types:
+                nlists, = struct.unpack_from('<I', record, pos)
+                pos += 4
+                distd[rel][dist_type] = []
+                for __ in range(nlists):
+                    length, = struct.unpack_from('<I', record, pos)
+                    pos += 4
+                    li = array.array('d')
+                    li.frombytes(record[pos:pos + 8 * length])
+                    pos += 8 * length
+                    distd[rel][dist_type].append(li.tolist())
+        return n, pli, distd
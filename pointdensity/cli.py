@@ -0,0 +1,201 @@
+#
+# Command-line batch runner.
+#
+# Runs a session without the GUI (and without importing wx), with options
+# read from an INI file with the keys saved by the GUI (see options.py) or
+# from a JSON file, and overridden by key=value pairs given on the command
+# line. The log is written to stdout and progress to stderr. The exit code
+# is that of main.main_proc(): 0 if there were errors, 2 if there were
+# warnings, 1 if processing was clean and 3 if the session was aborted.
+#
+
+import argparse
+import os
+import os.path
+import signal
+import sys
+import time
+import traceback
+from . import core
+from . import ingest
+from . import main as session
+from . import options
+from . import version
+
+
+class ProgressQueue:
+    """Writes the progress events put by main_proc() to stderr"""
+    def __init__(self, opt):
+        self.opt = opt
+        self.n = 0
+
+    def put(self, event):
+        event_type, data = event
+        if event_type == "new_file":
+            self.n += 1
+            # The session replaces the input sources by the files they
+            # expand to, but container files may hold several profiles
+            total = len(self.opt.input_file_list)
+            if self.n <= total:
+                msg = "Processing %s (file %d of %d)" % (os.path.basename(data), self.n, total)
+            else:
+                msg = "Processing %s" % os.path.basename(data)
+        elif event_type == "saving_summaries":
+            msg = "Saving summaries..."
+        elif event_type == "done":
+            msg = "Done."
+        else:
+            return
+        sys.stderr.write(msg + "\n")
+        sys.stderr.flush()
+
+
+class BatchSession:
+    """Stand-in for the GUI thread running a session"""
+    def __init__(self, opt):
+        self.opt = opt
+        self.process_queue = ProgressQueue(opt)
+        self.opt.stop_requested = False
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    """Exits with the exit code of a session with errors (0) on invalid
+    arguments
+    """
+    def error(self, message):
+        self.print_usage(sys.stderr)
+        self.exit(0, "%s: error: %s\n" % (self.prog, message))
+
+
+def warn(s):
+    sys.stderr.write("Warning: %s\n" % s.replace("\n", " "))
+
+
+def read_options_file(fn):
+    """Return a list of (key, value) pairs of the options in the INI or JSON
+    (if fn ends with '.json') options file fn
+    """
+    if not os.path.isfile(fn):
+        raise ValueError("options file '%s' not found" % fn)
+    if os.path.splitext(fn)[1].lower() == '.json':
+        try:
+            return options.read_json(fn)
+        except (IOError, ValueError) as err:
+            raise ValueError("unable to read options file '%s' (%s)" % (fn, err))
+    items = options.read_config(fn)
+    if not items:
+        warn("No options found in section '%s' of options file '%s'. Using defaults."
+             % (options.config_section, fn))
+    return items
+
+
+def parse_overrides(overrides):
+    """Return a list of (key, value) pairs of the overrides given as
+    'key=value' strings
+    """
+    items = []
+    for s in overrides:
+        key, sep, val = s.partition('=')
+        key = key.strip()
+        if not sep or not options.is_valid_key(key):
+            raise ValueError("invalid option '%s'" % s)
+        items.append((key, val.strip()))
+    return items
+
+
+def source_dir(source):
+    """Return the directory of the input source (a file, directory, glob
+    pattern, archive or archive member)
+    """
+    if os.path.isdir(source):
+        return source
+    if ingest.is_archive_member(source):
+        source = ingest.split_member_name(source)[0]
+    return os.path.dirname(source)
+
+
+def get_options(args):
+    """Return an OptionData object from the command-line arguments args"""
+    opt = core.OptionData()
+    if args.options:
+        options.apply_options(opt, read_options_file(args.options),
+                              "options file '%s'" % args.options, warn)
+    options.apply_options(opt, parse_overrides(args.set), "command line", warn)
+    opt.output_filename_ext = '.xlsx' if opt.output_file_format == 'excel' else '.csv'
+    if args.suffix is not None:
+        opt.output_filename_other_suffix = args.suffix
+    # Directories, glob patterns, archives and manifests are expanded by the
+    # session, as for input files added in the GUI
+    opt.input_file_list = [os.path.abspath(source) for source in args.inputs]
+    if args.output_dir:
+        opt.output_dir = os.path.abspath(args.output_dir)
+    else:
+        opt.output_dir = os.path.join(source_dir(opt.input_file_list[0]), "out")
+    return opt
+
+
+def run(opt):
+    """Run a session with the options opt and return its exit code. The
+    session is aborted as from the GUI on keyboard interrupt; a second
+    interrupt raises KeyboardInterrupt as usual.
+    """
+
+    def abort(signum, frame):
+        sys.stderr.write("Aborting... (interrupt again to exit immediately)\n")
+        opt.stop_requested = True
+        signal.signal(signal.SIGINT, previous_handler)
+
+    if not os.path.isdir(opt.output_dir):
+        os.makedirs(opt.output_dir)
+    previous_handler = signal.signal(signal.SIGINT, abort)
+    if previous_handler is None:  # not installed from Python
+        previous_handler = signal.SIG_DFL
+    # noinspection PyBroadException
+    try:
+        return session.main_proc(BatchSession(opt))
+    except KeyboardInterrupt:
+        raise
+    except:  # yes, I do want to catch everything
+        exc_str = "".join(traceback.format_exception(*sys.exc_info()))
+        sys.stdout.write("\n*** %s session was unexpectedly aborted"
+                         " at %s (local time). \n\nDetails:\n%s"
+                         % (version.title, time.ctime(), exc_str))
+        sys.stderr.write("An unexpected error occurred - session aborted.\n")
+        return 0
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        prog="PointDensity-batch",
+        description="Process %s input files without the graphical user interface. "
+                    "The exit code is 0 if there were errors, 2 if there were "
+                    "warnings, 1 if processing was clean and 3 if the session was "
+                    "aborted; invalid arguments also give exit code 0." % version.title)
+    parser.add_argument('inputs', nargs='+', metavar='input',
+                        help="input file, folder, archive, archive member "
+                             "(archive::member), manifest or quoted glob pattern")
+    parser.add_argument('-c', '--options', metavar='FILE',
+                        help="INI file with an [%s] section, as saved by the GUI, or "
+                             "JSON file with the same keys" % options.config_section)
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="set an option, e.g. run_monte_carlo=True or "
+                             "outputs.particle_summary=False; may be repeated")
+    parser.add_argument('-o', '--output-dir', metavar='DIR',
+                        help="output folder (default: 'out' in the folder of the "
+                             "first input file)")
+    parser.add_argument('--suffix', metavar='SUFFIX',
+                        help="suffix appended to output filenames")
+    parser.add_argument('--version', action='version',
+                        version="%s %s" % (version.title, version.version))
+    args = parser.parse_args(argv)
+    try:
+        opt = get_options(args)
+    except ValueError as err:
+        parser.error(str(err))
+    sys.exit(run(opt))
+
+
+if __name__ == '__main__':
+    main()
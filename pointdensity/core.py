@@ -1,7 +1,26 @@
+import bisect
+import math
 import random
 import sys
+from . import blocks
+from . import checkpoint
 from . import geometry
 from . import file_io
+from . import planner
+from . import profilecache
+from . import runstore
+from . import sampling
+
+
+# Largest number of simulated points generated at a time in Monte Carlo runs
+simulated_points_per_chunk = 20000
+
+# Quantiles of the expected distribution of distances to the profile border
+border_dist_quantile_levels = (0.01, 0.025, 0.05, 0.25, 0.5, 0.75, 0.95, 0.975, 0.99)
+
+# Version of the input file parser; increase whenever parsing changes, so that
+# cached profiles parsed by an earlier version are not used
+parser_version = 1
 
 
 # Convenience functions
@@ -47,10 +66,6 @@ class Point(geometry.Point):
         else:
             geometry.Point.__init__(self, x, y)
         self.profile = profile
-        if self.profile is not None:
-            self.opt = self.profile.opt
-        else:
-            self.opt = None
         self.discard = False
         self.ptype = ptype
         self.cluster = None
@@ -60,9 +75,18 @@ class Point(geometry.Point):
         self.nearest_lateral_neighbour_point = geometry.Point()
         self.nearest_neighbour = geometry.Point()
 
-    def determine_stuff(self):
-        """Determine general stuff for a point, including distance to path.
-         Also mark the point for discarding if it is not valid.
+    @property
+    def opt(self):
+        # Taken from the profile rather than stored, so that a profile can
+        # be pickled without its options
+        if self.profile is not None:
+            return self.profile.opt
+        return None
+
+    def determine_stuff(self, association=True):
+        """Determine general stuff for a point, including distance to path
+         (and association with the path, if association is True). Also mark
+         the point for discarding if it is not valid.
         """
 
         def mark_to_discard(msg):
@@ -78,8 +102,18 @@ class Point(geometry.Point):
         if not (self.is_within_profile or self.is_within_shell):
             mark_to_discard("Located outside the shell")
             return
-        # This is to force the computation of this lazy property here
-        __ = self.is_associated_with_path
+        if association:
+            # This is to force the computation of this lazy property here
+            __ = self.is_associated_with_path
+
+    def set_location(self, within_profile, within_hole, dist):
+        """Set location properties that have already been determined
+        elsewhere (e.g. for many points at once), so that they need not be
+        computed again. dist is the unsigned distance to the profile border.
+        """
+        self._lazy_is_within_profile = within_profile
+        self._lazy_is_within_hole = within_hole
+        self._lazy_dist_to_path = dist if within_profile else -dist
 
     @lazy_property
     def dist_to_path(self):
@@ -102,13 +136,10 @@ class Point(geometry.Point):
     @lazy_property
     def is_within_hole(self):
         """Determine whether self is inside a profile hole"""
-        within_hole = False
         for h in self.profile.holeli:
             if self.is_within_polygon(h):
-                within_hole = True
-            else:
-                within_hole = False
-        return within_hole
+                return True
+        return False
 
     @lazy_property
     def is_within_profile(self):
@@ -232,19 +263,31 @@ class ClusterData(list):
 
 
 class ProfileData:
-    def __init__(self, inputfn, opt):
+    def __init__(self, inputfn, opt, lines=None):
         self.id = None
         self.inputfn = inputfn
+        # Lines of the input file (see file_io.iter_profiles()), if already
+        # opened; else, the input file is opened when parsed
+        self.lines = lines
+        self.in_container = isinstance(lines, file_io.ProfileBlock)
+        self.__input_read = False
+        self.__read_error = None
+        self.__cached = None
         self.src_img = None
         self.opt = opt
         self.holeli = []
         self.pli = []
         self.randomli = []
-        self.mcli = []
+        self.mcruns = runstore.SimulatedRuns()
+        self.mc_checkpoint_fn = ''
         self.clusterli = []
         self.pp_distli, self.pp_latdistli = [], []
         self.rp_distli, self.rp_latdistli = [], []
+        self.expected_border_dist_cdf = []
+        self.expected_border_dist_quantiles = []
+        self.expected_border_dist_mean = None
         self.n_discarded = {'particle': 0, 'random': 0}
+        self.parse_messages = []
         self.comment = ''
         self.pixelwidth = None
         self.metric_unit = ''
@@ -254,13 +297,22 @@ class ProfileData:
         self.feret = None
         self.warnflag = False
         self.errflag = False
+        self.is_processed = False
+
+    def __getstate__(self):
+        """ Leave out the session options when pickling, e.g. to return a
+        profile processed in a worker process; they must be set anew in
+        the unpickled profile.
+        """
+        state = self.__dict__.copy()
+        state['opt'] = None
+        return state
 
     def process(self, opt):
         """ Parse profile data from a file and determine distances
         """
         try:
-            self.__parse()
-            self.__check_paths()
+            self.__check_input()
             sys.stdout.write("Processing profile...\n")
             self.__compute_stuff()
             if self.opt.determine_interpoint_dists:
@@ -269,6 +321,9 @@ class ProfileData:
             if self.opt.determine_clusters:
                 sys.stdout.write("Determining clusters...\n")
                 self.clusterli = self.__determine_clusters(self.pli)
+            if self.opt.determine_expected_border_dists:
+                sys.stdout.write("Determining expected distances to profile border...\n")
+                self.__determine_expected_border_dists()
             if self.opt.run_monte_carlo:
                 sys.stdout.write("Running Monte Carlo simulations...\n")
                 self.__run_monte_carlo()
@@ -278,6 +333,31 @@ class ProfileData:
         except ProfileError as err:
             sys.stdout.write("Error: %s\n" % err.msg)
             self.errflag = True
+        self.is_processed = True
+
+    def release(self):
+        """ Free the points, distances and Monte Carlo runs of the profile,
+            and delete any scratch files holding them and the Monte Carlo
+            checkpoint, once its results have been saved; the profile border
+            and the flags are kept
+        """
+        for a in (self.pp_distli, self.pp_latdistli, self.rp_distli, self.rp_latdistli):
+            runstore.remove_array(a)
+        self.mcruns.remove()
+        checkpoint.remove(self.mc_checkpoint_fn)
+        self.mcruns = runstore.SimulatedRuns()
+        self.pli, self.randomli, self.clusterli = [], [], []
+        self.pp_distli, self.pp_latdistli = [], []
+        self.rp_distli, self.rp_latdistli = [], []
+        self.expected_border_dist_cdf = []
+        self.expected_border_dist_quantiles = []
+
+    @lazy_property
+    def content_digest(self):
+        """SHA-256 digest of the input file contents (for a profile in a
+        container file, this is set when parsing)
+        """
+        return file_io.file_digest(self.inputfn)
 
     @lazy_property
     def area(self):
@@ -295,98 +375,96 @@ class ProfileData:
         __ = self.area  # Force computation here
         self.perimeter = self.path.perimeter()
         self.feret = self.path.feret_diameter()
+        plan = planner.get_plan(self.opt)
         for p in self.pli:
             p.determine_stuff()
         self.pli = [p for p in self.pli if not p.discard]
+        if self.randomli and not plan.locate_random_points:
+            sys.stdout.write("  Random points not analyzed (not used by any output).\n")
+            self.randomli = []
         for p in self.randomli:
-            p.determine_stuff()
+            p.determine_stuff(plan.random_point_association)
         self.randomli = [p for p in self.randomli if not p.discard]
         for ptype in ('particle', 'random'):
-            if ptype == 'random' and not self.opt.use_random:
+            if ptype == 'random' and not (self.opt.use_random and plan.locate_random_points):
                 continue
             ptypestr = 'particles' if ptype == 'particle' else ptype + ' points'
             sys.stdout.write("  Number of %s discarded: %d\n"
                              % (ptypestr, self.n_discarded[ptype]))
 
     def __determine_interdistlis(self):
-        if True not in [val for key, val in self.opt.interpoint_relations.items()
-                        if 'simulated' not in key]:
+        plan = planner.get_plan(self.opt)
+        if not plan.interpoint_relations:
             return
-        if self.opt.interpoint_relations['particle - particle']:
-            self.pp_distli, self.pp_latdistli = self.__get_same_interpoint_distances(self.pli)
-        if self.opt.use_random and self.opt.interpoint_relations['random - particle']:
-            self.rp_distli, self.rp_latdistli = self.__get_interpoint_distances2(self.randomli,
-                                                                                 self.pli)
+        scratch_dir = getattr(self.opt, 'scratch_session_dir', None)
+        typecode, scale = runstore.distance_format(self.opt, self.pixelwidth)
+        if 'particle - particle' in plan.interpoint_relations:
+            self.pp_distli, self.pp_latdistli = [
+                runstore.new_array(typecode, scratch_dir, li, scale)
+                for li in self.__get_same_interpoint_distances(self.pli)]
+        if self.opt.use_random and 'random - particle' in plan.interpoint_relations:
+            self.rp_distli, self.rp_latdistli = [
+                runstore.new_array(typecode, scratch_dir, li, scale)
+                for li in self.__get_interpoint_distances2(self.randomli, self.pli)]
 
     def __get_same_interpoint_distances(self, pointli):
-        dli = []
-        latdli = []
-        for i in range(0, len(pointli)):
-            if self.opt.stop_requested:
-                return [], []
-            if self.opt.interpoint_dist_mode == 'all':
-                for j in range(i + 1, len(pointli)):
-                    if self.opt.interpoint_shortest_dist:
-                        dli.append(pointli[i].dist(pointli[j]))
-                    if self.opt.interpoint_lateral_dist:
-                        latdli.append(pointli[i].lateral_dist_to_point(
-                            pointli[j], self.path))
-            elif self.opt.interpoint_dist_mode == 'nearest neighbour':
-                if self.opt.interpoint_shortest_dist:
-                    dli.append(pointli[i].get_nearest_neighbour(pointli))
-                if self.opt.interpoint_lateral_dist:
-                    latdli.append(pointli[i].get_nearest_lateral_neighbour(
-                        pointli))
-        dli = [d for d in dli if d is not None]
-        latdli = [d for d in latdli if d is not None]
-        return dli, latdli
+        return self.__get_interpoint_distances2(pointli)
 
     def __get_interpoint_distances2(self, pointli, pointli2=None):
-        if pointli2 is None:
-            pointli2 = []
+        """Return lists of the shortest and lateral distances between the
+        points in pointli, or from these to the points in pointli2. The
+        distances are computed in blocks of points, in a pool of
+        opt.block_processes worker processes if there are many points.
+        """
+        same = pointli2 is None
+        processes = self.opt.block_processes
+
+        def stop():
+            return self.opt.stop_requested
+
         dli = []
         latdli = []
-        for i, p in enumerate(pointli):
-            if self.opt.stop_requested:
+        if self.opt.interpoint_shortest_dist:
+            xs, ys = [p.x for p in pointli], [p.y for p in pointli]
+            xs2, ys2 = (None, None) if same else ([p.x for p in pointli2],
+                                                  [p.y for p in pointli2])
+            dli = blocks.shortest_distances(xs, ys, xs2, ys2, self.opt.interpoint_dist_mode,
+                                            processes, stop)
+            if dli is None:
                 return [], []
+        if self.opt.interpoint_lateral_dist:
+            projections = []
+            for p in pointli:
+                if self.opt.stop_requested:
+                    return [], []
+                projections.append(p.project_on_closed_path(self.path))
+            projections2 = None if same else [p.project_on_closed_path(self.path)
+                                              for p in pointli2]
             if self.opt.interpoint_dist_mode == 'all':
-                for p2 in pointli2:
-                    if self.opt.interpoint_shortest_dist:
-                        dli.append(p.dist(p2))
-                    if self.opt.interpoint_lateral_dist:
-                        latdli.append(p.lateral_dist_to_point(p2, self.path))
+                latdli = blocks.lateral_distances(projections, self.path, projections2,
+                                                  processes, stop)
             elif self.opt.interpoint_dist_mode == 'nearest neighbour':
-                if self.opt.interpoint_shortest_dist:
-                    dli.append(p.get_nearest_neighbour(pointli2))
-                if self.opt.interpoint_lateral_dist:
-                    latdli.append(p.get_nearest_lateral_neighbour(pointli2))
+                latdli = blocks.nearest_lateral_neighbours(projections, self.path,
+                                                           projections2, processes, stop)
+                if latdli is not None:
+                    nbli = pointli if same else pointli2
+                    for p, nb in zip(pointli, latdli):
+                        if nb is not None:
+                            p.nearest_lateral_neighbour_dist = nb[0]
+                            p.nearest_lateral_neighbour_point = nbli[nb[1]]
+                    latdli = [nb[0] for nb in latdli if nb is not None]
+            if latdli is None:
+                return [], []
         dli = [d for d in dli if d is not None]
         latdli = [d for d in latdli if d is not None]
         return dli, latdli
 
-    def __run_monte_carlo(self):
-
-        # TODO: See if we can simplify is_valid()!
-        def is_valid(p_candidate):
-            if p_candidate in mcli[n]["pli"]:
-                return False
-            if p_candidate.is_within_profile:
-                return True
-            # The if clause below is not necessary but should speed up
-            # the code a little bit
-            elif (self.opt.monte_carlo_simulation_window == "profile" and
-                  self.opt.monte_carlo_strict_location):
-                    return False
-            # Not necessary as Point.is_within_profile tests for holes
-            # if p_candidate.is_within_hole:
-            #     return False
-            d = p_candidate.perpend_dist_closed_path(self.path)
-            if d is None:
-                return False
-            # border is set in the outer function according to
-            # simulation window and opt.monte_carlo_strict_location
-            return d <= border
-
+    def __get_simulation_window(self):
+        """Return the list of particles to simulate and the maximum distance
+        (in pixels) outside the profile border at which a simulated point is
+        allowed, according to the simulation window and
+        opt.monte_carlo_strict_location.
+        """
         if self.opt.monte_carlo_simulation_window == "profile + shell":
             # Points outside shell have already been discarded
             pli = self.pli
@@ -402,50 +480,195 @@ class ProfileData:
             # outside the shell have been discarded
             border = geometry.to_pixel_units(min(self.opt.shell_width, self.opt.spatial_resolution),
                                              self.pixelwidth)
-        numpoints = len(pli)
+        return pli, border
+
+    def __determine_expected_border_dists(self, grid_size=256):
+        """Determine the distribution of distances to the profile border
+        expected under complete spatial randomness in the Monte Carlo
+        simulation window, i.e., the fraction of the window area at each
+        distance from the border, without simulation.
+
+        The window is rasterized on a grid with grid_size cells along its
+        longer side, and the signed distance to the border is determined at
+        the center of each cell within the window. The cumulative
+        distribution is evaluated at multiples of the cell size.
+        """
+        __, border = self.__get_simulation_window()
+        box = self.path.bounding_box()
+        lox, loy = box[0].x - border, box[0].y - border
+        w, h = box[1].x - box[0].x + 2 * border, box[2].y - box[0].y + 2 * border
+        step = max(w, h) / grid_size
+        nx, ny = max(1, int(math.ceil(w / step))), max(1, int(math.ceil(h / step)))
+        xs = [lox + (i + 0.5) * step for __ in range(ny) for i in range(nx)]
+        ys = [loy + (j + 0.5) * step for j in range(ny) for __ in range(nx)]
+        strict = (self.opt.monte_carlo_simulation_window == "profile" and
+                  self.opt.monte_carlo_strict_location)
+        distli = []
+        for within_profile, __, d in zip(*self.__locate_points(xs, ys)):
+            # Same criteria as for accepting a simulated point
+            if within_profile:
+                distli.append(d)
+            elif not strict and d is not None and d <= border:
+                distli.append(-d)
+        if not distli:
+            return
+        distli.sort()
+        n = len(distli)
+        self.expected_border_dist_mean = sum(distli) / n
+        self.expected_border_dist_quantiles = [distli[max(0, int(math.ceil(q * n)) - 1)]
+                                               for q in border_dist_quantile_levels]
+        self.expected_border_dist_cdf = [
+            (k * step, bisect.bisect_right(distli, k * step) / n)
+            for k in range(int(math.floor(distli[0] / step)),
+                           int(math.ceil(distli[-1] / step)) + 1)]
+
+    def __locate_points(self, xs, ys):
+        """Return lists telling whether each of the points given by the
+        coordinate sequences xs and ys is within the profile (excluding
+        holes) and within a hole, and a list of the (unsigned) distances
+        of the points to the profile border.
+        """
+        within_path = geometry.polygon_contains(xs, ys, self.path)
+        within_hole = [False] * len(xs)
+        for hole in self.holeli:
+            within_hole = [a or b for a, b in
+                           zip(within_hole, geometry.polygon_contains(xs, ys, hole))]
+        within_profile = [a and not b for a, b in zip(within_path, within_hole)]
+        return within_profile, within_hole, geometry.closed_path_distances(xs, ys, self.path)
+
+    def __generate_simulated_points(self, numpoints, border, rngli):
+        """Return a list of lists of numpoints points randomly placed within
+        the simulation window, one list for each random number generator in
+        rngli. The points of a run depend only on its own generator.
+
+        Candidate points for all runs are located in a few batched calls
+        rather than one point at a time; the number of candidates drawn
+        per round is adjusted to the observed acceptance rate.
+        """
         box = self.path.bounding_box()
-        mcli = []
-        for n in range(0, self.opt.monte_carlo_runs):
+        strict = (self.opt.monte_carlo_simulation_window == "profile" and
+                  self.opt.monte_carlo_strict_location)
+        runli = [[] for __ in rngli]
+        seenli = [set() for __ in rngli]
+        candidatesli = [sampling.candidates(self.opt.monte_carlo_sampling,
+                                            box[0].x - border, box[0].y - border,
+                                            box[1].x + border, box[2].y + border,
+                                            numpoints, rng) for rng in rngli]
+        acceptance = 1.0
+        while True:
             if self.opt.stop_requested:
                 return []
+            ownerli, xs, ys = [], [], []
+            for n, li in enumerate(runli):
+                if len(li) < numpoints:
+                    for __ in range(int(math.ceil((numpoints - len(li)) / acceptance))):
+                        x, y = next(candidatesli[n])
+                        ownerli.append(n)
+                        xs.append(x)
+                        ys.append(y)
+            if not ownerli:
+                break
+            accepted = 0
+            for n, x, y, within_profile, within_hole, d in zip(ownerli, xs, ys,
+                                                               *self.__locate_points(xs, ys)):
+                if not within_profile and (strict or d is None or d > border):
+                    continue
+                accepted += 1
+                if len(runli[n]) == numpoints or (x, y) in seenli[n]:
+                    continue
+                seenli[n].add((x, y))
+                p = Point(x, y, ptype='sim', profile=self)
+                p.set_location(within_profile, within_hole, d)
+                runli[n].append(p)
+            acceptance = max(accepted / len(ownerli), 0.01)
+        return runli
+
+    def __restore_simulated_points(self, coordli):
+        """Return a list of simulated points at the coordinates in coordli
+        (a list of (x, y) tuples), e.g. as loaded from a checkpoint.
+        """
+        xs, ys = [x for x, __ in coordli], [y for __, y in coordli]
+        pli = []
+        for x, y, within_profile, within_hole, d in zip(xs, ys, *self.__locate_points(xs, ys)):
+            p = Point(x, y, ptype='sim', profile=self)
+            p.set_location(within_profile, within_hole, d)
+            pli.append(p)
+        return pli
+
+    def __run_monte_carlo(self):
+        plan = planner.get_plan(self.opt)
+        pli, border = self.__get_simulation_window()
+        runs = self.opt.monte_carlo_runs
+        store = None
+        completed = {}
+        if self.opt.monte_carlo_seed is not None or self.opt.monte_carlo_checkpoint_dir:
+            # Seed each run separately, so that any run can be reproduced
+            # regardless of the others
+            key = checkpoint.simulation_key(self.content_digest or '', self.opt)
+            if self.opt.monte_carlo_checkpoint_dir:
+                store = checkpoint.RunCheckpoint(self.opt.monte_carlo_checkpoint_dir, key)
+                completed = dict((n, run) for n, run in store.load().items() if n < runs)
+                if completed:
+                    sys.stdout.write("  Resuming from checkpoint: %d of %d runs already "
+                                     "completed.\n" % (len(completed), runs))
+                if self.opt.monte_carlo_seed is None:
+                    key = store.session_key()
+                self.mc_checkpoint_fn = store.fn
+            rngli = [random.Random(checkpoint.run_seed(key, n)) for n in range(0, runs)]
+        else:
+            rngli = [random.Random(random.getrandbits(64)) for __ in range(0, runs)]
+        # Simulated points are generated and located for a chunk of runs at a
+        # time, so that only the compact representation of completed runs is
+        # kept for all runs
+        pending = [n for n in range(0, runs) if n not in completed]
+        chunk_runs = max(1, simulated_points_per_chunk // max(len(pli), 1))
+        next_chunk = 0
+        simd = {}
+        mcruns = runstore.SimulatedRuns(getattr(self.opt, 'scratch_session_dir', None),
+                                        runstore.distance_format(self.opt, self.pixelwidth))
+        for n in range(0, runs):
+            if self.opt.stop_requested:
+                return
             dot_progress(n)
-            mcli.append({'pli': [],
-                         'simulated - simulated': {'dist': [], 'latdist': []},
-                         'simulated - particle': {'dist': [], 'latdist': []},
-                         'particle - simulated': {'dist': [], 'latdist': []},
-                         'clusterli': []})
-            p = Point()
-            for __ in range(0, numpoints):
-                while True:
-                    x = random.randint(int(box[0].x - border), int(box[1].x + border) + 1)
-                    y = random.randint(int(box[0].y - border), int(box[2].y + border) + 1)
-                    p = Point(x, y, ptype='sim', profile=self)
-                    if is_valid(p):
-                        break
-                # escape the while loop when a valid simulated
-                # point is found
-                mcli[n]['pli'].append(p)
-            for p in mcli[n]['pli']:
-                p.determine_stuff()
-            if self.opt.determine_interpoint_dists:
-                if self.opt.interpoint_relations['simulated - simulated']:
-                    distlis = self.__get_same_interpoint_distances(mcli[n]['pli'])
-                    mcli[n]['simulated - simulated']['dist'].append(distlis[0])
-                    mcli[n]['simulated - simulated']['latdist'].append(distlis[1])
-                if self.opt.interpoint_relations['simulated - particle']:
-                    distlis = self.__get_interpoint_distances2(mcli[n]['pli'], pli)
-                    mcli[n]['simulated - particle']['dist'].append(distlis[0])
-                    mcli[n]['simulated - particle']['latdist'].append(distlis[1])
-                if self.opt.interpoint_relations['particle - simulated']:
-                    distlis = self.__get_interpoint_distances2(pli, mcli[n]['pli'])
-                    mcli[n]['particle - simulated']['dist'].append(distlis[0])
-                    mcli[n]['particle - simulated']['latdist'].append(distlis[1])
-        if self.opt.determine_clusters:
-            for n, li in enumerate(mcli):
-                dot_progress(n)
-                mcli[n]['clusterli'] = self.__determine_clusters(li['pli'])
-                self.__process_clusters(mcli[n]['clusterli'])
-        self.mcli = mcli
+            rund = {'simulated - simulated': {'dist': [], 'latdist': []},
+                    'simulated - particle': {'dist': [], 'latdist': []},
+                    'particle - simulated': {'dist': [], 'latdist': []},
+                    'clusterli': []}
+            if n in completed:
+                simli = self.__restore_simulated_points(completed[n][0])
+                rund.update(completed[n][1])
+            else:
+                if n not in simd:
+                    chunk = pending[next_chunk:next_chunk + chunk_runs]
+                    next_chunk += len(chunk)
+                    simd = dict(zip(chunk, self.__generate_simulated_points(
+                        len(pli), border, [rngli[m] for m in chunk])))
+                    if self.opt.stop_requested:
+                        return
+                simli = simd.pop(n)
+            if n not in completed:
+                if 'simulated - simulated' in plan.simulated_relations:
+                    distlis = self.__get_same_interpoint_distances(simli)
+                    rund['simulated - simulated']['dist'].append(distlis[0])
+                    rund['simulated - simulated']['latdist'].append(distlis[1])
+                if 'simulated - particle' in plan.simulated_relations:
+                    distlis = self.__get_interpoint_distances2(simli, pli)
+                    rund['simulated - particle']['dist'].append(distlis[0])
+                    rund['simulated - particle']['latdist'].append(distlis[1])
+                if 'particle - simulated' in plan.simulated_relations:
+                    distlis = self.__get_interpoint_distances2(pli, simli)
+                    rund['particle - simulated']['dist'].append(distlis[0])
+                    rund['particle - simulated']['latdist'].append(distlis[1])
+            if store is not None and n not in completed and not self.opt.stop_requested:
+                store.save(n, simli, rund)
+            if plan.simulated_clusters:
+                rund['clusterli'] = self.__determine_clusters(simli)
+            if self.opt.stop_requested:
+                return
+            # Only the compact representation of the run is kept
+            mcruns.append_run(simli, rund)
+        mcruns.close()
+        self.mcruns = mcruns
         sys.stdout.write("\n")
 
     def __process_clusters(self, clusterli):
@@ -477,71 +700,190 @@ class ProfileData:
         """
         if self.opt.within_cluster_dist < 0:
             return
+        # For each point, the first point in pointli within the cluster
+        # distance; as the points are assigned to clusters in order, a point
+        # joins the cluster of its first preceding such point, if any
+        firstli = blocks.first_neighbours(
+            [p.x for p in pointli], [p.y for p in pointli],
+            geometry.to_pixel_units(self.opt.within_cluster_dist, self.pixelwidth),
+            self.opt.block_processes, lambda: self.opt.stop_requested)
+        if firstli is None:
+            return []
         clusterli = []
-        for p1 in pointli:
-            if self.opt.stop_requested:
-                return []
+        for p1, j in zip(pointli, firstli):
             if p1.cluster:
                 continue
-            for p2 in pointli:
-                if p1 != p2 and p1.dist(p2) <= geometry.to_pixel_units(
-                        self.opt.within_cluster_dist,
-                        self.pixelwidth):
-                    if p2.cluster is not None:
-                        p1.cluster = p2.cluster
-                        clusterli[p1.cluster].append(p1)
-                        break
+            if j != -1:
+                p1.cluster = pointli[j].cluster
+                clusterli[p1.cluster].append(p1)
             else:
                 p1.cluster = len(clusterli)
                 clusterli.append(ClusterData([p1]))
         self.__process_clusters(clusterli)
         return clusterli
 
-    def __parse(self):
-        """ Parse profile data from input file 
+    def read_input(self):
+        """ Read and parse the input file, or restore the parsed data from
+        the profile cache, without checking it. As this does not depend on
+        other profiles, it may be done ahead of process() in another thread.
+        """
+        try:
+            if self.opt.use_profile_cache and not self.in_container:
+                self.__cached = profilecache.load(self.inputfn, self.content_digest,
+                                                  parser_version)
+            self.__parse(self.__cached)
+        except ProfileError as err:
+            self.__read_error = err
+        self.__input_read = True
+
+    def __check_input(self):
+        """ Read the input file unless already done, and check the parsed
+        data and the paths; the verdict of the path check is taken from the
+        profile cache if valid.
+        """
+        if not self.__input_read:
+            self.read_input()
+        if self.__read_error is not None:
+            raise self.__read_error
+        # Now, let's see if everything was found
+        self.__check_parsed_data()
+        cached, self.__cached = self.__cached, None
+        if cached is not None:
+            if cached['path_error'] is not None:
+                raise ProfileError(self, cached['path_error'])
+            sys.stdout.write("  Paths are ok.\n")
+            return
+        try:
+            self.__check_paths()
+        except ProfileError as err:
+            self.__save_profile_cache(err.msg[:-1])  # without the added period
+            raise
+        self.__save_profile_cache(None)
+
+    def __parse(self, cached=None):
+        """ Parse profile data from input file, or restore it from the
+        profile cache data in cached
         """
         sys.stdout.write("\nParsing '%s':\n" % self.inputfn)
-        li = file_io.read_file(self.inputfn)
-        if not li:
-            raise ProfileError(self, "Could not open input file")
-        while li:
-            s = li.pop(0).replace('\n', '').strip()
-            if s.split(' ')[0].upper() == 'IMAGE':
-                self.src_img = s.split(' ')[1]
-            elif s.split(' ')[0].upper() == 'PROFILE_ID':
+        if cached is not None:
+            self.__restore_parsed_data(cached)
+        elif self.lines is not None:
+            lines, self.lines = self.lines, None
+            found = self.__parse_lines(lines)
+            if self.in_container:
+                self._lazy_content_digest = lines.hexdigest()
+            if not found:
+                raise ProfileError(self, "Could not open input file")
+        else:
+            f = file_io.open_input_file(self.inputfn)
+            if not f:
+                raise ProfileError(self, "Could not open input file")
+            with f:
+                if not self.__parse_lines(line.strip() for line in f):
+                    raise ProfileError(self, "Could not open input file")
+
+    def __parse_message(self, s):
+        """ Write a message issued while parsing, and keep it so that it
+        can be repeated when the profile is read from the cache
+        """
+        sys.stdout.write(s)
+        self.parse_messages.append(s)
+
+    def __parse_warning(self, msg):
+        self.__parse_message("Warning: %s.\n" % msg)
+        self.warnflag = True
+
+    def __restore_parsed_data(self, cached):
+        """ Restore parsed profile data from the profile cache
+        """
+        for s in cached['messages']:
+            self.__parse_message(s)
+        self.warnflag = self.warnflag or cached['warnflag']
+        sys.stdout.write("  Read from profile cache.\n")
+        self.src_img = cached['src_img']
+        self.id = cached['id']
+        self.comment = cached['comment']
+        self.pixelwidth = cached['pixelwidth']
+        self.metric_unit = cached['metric_unit']
+        if cached['path']:
+            self.path = ProfileBorderData([geometry.Point(x, y) for x, y in cached['path']])
+        self.holeli = [geometry.SegmentedPath([geometry.Point(x, y) for x, y in hole])
+                       for hole in cached['holes']]
+        self.pli = PointList([geometry.Point(x, y) for x, y in cached['particles']],
+                             "particle", self)
+        self.randomli = PointList([geometry.Point(x, y) for x, y in cached['random']],
+                                  "random", self)
+
+    def __save_profile_cache(self, path_error):
+        """ Save the parsed profile data and the verdict of the path check
+        (path_error, which is None if the paths are ok) to the profile cache
+        """
+        if not self.opt.use_profile_cache or self.in_container:
+            return
+        profilecache.save(self.inputfn, self.content_digest, parser_version, {
+            'src_img': self.src_img,
+            'id': self.id,
+            'comment': self.comment,
+            'pixelwidth': self.pixelwidth,
+            'metric_unit': self.metric_unit,
+            'path': [(p.x, p.y) for p in self.path],
+            'holes': [[(p.x, p.y) for p in h] for h in self.holeli],
+            'particles': [(p.x, p.y) for p in self.pli],
+            'random': [(p.x, p.y) for p in self.randomli],
+            'messages': self.parse_messages,
+            'warnflag': self.warnflag,
+            'path_error': path_error})
+
+    def __parse_lines(self, lines):
+        """ Parse the stripped lines of an input file in a single pass,
+        consuming coordinate blocks as they are encountered. Return False if
+        there were no lines at all.
+        """
+        empty = True
+        for s in lines:
+            empty = False
+            if not s:
+                continue
+            tokens = s.split(' ')
+            keyword = tokens[0].upper()
+            if keyword == 'IMAGE':
+                if len(tokens) > 1:
+                    self.src_img = tokens[1]
+            elif keyword == 'PROFILE_ID':
                 try:
-                    self.id = int(s.split(' ')[1])
+                    self.id = int(tokens[1])
                 except (IndexError, ValueError):
-                    profile_warning(self, "Profile id not defined or invalid")
-            elif s.split(' ')[0].upper() == 'COMMENT':
+                    self.__parse_warning("Profile id not defined or invalid")
+            elif keyword == 'COMMENT':
                 try:
                     self.comment = s.split(' ', 1)[1]
                 except IndexError:
                     self.comment = ''
-            elif s.split(' ')[0].upper() == 'PIXELWIDTH':
+            elif keyword == 'PIXELWIDTH':
                 try:
-                    self.pixelwidth = float(s.split(' ')[1])
-                    self.metric_unit = s.split(' ')[2]
+                    self.pixelwidth = float(tokens[1])
+                    self.metric_unit = tokens[2]
                 except (IndexError, ValueError):
                     raise ProfileError(self, "PIXELWIDTH is not a valid number")
-            elif s.upper() == "PROFILE_BORDER":
-                self.path = ProfileBorderData(self.__get_coords(li, 'path'))
-            elif s.upper() in ("PROFILE_HOLE", "HOLE"):
-                self.holeli.append(geometry.SegmentedPath(self.__get_coords(li, 'hole')))
-            elif s.upper() in ("POINTS", "PARTICLES"):
-                self.pli = PointList(self.__get_coords(li, "particle"), "particle", self)
-            elif s.upper() == "RANDOM_POINTS":
-                self.randomli = PointList(self.__get_coords(li, "random"), "random", self)
-            elif s.upper() == 'GRID':
-                # Retrieve coordinates to dummy variable as they will not be used
-                __ = PointList(self.__get_coords(li, 'grid'), 'grid', self)
-                profile_warning(self, "Grid found; however, as grids are no longer supported " 
-                                      "it will be discarded")
+            elif len(tokens) > 1:
+                if s[0] != "#":
+                    self.__parse_warning("Unrecognized string '%s' in input file" % s)
+            elif keyword == "PROFILE_BORDER":
+                self.path = ProfileBorderData(self.__get_coords(lines, 'path'))
+            elif keyword in ("PROFILE_HOLE", "HOLE"):
+                self.holeli.append(geometry.SegmentedPath(self.__get_coords(lines, 'hole')))
+            elif keyword in ("POINTS", "PARTICLES"):
+                self.pli = PointList(self.__get_coords(lines, "particle"), "particle", self)
+            elif keyword == "RANDOM_POINTS":
+                self.randomli = PointList(self.__get_coords(lines, "random"), "random", self)
+            elif keyword == 'GRID':
+                # Consume coordinates without using them
+                self.__get_coords(lines, 'grid')
+                self.__parse_warning("Grid found; however, as grids are no longer supported "
+                                     "it will be discarded")
             elif s[0] != "#":  # unless specifically commented out
-                profile_warning(self, "Unrecognized string '" + s +
-                                "' in input file")
-        # Now, let's see if everything was found
-        self.__check_parsed_data()
+                self.__parse_warning("Unrecognized string '%s' in input file" % s)
+        return not empty
 
     def __check_parsed_data(self):
         """See if the profile data was parsed correctly, and print info
@@ -697,28 +1039,38 @@ class ProfileData:
                                        % (n + 1, n + n2 + 2))
         sys.stdout.write("  Paths are ok.\n")
 
-    def __get_coords(self, strli, coord_type=""):
-        """Pop point coordinates from list strli.
+    def __get_coords(self, lines, coord_type=""):
+        """Read point coordinates from the iterator lines up to the next
+        END line.
 
-        When an element of strli is not a valid point, a warning is
-        issued.
+        When a line is not a valid point, a warning is issued.
         """
         pointli = []
-        s = strli.pop(0).replace('\n', '').replace(' ', '').strip()
-        while s != 'END':
+        seen = set()
+        last = None
+        for s in lines:
+            if s.replace(' ', '') == 'END':
+                break
+            if not s:
+                continue
             try:
-                p = geometry.Point(float(s.split(',')[0]), float(s.split(',')[1]))
-                if pointli and (p == pointli[-1] or (coord_type == 'particle' and p in pointli)):
-                    sys.stdout.write("Duplicate %s coordinates %s: skipping "
-                                     "2nd instance\n" % (coord_type, p))
-                else:
-                    pointli.append(Point(p.x, p.y, ptype=coord_type))
+                xs, ys = s.split(',', 2)[:2]
+                xy = float(xs), float(ys)
             except ValueError:
                 if s[0] != '#':
-                    profile_warning(self, "'%s' not valid %s coordinates" % (s, coord_type))
-                else:
-                    pass
-            s = strli.pop(0).replace('\n', '').strip()
+                    self.__parse_warning("'%s' not valid %s coordinates" % (s, coord_type))
+                continue
+            if xy == last or (coord_type == 'particle' and xy in seen):
+                self.__parse_message("Duplicate %s coordinates %s: skipping "
+                                     "2nd instance\n" % (coord_type, geometry.Point(*xy)))
+                continue
+            if coord_type == 'particle':
+                seen.add(xy)
+            pointli.append(geometry.Point(*xy))
+            last = xy
+        else:
+            raise ProfileError(self, "%s coordinates not terminated by END"
+                               % coord_type.capitalize())
         # For some reason, sometimes the endnodes have the same coordinates;
         # in that case, delete the last endnode to avoid division by zero
         if (len(pointli) > 1) and (pointli[0] == pointli[-1]):
@@ -753,6 +1105,20 @@ class OptionData:
         self.monte_carlo_runs = 99
         self.monte_carlo_simulation_window = 'profile'
         self.monte_carlo_strict_location = False
+        self.monte_carlo_sampling = 'uniform'
+        self.monte_carlo_seed = None
+        self.monte_carlo_checkpoint_dir = ''
+        self.scratch_dir = ''
+        self.use_profile_cache = False
+        self.prefetch_depth = 0
+        self.processes = 1
+        self.block_processes = 1
+        self.compress_simulated_outputs = False
+        self.output_database = ''
+        self.export_npz = False
+        self.distance_storage = 'double'
+        self.output_layout = 'wide'
+        self.determine_expected_border_dists = False
         self.determine_interpoint_dists = False
         self.interpoint_dist_mode = 'nearest neighbour'
         self.interpoint_relations = {'particle - particle': True,
@@ -764,6 +1130,14 @@ class OptionData:
         self.interpoint_lateral_dist = False
         self.stop_requested = False
 
+    def __getstate__(self):
+        """ Leave out the process queue of the session, which cannot be
+            pickled.
+        """
+        state = self.__dict__.copy()
+        state.pop('process_queue', None)
+        return state
+
     def reset(self):
         """ Resets all options to default, and removes those that are not
             set in __init__().
@@ -1,42 +1,262 @@
+import csv
+import gzip
+import hashlib
+import io
+import itertools
 import os.path
 import sys
+from . import ingest
+
+
+# Size limits of an Excel worksheet; larger output tables are split into
+# several sheets (Excel output) or files (csv output)
+max_rows = 1048576
+max_cols = 16384
+
+# Size of the write buffer of csv output files, and the number of rows passed
+# to the csv writer at a time
+csv_buffer_size = 1 << 20
+csv_batch_rows = 1024
 
 
 class FileWriter:
-    def __init__(self, main_name, opt):
+    def __init__(self, main_name, opt, compress=False):
+        """Writer of the output file main_name. If compress is True, csv
+        output is gzip compressed (and '.gz' is appended to the filename).
+        """
         self.main_name = main_name
         self.opt = opt
         self.format = opt.output_file_format
+        self.compress = compress and self.format == 'csv'
         self.fn = ""
         self.f = None
+        self.xls_writer = None
+        self.files = []
+        self.saved = False
 
     def __enter__(self):
         self.fn = os.path.join(self.opt.output_dir,
                                self.main_name +
                                self.opt.output_filename_suffix +
-                               self.opt.output_filename_ext)
+                               self.opt.output_filename_ext +
+                               ('.gz' if self.compress else ''))
         if (os.path.exists(self.fn) and
                 self.opt.action_if_output_file_exists == 'enumerate'):
                 self.fn = enum_filename(self.fn, 2)
+        self.f = SplitWriter(self.__open_part)
+        return self.f
+
+    def __open_part(self, n):
+        """Open part n (counting from 1) of the output; return its name and
+        a writer for it.
+        """
         if self.format == 'csv':
-            import csv
-            self.f = csv.writer(open(self.fn, 'w'), **self.opt.csv_format)
+            if n == 1:
+                fn = self.fn
+            else:
+                fnbase, fnext = os.path.splitext(self.fn)
+                if self.compress:
+                    fnbase, csvext = os.path.splitext(fnbase)
+                    fnext = csvext + fnext
+                fn = "%s.part%d%s" % (fnbase, n, fnext)
+            if self.compress:
+                # The compressed stream is written in blocks of
+                # csv_buffer_size bytes, and the text is encoded as by open().
+                # The fastest compression level still halves the size of
+                # tables of distances, at a fraction of the time of the
+                # default level.
+                f = io.TextIOWrapper(io.BufferedWriter(
+                    gzip.GzipFile(fn, 'wb', compresslevel=1), csv_buffer_size))
+            else:
+                f = open(fn, 'w', buffering=csv_buffer_size)
+            self.files.append(f)
+            return os.path.basename(fn), CsvWriter(f, **self.opt.csv_format)
         elif self.format == 'excel':
             from . import xls
-            self.f = xls.Writer(self.fn)
-        return self.f
+            if n == 1:
+                self.xls_writer = xls.Writer(self.fn)
+                return "Sheet1", self.xls_writer
+            return "Sheet%d" % n, self.xls_writer.add_sheet("Sheet%d" % n)
+
+    def flush(self):
+        """Write the rows written so far to disk (csv output only; Excel
+        files are only complete when closed)
+        """
+        for f in self.files:
+            f.flush()
 
     def __exit__(self, _type, _val, tb):
+        self.finish(tb)
+        self.report()
+
+    def finish(self, tb=None):
+        """Finish writing the output (tb is the traceback of an exception
+        raised while writing it, if any). Nothing is logged, so several
+        outputs may be finished at once in different threads; the outcome
+        is logged by report().
+        """
         try:
-            if tb is not None:
-                raise IOError
-            if self.format == 'excel':
-                self.f.close()
-            sys.stdout.write("Saved '%s'.\n" % self.fn)
-            self.opt.save_result['any_saved'] = True
+            try:
+                if tb is not None:
+                    raise IOError
+                self.f.finish()
+                if self.format == 'excel':
+                    self.xls_writer.close()
+            finally:
+                for f in self.files:
+                    f.close()
+            self.saved = True
         except IOError:
+            self.saved = False
+
+    def report(self):
+        """Log and record the outcome of finish()"""
+        if not self.saved:
             sys.stdout.write("Error: Unable to save to file '%s'\n" % self.fn)
             self.opt.save_result['any_err'] = True
+            return
+        sys.stdout.write("Saved '%s'.\n" % self.fn)
+        if len(self.f.layout) > 1:
+            sys.stdout.write("  Table exceeds %d rows or %d columns: split into %d %s.\n"
+                             % (max_rows, max_cols, len(self.f.layout),
+                                "sheets" if self.format == 'excel' else "files"))
+            self.opt.save_result['split_outputs'].append(
+                (os.path.basename(self.fn), self.f.layout))
+        self.opt.save_result['any_saved'] = True
+
+
+class CsvWriter:
+    """csv.writer look-alike that formats rows of numbers in bulk. Numbers
+    never need quoting, so such rows are joined directly rather than going
+    through the quoting logic of the csv module; other rows are written by a
+    csv.writer. The output is the same.
+    """
+    _number_types = {float, int}
+    _padded_types = {float, int, str}
+
+    def __init__(self, f, **fmtparams):
+        self.f = f
+        self.writer = csv.writer(f, **fmtparams)
+        dialect = self.writer.dialect
+        self.delimiter = dialect.delimiter
+        self.lineterminator = dialect.lineterminator
+        self.bulk = (dialect.quoting == csv.QUOTE_MINIMAL and
+                     not (dialect.delimiter.isalnum() or dialect.delimiter in '.+-'))
+
+    def writerow(self, row):
+        self.writerows((row,))
+
+    def writerows(self, rows):
+        if not self.bulk:
+            self.writer.writerows(rows)
+            return
+        lines = []
+        for row in rows:
+            types = set(map(type, row))
+            if (types <= self._number_types or
+                    # Rows of numbers padded with empty strings
+                    (types <= self._padded_types and len(row) > 1 and
+                     not any(x for x in row if type(x) is str))):
+                lines.append(self.delimiter.join(map(str, row)))
+            else:
+                self.__write_lines(lines)
+                lines = []
+                self.writer.writerow(row)
+        self.__write_lines(lines)
+
+    def __write_lines(self, lines):
+        if lines:
+            lines.append('')
+            self.f.write(self.lineterminator.join(lines))
+
+
+class SplitWriter:
+    """csv writer look-alike that splits a table into parts of at most
+    max_rows rows and max_cols columns, as the rows are written. The parts
+    are opened by calling open_part(n), which returns a name and a writer
+    for part n. After finish() has been called, layout is a list of
+    (name, first row, last row, first column, last column) tuples, one for
+    each part, with rows and columns numbered from 1.
+    """
+    def __init__(self, open_part):
+        self.open_part = open_part
+        self.parts = {}     # (row block, column block) -> part index
+        self.writers = []
+        self.layout = []
+        self.nrows = 0
+        self.block = []     # (writer, part index) of each column block of the current
+                            # row block
+        self.width = []     # maximum row length in each part
+
+    def writerow(self, row):
+        if self.nrows % max_rows == 0:
+            self.block = []
+        if len(row) <= max_cols and len(self.block) <= 1:
+            # The common case of a table within the limits
+            if not self.block:
+                self.__add_column_block()
+            writer, part = self.block[0]
+            writer.writerow(row)
+            if len(row) > self.width[part]:
+                self.width[part] = len(row)
+        else:
+            while len(self.block) * max_cols < len(row):
+                self.__add_column_block()
+            for cb, (writer, part) in enumerate(self.block):
+                chunk = row[cb * max_cols:(cb + 1) * max_cols]
+                writer.writerow(chunk)
+                self.width[part] = max(self.width[part], len(chunk))
+        self.nrows += 1
+
+    def writerows(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, csv_batch_rows))
+            if not batch:
+                return
+            if self.nrows % max_rows == 0:
+                # Start a new part
+                self.writerow(batch.pop(0))
+            # Pass a batch of rows to the underlying writer at once if they
+            # all go to the same part
+            if not batch:
+                continue
+            if (len(self.block) == 1 and
+                    self.nrows % max_rows + len(batch) <= max_rows and
+                    max(map(len, batch)) <= max_cols):
+                writer, part = self.block[0]
+                writer.writerows(batch)
+                self.width[part] = max(self.width[part], max(map(len, batch)))
+                self.nrows += len(batch)
+            else:
+                for r in batch:
+                    self.writerow(r)
+
+    def __add_column_block(self):
+        rb, cb = self.nrows // max_rows, len(self.block)
+        part = len(self.writers)
+        name, writer = self.open_part(part + 1)
+        self.parts[(rb, cb)] = part
+        self.writers.append(writer)
+        self.layout.append(name)
+        self.width.append(0)
+        # Keep the rows of the parts of this row block aligned
+        for __ in range(self.nrows - rb * max_rows):
+            writer.writerow([])
+        self.block.append((writer, part))
+
+    def finish(self):
+        """Open the first part if nothing has been written, and fill in
+        layout.
+        """
+        if not self.writers:
+            self.__add_column_block()
+        names = self.layout
+        self.layout = []
+        for (rb, cb), part in sorted(self.parts.items(), key=lambda item: item[1]):
+            self.layout.append((names[part],
+                                rb * max_rows + 1, min((rb + 1) * max_rows, self.nrows),
+                                cb * max_cols + 1, cb * max_cols + self.width[part]))
 
 
 def enum_filename(fn, n):
@@ -61,3 +281,100 @@ def read_file(fname):
         sys.stdout.write("Error: File not found or unreadable\n")
         return False
     return s
+
+
+def open_input_file(fname):
+    """Open file (or archive member) named fname for reading line by line;
+       return None if it cannot be opened"""
+    try:
+        return ingest.open_input(fname)
+    except IOError:
+        sys.stdout.write("Error: File not found or unreadable\n")
+        return None
+
+
+class ProfileBlock:
+    """Iterator over the stripped lines of one PROFILE ... END_PROFILE block
+    of a container file, which keeps a digest of the lines it has yielded.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.h = hashlib.sha256()
+        self.next_profile = False
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.done:
+            for s in self.lines:
+                upper = s.upper()
+                if upper in ('END_PROFILE', 'PROFILE'):
+                    # A PROFILE line means that END_PROFILE is missing
+                    self.next_profile = upper == 'PROFILE'
+                    break
+                self.h.update(s.encode('utf-8', 'surrogateescape') + b'\n')
+                return s
+            self.done = True
+        raise StopIteration
+
+    def hexdigest(self):
+        """Return the SHA-256 hex digest of the lines of the block; any
+        lines not yet read are skipped first"""
+        for __ in self:
+            pass
+        return self.h.hexdigest()
+
+
+def iter_profiles(fname):
+    """Yield a (name, lines) tuple for each profile in the input file fname,
+       where lines iterates over the stripped lines of the profile. If fname
+       is a container of PROFILE ... END_PROFILE blocks, these are read one at
+       a time and profile n is named 'fname#n'; otherwise, fname holds a
+       single profile. If fname cannot be opened, lines is None. Each tuple
+       must be done with before the next one is requested."""
+    try:
+        f = ingest.open_input(fname)
+    except IOError:
+        yield fname, None
+        return
+    with f:
+        lines = (s.strip() for s in f)
+        head = []
+        for s in lines:
+            head.append(s)
+            if s and s[0] != '#':
+                break
+        if not head or head[-1].upper() != 'PROFILE':
+            yield fname, itertools.chain(head, lines)
+            return
+        n = 0
+        while True:
+            n += 1
+            block = ProfileBlock(lines)
+            yield '%s#%d' % (fname, n), block
+            block.hexdigest()  # skip any lines not read
+            if block.next_profile:
+                continue
+            for s in lines:
+                if s.upper() == 'PROFILE':
+                    break
+                elif s and s[0] != '#':
+                    sys.stdout.write("Warning: Unrecognized string '%s' outside profile in "
+                                     "input file '%s'.\n" % (s, fname))
+            else:
+                return
+
+
+def file_digest(fname):
+    """Return the SHA-256 hex digest of the contents of the file (or archive
+       member) named fname, or None if the file cannot be read"""
+    h = hashlib.sha256()
+    try:
+        with ingest.open_input(fname, binary=True) as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    except IOError:
+        return None
+    return h.hexdigest()
@@ -10,8 +10,9 @@ import wx
 from . import core
 from . import file_io
 from . import gui
+from . import ingest
 from . import main
-from . import stringconv
+from . import options
 from . import version
 
 
@@ -160,7 +161,10 @@ class Frame(gui.MainFrame):
             self.log.update()
             if event_type == "done" and self.log.fn != "":
                 self.StatusBar.SetStatusText("Logged to '" + self.log.fn + "'.")
-            if not dlg.Update(i, msg)[0] and not self.opt.stop_requested:
+            # Archives and manifests may expand to more input files
+            # than there are items in the list
+            if (not dlg.Update(min(i, dlg.GetRange()), msg)[0] and
+                    not self.opt.stop_requested):
                 if self.yes_no_dialog("Abort process?"):
                     pthread.stop()
                     dlg.Hide()
@@ -250,133 +254,18 @@ class Frame(gui.MainFrame):
                               % (inputdir, self.configfn))
 
     def save_options_to_config(self):
-
-        def set_option(option):
-            config['Options'][option] = str(getattr(self.opt, option))
-
-        def set_dict_option(option):
-            optdict = getattr(self.opt, option)
-            for key, val in list(optdict.items()):
-                optstr = '.'.join([option, key.replace(' ', '_')])
-                config['Options'][optstr] = str(val)
-
         self.set_options_from_ui()
-        config = configparser.ConfigParser()
-        try:
-            config.read(self.configfn)
-        except (configparser.ParsingError, configparser.MissingSectionHeaderError):
-            pass  # Silently suppress parsing errors at this stage
-        if 'Options' not in config.sections():
-            config['Options'] = {}
-        set_option('output_file_format')
-        set_option('csv_delimiter')
-        set_option('action_if_output_file_exists')
-        set_option('output_filename_date_suffix')
-        set_option('spatial_resolution')
-        set_option('shell_width')
-        set_option('determine_clusters')
-        set_option('within_cluster_dist')
-        set_option('run_monte_carlo')
-        set_option('monte_carlo_runs')
-        set_option('determine_interpoint_dists')
-        set_option('monte_carlo_simulation_window')
-        set_option('monte_carlo_strict_location')
-        set_option('interpoint_dist_mode')
-        set_option('interpoint_shortest_dist')
-        set_option('interpoint_lateral_dist')
-        set_dict_option('interpoint_relations')
-        set_dict_option('outputs')
         try:
-            with open(self.configfn, 'w') as f:
-                config.write(f)
+            options.write_config(self.opt, self.configfn)
         except IOError:
             self.show_warning("Configuration file\n(%s)\ncould not be saved." % self.configfn)
+            return False
+        return True
 
-    def load_options_from_config(self):
-
-        def show_invalid_option_warning(invalid_opt):
-            self.show_warning("Invalid value '%s' for option '%s' in "
-                              "configuration file '%s'.\nUsing default value."
-                              % (getattr(self.opt, invalid_opt), invalid_opt,
-                                 self.configfn))
-
-        def check_str_option(opt, valid_strings=()):
-            if getattr(self.opt, opt) not in valid_strings:
-                show_invalid_option_warning(opt)
-                setattr(self.opt, opt, getattr(defaults, opt))
-
-        def check_int_option(opt, lower=None, upper=None):
-            try:
-                setattr(self.opt, opt,
-                        stringconv.str_to_int(getattr(self.opt, opt), lower, upper))
-            except ValueError:
-                show_invalid_option_warning(opt)
-                setattr(self.opt, opt, getattr(defaults, opt))
-
-        def check_bool_option(opt):
-            try:
-                setattr(self.opt, opt, stringconv.str_to_bool(getattr(self.opt, opt)))
-            except ValueError:
-                show_invalid_option_warning(opt)
-                setattr(self.opt, opt, getattr(defaults, opt))
-
-        def check_bool_dict_option(opt):
-            optdict = getattr(self.opt, opt)
-            defaultdict = getattr(defaults, opt)
-            for key, val in list(optdict.items()):
-                optstr = '.'.join([opt, key.replace(" ", "_")])
-                if key not in list(getattr(defaults, opt).keys()):
-                    self.show_warning("Invalid option '%s' in configuration file '%s'."
-                                      % (optstr, self.configfn))
-                    del optdict[key]
-                try:
-                    optdict[key] = stringconv.str_to_bool(val)
-                except ValueError:
-                    self.show_warning("Invalid value '%s' for option '%s' in "
-                                      "configuration file '%s'.\nUsing default "
-                                      "value." % (val, optstr, self.configfn))
-                    optdict[key] = defaultdict[key]
-
-        config = configparser.ConfigParser()
-        if not os.path.exists(self.configfn):
-            return
-        try:
-            config.read(self.configfn)
-        except (configparser.ParsingError, configparser.MissingSectionHeaderError):
-            return     # Silently suppress parsing errors at this stage
-        if 'Options' not in config.sections():
-            return     # No options present in config file; silently use defaults
-        defaults = core.OptionData()
-        for option in config.options('Options'):
-            if '.' in option:
-                option_dict, option_key = option.split('.', 1)
-                option_key = option_key.replace("_", " ")
-                try:
-                    getattr(self.opt,
-                            option_dict)[option_key] = config.get('Options', option)
-                except AttributeError:
-                    pass   # So, attribute is invalid, but continue silently
-            else:
-                setattr(self.opt, option, config.get('Options', option))
-        check_str_option('output_file_format', ('excel', 'csv'))
-        check_str_option('csv_delimiter', ('comma', 'tab'))
-        check_str_option('action_if_output_file_exists', ('enumerate', 'overwrite'))
-        check_bool_option('output_filename_date_suffix')
-        check_int_option('spatial_resolution', lower=0, upper=1000)
-        check_int_option('shell_width', lower=0, upper=1000)
-        check_bool_option('determine_clusters')
-        check_int_option('within_cluster_dist', lower=1, upper=1000)
-        check_bool_option('run_monte_carlo')
-        check_int_option('monte_carlo_runs', lower=1, upper=999)
-        check_bool_option('determine_interpoint_dists')
-        check_str_option('monte_carlo_simulation_window', ('profile',
-                                                           'profile + shell'))
-        check_bool_option('monte_carlo_strict_location')
-        check_str_option('interpoint_dist_mode', ('nearest neighbour', 'all'))
-        check_bool_option('interpoint_shortest_dist')
-        check_bool_option('interpoint_lateral_dist')
-        check_bool_dict_option('interpoint_relations')
-        check_bool_dict_option('outputs')
+    def load_options_from_config(self, warn=None):
+        options.apply_options(self.opt, options.read_config(self.configfn),
+                              "configuration file '%s'" % self.configfn,
+                              warn or self.show_warning)
 
     def set_options_in_ui(self):
         self.SpatResSpinCtrl.SetValue(self.opt.spatial_resolution)
@@ -433,6 +322,10 @@ class Frame(gui.MainFrame):
         self.LogFilePickerCtrl.SetPath(version.title + '.log')
  
     def set_options_from_ui(self):
+        # Options without a widget are only kept in the configuration file,
+        # and are reset to defaults at the end of each session; invalid
+        # values were already reported when the frame was created
+        self.load_options_from_config(warn=lambda s: None)
         self.opt.input_file_list = []
         for n in range(0, self.InputFileListCtrl.GetItemCount()):
             self.opt.input_file_list.append(os.path.join(
@@ -502,7 +395,8 @@ class Frame(gui.MainFrame):
         fn = ""
         for fn in fli:
             if (os.path.isfile(fn) and
-                    os.path.splitext(fn)[1] == self.opt.input_filename_ext):
+                    (os.path.splitext(fn)[1] == self.opt.input_filename_ext or
+                     ingest.is_archive(fn) or ingest.is_manifest(fn))):
                 self.InputFileListCtrl.InsertItem(c + n, os.path.basename(fn))
                 self.InputFileListCtrl.SetItem(c + n, 1, os.path.dirname(fn))
                 n += 1
@@ -339,17 +339,10 @@ class Point(object):
         """ Determine lateral distance to a point p2 along profile
             border. Assume profile border is a closed path.
         """
-        path = SegmentedPath()
         p2_project, p2_seg_project = p2.project_on_closed_path(border)
         project, seg_project = self.project_on_closed_path(border)
-        path.extend([project, p2_project])
-        if p2_seg_project < seg_project:
-            path.reverse()
-        for n in range(min(p2_seg_project, seg_project) + 1,
-                       max(p2_seg_project, seg_project)):
-            path.insert(len(path) - 1, border[n])
-        length = path.length()
-        return min(length, border.perimeter() - length)
+        return lateral_dist_between_projections(project, seg_project,
+                                                 p2_project, p2_seg_project, border)
 
 # end of class Point
 
@@ -715,6 +708,79 @@ def segments_intersect_or_coincide(a, b, c, d):
     return False
 
 
+def closed_path_distances(xs, ys, path):
+    """Return a list of the distances from each of the points given by the
+       coordinate sequences xs and ys to the closed path path. Equivalent to
+       calling Point.perpend_dist_closed_path() for each point, but avoids
+       creating intermediate Point and Vec objects.
+    """
+    segli = []
+    for n in range(-1, len(path) - 1):
+        a, b = path[n], path[n + 1]
+        if a.x != -1 and b.x != -1:
+            dx, dy = b.x - a.x, b.y - a.y
+            segli.append((a.x, a.y, dx, dy, dx * dx + dy * dy))
+    if not segli:
+        return [None] * len(xs)
+    distli = []
+    for x, y in zip(xs, ys):
+        mind2 = float("inf")
+        for ax, ay, dx, dy, len2 in segli:
+            ux, uy = x - ax, y - ay
+            t = (ux * dx + uy * dy) / len2 if len2 else 0.0
+            if t <= 0:
+                d2 = ux * ux + uy * uy
+            elif t >= 1:
+                d2 = (ux - dx) ** 2 + (uy - dy) ** 2
+            else:
+                d2 = (ux * dy - uy * dx) ** 2 / len2
+            if d2 < mind2:
+                mind2 = d2
+        distli.append(math.sqrt(mind2))
+    return distli
+
+
+def polygon_contains(xs, ys, pol):
+    """Return a list of booleans telling whether each of the points given by
+       the coordinate sequences xs and ys is inside the polygon pol.
+       Equivalent to calling Point.is_within_polygon() for each point.
+    """
+    if not pol:
+        return [None] * len(xs)
+    edgeli = [(pol[n].x, pol[n].y, pol[n + 1].x, pol[n + 1].y)
+              for n in range(-1, len(pol) - 1)]
+    insideli = []
+    for x, y in zip(xs, ys):
+        cn = 0
+        for x0, y0, x1, y1 in edgeli:
+            if (y0 <= y < y1) or (y0 > y and y1 <= y):
+                if x0 + (y - y0) * (x1 - x0) / (y1 - y0) > x:
+                    cn += 1
+        insideli.append(cn % 2 == 1)
+    return insideli
+
+
+def lateral_dist_between_projections(project, seg_project, p2_project, p2_seg_project,
+                                     border, perimeter=None):
+    """Return the lateral distance along the closed path border between two
+       points, given their projections on border and the first nodes of the
+       segments they project on (as returned by
+       Point.project_on_closed_path()). The perimeter of border may be
+       given if known.
+    """
+    path = SegmentedPath()
+    path.extend([project, p2_project])
+    if p2_seg_project < seg_project:
+        path.reverse()
+    for n in range(min(p2_seg_project, seg_project) + 1,
+                   max(p2_seg_project, seg_project)):
+        path.insert(len(path) - 1, border[n])
+    length = path.length()
+    if perimeter is None:
+        perimeter = border.perimeter()
+    return min(length, perimeter - length)
+
+
 def convex_hull_graham(pointli):
     """Determine the convex hull of the points in pointli.
 
@@ -0,0 +1,225 @@
+import glob
+import io
+import os
+import os.path
+import sys
+import tarfile
+import threading
+import zipfile
+
+
+#
+# Batch ingestion of input files.
+#
+# An input source can be a plain input file, a directory (searched
+# recursively for input files), a glob pattern, a zip or tar archive, or a
+# manifest file listing further sources, one per line. Members of archives
+# are named 'archive::member' and are read directly from the archive without
+# extracting them.
+#
+
+member_separator = '::'
+manifest_ext = '.pdlist'
+zip_exts = ('.zip',)
+tar_exts = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def is_archive(fn):
+    return fn.lower().endswith(zip_exts + tar_exts)
+
+
+def is_manifest(fn):
+    return fn.lower().endswith(manifest_ext)
+
+
+def is_glob(s):
+    return glob.has_magic(s)
+
+
+def is_archive_member(fn):
+    return member_separator in fn
+
+
+def split_member_name(fn):
+    """Split 'archive::member' into archive filename and member name"""
+    archive, member = fn.split(member_separator, 1)
+    return archive, member
+
+
+def expand_inputs(sources, ext):
+    """Expand the list of input sources into a list of input files. Files
+    found in directories, by glob patterns and in archives are included only
+    if they have the extension ext, and are sorted by name; otherwise, the
+    order of the sources is kept. Duplicates are removed, keeping the last
+    occurrence.
+    """
+    inputfli = []
+    for source in sources:
+        inputfli.extend(_expand_source(source, ext, set()))
+    return remove_duplicates(inputfli)
+
+
+def remove_duplicates(fli):
+    """Remove duplicate filenames in fli, keeping the last occurrence of
+    each, and return the resulting list.
+    """
+    last = {}
+    for n, fn in enumerate(fli):
+        last[_canonical_name(fn)] = n
+    uniquefli = []
+    for n, fn in enumerate(fli):
+        if last[_canonical_name(fn)] == n:
+            uniquefli.append(fn)
+        else:
+            sys.stdout.write("Duplicate input filename %s:\n   => removing first occurrence in "
+                             "list\n" % fn)
+    return uniquefli
+
+
+def _canonical_name(fn):
+    if is_archive_member(fn):
+        archive, member = split_member_name(fn)
+        return _canonical_name(archive) + member_separator + member
+    return os.path.normcase(os.path.abspath(fn))
+
+
+def _has_ext(fn, ext):
+    return fn.lower().endswith(ext.lower())
+
+
+def _expand_source(source, ext, manifests):
+    if os.path.isdir(source):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            found.extend(os.path.join(dirpath, fn) for fn in filenames if _has_ext(fn, ext))
+        return sorted(found)
+    if is_manifest(source) and os.path.isfile(source):
+        return _expand_manifest(source, ext, manifests)
+    if is_archive(source) and os.path.isfile(source):
+        return _archive_members(source, ext)
+    if is_glob(source) and not os.path.exists(source):
+        found = []
+        for fn in sorted(glob.glob(source, recursive=True)):
+            if os.path.isdir(fn) or is_archive(fn) or is_manifest(fn):
+                found.extend(_expand_source(fn, ext, manifests))
+            elif _has_ext(fn, ext):
+                found.append(fn)
+        if not found:
+            sys.stdout.write("Warning: No input files matching '%s'.\n" % source)
+        return found
+    # A plain input file (or archive member); if it does not exist, this
+    # will be reported when it is parsed
+    return [source]
+
+
+def _expand_manifest(fn, ext, manifests):
+    """Return the input files listed in the manifest file fn. Relative paths
+    are relative to the directory of the manifest.
+    """
+    key = _canonical_name(fn)
+    if key in manifests:
+        sys.stdout.write("Warning: Manifest '%s' includes itself; skipping.\n" % fn)
+        return []
+    manifests = manifests | {key}
+    found = []
+    try:
+        with open(fn, mode="r", errors="surrogateescape") as f:
+            lines = [s.strip() for s in f]
+    except IOError:
+        sys.stdout.write("Warning: Unable to read manifest '%s'.\n" % fn)
+        return []
+    for s in lines:
+        if not s or s[0] == '#':
+            continue
+        if not os.path.isabs(s):
+            s = os.path.join(os.path.dirname(fn), s)
+        found.extend(_expand_source(s, ext, manifests))
+    return found
+
+
+def _archive_members(fn, ext):
+    try:
+        names = _get_archive(fn).names
+    except (IOError, zipfile.BadZipFile, tarfile.TarError):
+        sys.stdout.write("Warning: Unable to read archive '%s'.\n" % fn)
+        return []
+    return [fn + member_separator + name for name in sorted(names) if _has_ext(name, ext)]
+
+
+class _Archive:
+    """An open zip or tar archive, with a lock serializing member reads"""
+    def __init__(self, fn):
+        self.lock = threading.Lock()
+        if fn.lower().endswith(zip_exts):
+            self.zf = zipfile.ZipFile(fn)
+            self.tf = None
+            self.members = {info.filename: info for info in self.zf.infolist()
+                            if not info.is_dir()}
+        else:
+            self.zf = None
+            self.tf = tarfile.open(fn)
+            self.members = {info.name: info for info in self.tf.getmembers() if info.isfile()}
+        self.names = list(self.members)
+
+    def read(self, name):
+        with self.lock:
+            if self.zf is not None:
+                return self.zf.read(self.members[name])
+            return self.tf.extractfile(self.members[name]).read()
+
+    def close(self):
+        (self.zf or self.tf).close()
+
+
+def _get_archive(fn):
+    key = _canonical_name(fn)
+    with _archives_lock:
+        if key not in _archives:
+            _archives[key] = _Archive(fn)
+        return _archives[key]
+
+
+def close_archives():
+    """Close all archives opened for reading members"""
+    with _archives_lock:
+        for archive in _archives.values():
+            archive.close()
+        _archives.clear()
+
+
+def discard_archives():
+    """Forget archives opened by a parent process without closing them; to
+    be called in a forked child process, which must not share their file
+    positions with the parent.
+    """
+    global _archives, _archives_lock
+    _archives = {}
+    _archives_lock = threading.Lock()
+
+
+def read_member(fn):
+    """Return the contents of the archive member named 'archive::member' as
+    bytes. Raise IOError if it cannot be read.
+    """
+    archive, member = split_member_name(fn)
+    try:
+        return _get_archive(archive).read(member)
+    except (KeyError, zipfile.BadZipFile, tarfile.TarError) as err:
+        raise IOError(str(err))
+
+
+def open_input(fn, binary=False):
+    """Open the input file or archive member fn for reading, as text
+    (decoded as by open()) or binary.
+    """
+    if not is_archive_member(fn):
+        if binary:
+            return open(fn, 'rb')
+        return open(fn, mode="r", errors="surrogateescape")
+    f = io.BytesIO(read_member(fn))
+    if binary:
+        return f
+    return io.TextIOWrapper(f, errors="surrogateescape")
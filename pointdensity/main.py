@@ -1,9 +1,24 @@
+import collections
+import concurrent.futures
+import functools
 import itertools
+import operator
 import os.path
+import shutil
+import sqlite3
+import tempfile
 import time
 from .core import *
+from . import blocks
 from . import geometry
 from . import file_io
+from . import ingest
+from . import npzexport
+from . import parallel
+from . import planner
+from . import prefetch
+from . import runstore
+from . import sqlitestore
 from . import version
 from . import stringconv
 
@@ -19,152 +34,243 @@ def evaluated_profile_li(profileli):
     return [pro for pro in profileli if not pro.errflag]
 
 
-def save_output(profileli, opt):
-    """ Save a summary of results of evaluated profiles
+def metric(x, pixelwidth):
+    return geometry.to_metric_units(x, pixelwidth)
+
+
+def metric_all(li, pixelwidth):
+    # Scale all lengths in li at once
+    try:
+        return list(map(operator.mul, li, itertools.repeat(pixelwidth)))
+    except TypeError:
+        return [metric(x, pixelwidth) for x in li]
+
+
+def metric_area(x, pixelwidth):
+    # For area units
+    return geometry.to_metric_units(x, pixelwidth**2)
+
+
+def na(x):
+    if x in (None, -1):
+        return "N/A"
+    else:
+        return x
+
+
+class OutputTable:
+    """ An output file to which rows are written as profiles are processed.
+        If writing fails, the error is reported when the file is closed.
     """
-    def m(x, pixelwidth):
-        return geometry.to_metric_units(x, pixelwidth)
+    def __init__(self, main_name, opt, compress=False):
+        self.file_writer = file_io.FileWriter(main_name, opt, compress=compress)
+        self.f = self.file_writer.__enter__()
+        self.exc_info = (None, None, None)
 
-    def m2(x, pixelwidth):
-        # For area units
-        return geometry.to_metric_units(x, pixelwidth**2)
+    def writerows(self, rows):
+        if self.exc_info[2] is not None:
+            return
+        try:
+            self.f.writerows(rows)
+        except (IOError, OSError):
+            self.exc_info = sys.exc_info()
 
-    def na(x):
-        if x in (None, -1):
-            return "N/A"
-        else:
-            return x
+    def flush(self):
+        if self.exc_info[2] is not None:
+            return
+        try:
+            self.file_writer.flush()
+        except (IOError, OSError):
+            self.exc_info = sys.exc_info()
 
-    def write_session_summary():
-        if not opt.outputs['session summary']:
+    def finish(self):
+        """ Finish the file, without logging (see FileWriter.finish()) """
+        self.file_writer.finish(self.exc_info[2])
+
+    def report(self):
+        self.file_writer.report()
+
+
+class SessionOutput:
+    """ Output tables of a session. The rows of each profile are written as
+        soon as the profile has been processed, after which its points,
+        distances and Monte Carlo runs can be freed; only the counts and
+        filenames needed for the session summary are kept.
+    """
+    def __init__(self, opt):
+        self.opt = opt
+        opt.save_result = {'any_saved': False, 'any_err': False, 'split_outputs': []}
+        self.n_evaluated = 0
+        self.metric_unit = ''
+        self.clean_fli = []
+        self.warn_fli = []
+        self.err_fli = []
+        self.nop_fli = []
+        self.tables = {}
+        self.ip_prefixli = []
+        self.ip_cols = []
+        self.ip_columns = []
+        self.numeric = None
+
+    def add_profile(self, pro):
+        """ Write the results of the processed profile pro """
+        if not (pro.errflag or pro.warnflag):
+            self.clean_fli.append(pro.inputfn)
+        if pro.warnflag:
+            self.warn_fli.append(pro.inputfn)
+        if pro.errflag:
+            self.err_fli.append(pro.inputfn)
+        if not pro.pli:
+            self.nop_fli.append(pro.inputfn)
+        if pro.errflag:
             return
-        with file_io.FileWriter("session.summary", opt) as f:
-            f.writerow(["%s version:" % version.title,
-                        "%s (Last modified %s %s, %s)" % ((version.version,) + version.date)])
-            f.writerow(["Number of evaluated profiles:", len(eval_proli)])
-            if err_fli:
-                f.writerow(["Number of non-evaluated profiles:", len(err_fli)])
-            f.writerow(["Metric unit:", eval_proli[0].metric_unit])
-            f.writerow(["Spatial resolution:", opt.spatial_resolution,
-                        eval_proli[0].metric_unit])
-            f.writerow(["Shell width:", opt.shell_width, eval_proli[0].metric_unit])
-            f.writerow(["Interpoint distances calculated:",
-                        stringconv.yes_or_no(opt.determine_interpoint_dists)])
-            if opt.determine_interpoint_dists:
-                f.writerow(["Interpoint distance mode:", opt.interpoint_dist_mode])
-                f.writerow(["Shortest interpoint distances:",
-                            stringconv.yes_or_no(opt.interpoint_shortest_dist)])
-                f.writerow(["Lateral interpoint distances:",
-                            stringconv.yes_or_no(opt.interpoint_lateral_dist)])
-            f.writerow(["Monte Carlo simulations performed:",
-                        stringconv.yes_or_no(opt.run_monte_carlo)])
-            if opt.run_monte_carlo:
-                f.writerow(["Number of Monte Carlo runs:", opt.monte_carlo_runs])
-                f.writerow(["Monte Carlo simulation window:", opt.monte_carlo_simulation_window])
-                f.writerow(["Strict localization in simulation window:",
-                            stringconv.yes_or_no(opt.monte_carlo_strict_location)])
-            f.writerow(["Clusters determined:", stringconv.yes_or_no(opt.determine_clusters)])
-            if opt.determine_clusters:
-                f.writerow(["Within-cluster distance:",
-                            opt.within_cluster_dist,
-                            eval_proli[0].metric_unit])
-            if clean_fli:
-                f.writerow(["Input files processed cleanly:"])
-                f.writerows([[fn] for fn in clean_fli])
-            if nop_fli:
-                f.writerow(["Input files processed but which generated no particle distances:"])
-                f.writerows([[fn] for fn in nop_fli])
-            if warn_fli:
-                f.writerow(["Input files processed but which generated "
-                            "warnings (see log for details):"])
-                f.writerows([[fn] for fn in warn_fli])
-            if err_fli:
-                f.writerow(["Input files not processed or not included in "
-                            "summary (see log for details):"])
-                f.writerows([[fn] for fn in err_fli])
-
-    def write_profile_summary():
-        with file_io.FileWriter("profile.summary", opt) as f:
-            f.writerow(["Perimeter",
-                        "Area",
-                        "Feret diameter",
-                        "Number of points (total)",
-                        "Number of points within profile",
-                        "Number of points associated with profile",
-                        "Number of points associated with border",
-                        "Area density of points within profile * 1e6",
-                        "Profile ID",
-                        "Input file",
-                        "Comment"])
-            f.writerows([[m(pro.perimeter, pro.pixelwidth),
-                          m2(pro.area, pro.pixelwidth),
-                          m(pro.feret, pro.pixelwidth),
-                          len(pro.pli),
-                          len([p for p in pro.pli
-                               if p.is_within_profile]),
-                          len([p for p in pro.pli
-                               if (p.is_within_profile or
-                                   p.is_associated_with_path)]),
-                          len([p for p in pro.pli
-                               if p.is_associated_with_path]),
-                          1e6*(len([p for p in pro.pli
-                                    if p.is_within_profile])
-                               / m2(pro.area, pro.pixelwidth)),
-                          pro.id,
-                          os.path.basename(pro.inputfn),
-                          pro.comment] for pro in eval_proli])
-
-    def write_point_summary(ptype):
-        if ptype == 'particle' and opt.outputs['particle summary']:
-            pli = 'pli'
-            pstr = 'particle'
-        elif ptype == 'random' and opt.outputs['particle summary'] and opt.use_random:
-            pli = 'randomli'
-            pstr = 'point'
+        if self.n_evaluated == 0:
+            self.metric_unit = pro.metric_unit
+            self.__open_tables()
+        self.n_evaluated += 1
+        self.__write_profile_summary(pro)
+        self.__write_point_summary(pro, 'particle')
+        self.__write_point_summary(pro, 'random')
+        self.__write_interpoint_summaries(pro)
+        self.__write_cluster_summary(pro)
+        self.__write_expected_border_dists(pro)
+        self.__write_mc_dist_to_path(pro)
+        self.__write_mc_ip_dists(pro)
+        self.__write_mc_cluster_summary(pro)
+        if self.numeric is not None:
+            self.numeric.add_profile(pro)
+        # Keep the rows written so far on disk, should the session not end
+        # normally
+        for table in self.tables.values():
+            table.flush()
+
+    def __open_tables(self):
+        opt = self.opt
+        self.tables['profile.summary'] = OutputTable("profile.summary", opt)
+        self.tables['profile.summary'].writerows([["Perimeter",
+                                                   "Area",
+                                                   "Feret diameter",
+                                                   "Number of points (total)",
+                                                   "Number of points within profile",
+                                                   "Number of points associated with profile",
+                                                   "Number of points associated with border",
+                                                   "Area density of points within profile * 1e6",
+                                                   "Profile ID",
+                                                   "Input file",
+                                                   "Comment"]])
+        for ptype, pstr in (('particle', 'particle'), ('random', 'point')):
+            if ptype == 'particle' and not opt.outputs['particle summary']:
+                continue
+            if ptype == 'random' and not (opt.use_random and opt.outputs['random summary']):
+                continue
+            table = self.tables['%s.summary' % ptype] = OutputTable("%s.summary" % ptype, opt)
+            table.writerows([["%s number (as appearing in input file)" % pstr.capitalize(),
+                              "Distance to profile border",
+                              "Within profile",
+                              "Profile border-associated",
+                              "Profile-associated",
+                              "Profile ID",
+                              "Input file",
+                              "Comment"]])
+        self.__open_interpoint_summaries()
+        if opt.determine_clusters:
+            self.tables['cluster.summary'] = OutputTable("cluster.summary", opt)
+            self.tables['cluster.summary'].writerows([["Cluster number",
+                                                       "Number of points in cluster",
+                                                       "Distance to profile border of centroid",
+                                                       "Distance to nearest cluster along border",
+                                                       "Profile ID",
+                                                       "Input file",
+                                                       "Comment"]])
+        if opt.determine_expected_border_dists:
+            table = self.tables['expected.border.distances'] = OutputTable(
+                "expected.border.distances", opt)
+            table.writerows([["Mean"] +
+                             ["%g%% quantile" % (100 * q) for q in border_dist_quantile_levels] +
+                             ["Profile ID",
+                              "Input file",
+                              "Comment"]])
+            table = self.tables['expected.border.distance.cdf'] = OutputTable(
+                "expected.border.distance.cdf", opt)
+            table.writerows([["Distance to profile border",
+                              "Cumulative probability",
+                              "Profile ID",
+                              "Input file",
+                              "Comment"]])
+        if opt.output_layout == 'long':
+            border_header = [["Run", "Distance to profile border",
+                              "Profile ID", "Input file", "Comment"]]
+            ip_header = [["Run", "Distance", "Profile ID", "Input file", "Comment"]]
         else:
+            border_header = ip_header = [["Run %d" % (n + 1)
+                                          for n in range(0, opt.monte_carlo_runs)]]
+        if opt.run_monte_carlo:
+            table = self.tables['simulated.border.distances'] = OutputTable(
+                "simulated.border.distances", opt, compress=opt.compress_simulated_outputs)
+            table.writerows(border_header)
+        for ip_type, dist_type in self.__mc_ip_outputs():
+            name = "%s.interpoint.%s.distances" % (ip_type.replace(" ", ""), dist_type)
+            self.tables[name] = OutputTable(name, opt, compress=opt.compress_simulated_outputs)
+            self.tables[name].writerows(ip_header)
+        if opt.determine_clusters and opt.run_monte_carlo:
+            table = self.tables['simulated.cluster.summary'] = OutputTable(
+                "simulated.cluster.summary", opt)
+            table.writerows([["N particles in cluster", "Run",
+                              "Distance to profile border from centroid",
+                              "Distance to nearest cluster",
+                              "Profile ID",
+                              "Input file",
+                              "Comment"]])
+        if opt.export_npz:
+            self.numeric = npzexport.NumericTables(opt)
+
+    def __write_profile_summary(self, pro):
+        n_within = len([p for p in pro.pli if p.is_within_profile])
+        self.tables['profile.summary'].writerows([[
+            metric(pro.perimeter, pro.pixelwidth),
+            metric_area(pro.area, pro.pixelwidth),
+            metric(pro.feret, pro.pixelwidth),
+            len(pro.pli),
+            n_within,
+            len([p for p in pro.pli
+                 if (p.is_within_profile or
+                     p.is_associated_with_path)]),
+            len([p for p in pro.pli
+                 if p.is_associated_with_path]),
+            1e6*(n_within / metric_area(pro.area, pro.pixelwidth)),
+            pro.id,
+            os.path.basename(pro.inputfn),
+            pro.comment]])
+
+    def __write_point_summary(self, pro, ptype):
+        table = self.tables.get('%s.summary' % ptype)
+        if table is None:
             return
-        with file_io.FileWriter("%s.summary" % ptype, opt) as f:
-            f.writerow(["%s number (as appearing in input file)"
-                        % pstr.capitalize(),
-                        "Distance to profile border",                                                
-                        "Within profile",
-                        "Profile border-associated",
-                        "Profile-associated",                      
-                        "Profile ID",
-                        "Input file",
-                        "Comment"])
-            f.writerows([[n+1, 
-                          m(p.dist_to_path, pro.pixelwidth),                                                    
+        pli = pro.pli if ptype == 'particle' else pro.randomli
+        table.writerows([[n+1,
+                          metric(p.dist_to_path, pro.pixelwidth),
                           stringconv.yes_or_no(p.is_within_profile),
                           stringconv.yes_or_no(p.is_associated_with_path),
                           stringconv.yes_or_no(p.is_within_profile or
-                                       p.is_associated_with_path),
+                                               p.is_associated_with_path),
                           pro.id,
                           os.path.basename(pro.inputfn),
-                          pro.comment] for pro in eval_proli for n, p in
-                         enumerate(pro.__dict__[pli])])
+                          pro.comment] for n, p in enumerate(pli)])
 
-    def write_cluster_summary():
-        if not opt.determine_clusters:
+    def __write_cluster_summary(self, pro):
+        if 'cluster.summary' not in self.tables:
             return
-        with file_io.FileWriter("cluster.summary", opt) as f:
-            f.writerow(["Cluster number",
-                        "Number of points in cluster",
-                        "Distance to profile border of centroid",
-                        "Distance to nearest cluster along border",
-                        "Profile ID",
-                        "Input file",
-                        "Comment"])
-            f.writerows([[n + 1,
-                          len(c),
-                          m(c.dist_to_path, pro.pixelwidth),
-                          m(na(c.dist_to_nearest_cluster), pro.pixelwidth),
-                          pro.id,
-                          os.path.basename(pro.inputfn),
-                          pro.comment] for pro in eval_proli for n, c in
-                         enumerate(pro.clusterli)])
+        self.tables['cluster.summary'].writerows([[
+            n + 1,
+            len(c),
+            metric(c.dist_to_path, pro.pixelwidth),
+            metric(na(c.dist_to_nearest_cluster), pro.pixelwidth),
+            pro.id,
+            os.path.basename(pro.inputfn),
+            pro.comment] for n, c in enumerate(pro.clusterli)])
 
-    def write_interpoint_summaries():
+    def __open_interpoint_summaries(self):
+        opt = self.opt
         if not opt.determine_interpoint_dists:
             return
         ip_rels = dict([(key, val)
@@ -177,6 +283,24 @@ def save_output(profileli, opt):
         if (len(ip_rels) == 0 or not
            (opt.interpoint_shortest_dist or opt.interpoint_lateral_dist)):
             return
+        if opt.output_layout == 'long':
+            # One row per distance, in the order of the columns of the wide
+            # layout
+            self.ip_columns = []
+            for dist_type, suffix, selected in (("shortest", "", opt.interpoint_shortest_dist),
+                                                ("lateral", "lat", opt.interpoint_lateral_dist)):
+                if selected:
+                    self.ip_columns.extend(
+                        (key, dist_type, key[0] + key[key.index("- ") + 2] + "_" + suffix)
+                        for key in ip_rels)
+            self.tables['interpoint.distances'] = OutputTable("interpoint.distances", opt)
+            self.tables['interpoint.distances'].writerows([["Relation",
+                                                            "Distance type",
+                                                            "Distance",
+                                                            "Profile ID",
+                                                            "Input file",
+                                                            "Comment"]])
+            return
         table = []
         if opt.interpoint_dist_mode == 'all':
             s = "all distances"
@@ -203,108 +327,253 @@ def save_output(profileli, opt):
             topheaderli.append("Lateral distances along profile border")
         topheaderli.append("Input file")
         table.extend([topheaderli, headerli])
-        cols = [[] for _ in range(len(prefixli) + 1)]  # len+1 to account for input file column
-        for pro in eval_proli:
-            maxlength = 0   # find length of largest distli in profile
-            for n, li in enumerate([pro.__dict__[prefix + "distli"] for prefix in prefixli]):
-                maxlength = max(maxlength, len(li))
-                cols[n].extend([m(e, pro.pixelwidth) for e in li])
-            for _ in range(maxlength):    # input file should be added to all rows
-                cols[-1].append(os.path.basename(pro.inputfn))
-        # transpose cols and append to table
-        table.extend(list(itertools.zip_longest(*cols, fillvalue="")))
-        with file_io.FileWriter("interpoint.distances", opt) as f:
-            f.writerows(table)
-
-    def write_mc_dist_to_path():
-        if not opt.run_monte_carlo:
+        self.tables['interpoint.distances'] = OutputTable("interpoint.distances", opt)
+        self.tables['interpoint.distances'].writerows(table)
+        self.ip_prefixli = prefixli
+        # len+1 to account for input file column
+        self.ip_cols = [collections.deque() for _ in range(len(prefixli) + 1)]
+
+    def __write_interpoint_summaries(self, pro):
+        # Each column holds the distances of all profiles one after another,
+        # so a row is written once all columns have reached it; the rest of
+        # the columns are padded and written at the end of the session
+        if 'interpoint.distances' not in self.tables:
+            return
+        if self.opt.output_layout == 'long':
+            self.tables['interpoint.distances'].writerows(
+                [rel, dist_type, d, pro.id, os.path.basename(pro.inputfn), pro.comment]
+                for rel, dist_type, prefix in self.ip_columns
+                for d in metric_all(getattr(pro, prefix + "distli"), pro.pixelwidth))
+            return
+        cols = self.ip_cols
+        maxlength = 0   # find length of largest distli in profile
+        for n, li in enumerate([getattr(pro, prefix + "distli") for prefix in self.ip_prefixli]):
+            maxlength = max(maxlength, len(li))
+            cols[n].extend(metric_all(li, pro.pixelwidth))
+        # input file should be added to all rows
+        cols[-1].extend(itertools.repeat(os.path.basename(pro.inputfn), maxlength))
+        nrows = min(len(col) for col in cols)
+        self.tables['interpoint.distances'].writerows(
+            [tuple(col.popleft() for col in cols) for _ in range(nrows)])
+
+    def __finish_interpoint_summaries(self):
+        if 'interpoint.distances' in self.tables:
+            self.tables['interpoint.distances'].writerows(
+                itertools.zip_longest(*self.ip_cols, fillvalue=""))
+            self.ip_cols = []
+
+    def __write_expected_border_dists(self, pro):
+        if 'expected.border.distances' not in self.tables:
             return
-        table = [["Run %d" % (n + 1) for n in range(0, opt.monte_carlo_runs)]]
-        for pro in eval_proli:
-            table.extend(itertools.zip_longest(*[[m(p.dist_to_path, pro.pixelwidth)
-                                                  for p in li['pli']] for li in pro.mcli]))
-        with file_io.FileWriter("simulated.border.distances", opt) as f:
-            f.writerows(table)
-
-    def write_mc_ip_dists(dist_type):
+        self.tables['expected.border.distances'].writerows([
+            [metric(pro.expected_border_dist_mean, pro.pixelwidth)] +
+            [metric(d, pro.pixelwidth) for d in pro.expected_border_dist_quantiles] +
+            [pro.id,
+             os.path.basename(pro.inputfn),
+             pro.comment]])
+        self.tables['expected.border.distance.cdf'].writerows([
+            [metric(d, pro.pixelwidth),
+             cp,
+             pro.id,
+             os.path.basename(pro.inputfn),
+             pro.comment] for d, cp in pro.expected_border_dist_cdf])
+
+    def __write_mc_dist_to_path(self, pro):
+        if 'simulated.border.distances' not in self.tables:
+            return
+        self.tables['simulated.border.distances'].writerows(
+            self.__run_rows(pro, pro.mcruns.border_distances))
+
+    def __run_rows(self, pro, run_distances):
+        """ Return an iterable of the rows of a table of the distances
+            run_distances(n) of each Monte Carlo run n of the profile pro
+        """
+        runs = range(len(pro.mcruns))
+        if self.opt.output_layout == 'long':
+            inputfn = os.path.basename(pro.inputfn)
+            return ([n + 1, d, pro.id, inputfn, pro.comment]
+                    for n in runs
+                    for d in metric_all(run_distances(n), pro.pixelwidth))
+        return itertools.zip_longest(*[metric_all(run_distances(n), pro.pixelwidth)
+                                       for n in runs])
+
+    def __mc_ip_outputs(self):
+        """ Return a list of (relation, distance type) of the simulated
+            interpoint distance outputs
+        """
+        opt = self.opt
         if not (opt.run_monte_carlo and opt.determine_interpoint_dists):
+            return []
+        return [(ip_type, dist_type)
+                for dist_type, selected in (('shortest', opt.interpoint_shortest_dist),
+                                            ('lateral', opt.interpoint_lateral_dist))
+                if selected
+                for ip_type in [key for key, val in opt.interpoint_relations.items()
+                                if 'simulated' in key and val]]
+
+    def __write_mc_ip_dists(self, pro):
+        for ip_type, dist_type in self.__mc_ip_outputs():
+            short_dist_type = "latdist" if dist_type == 'lateral' else "dist"
+            if not pro.mcruns.has_interpoint_distances(ip_type, short_dist_type):
+                continue
+            self.tables["%s.interpoint.%s.distances"
+                        % (ip_type.replace(" ", ""), dist_type)].writerows(
+                self.__run_rows(pro, functools.partial(pro.mcruns.interpoint_distances,
+                                                       ip_type, short_dist_type)))
+
+    def __write_mc_cluster_summary(self, pro):
+        if 'simulated.cluster.summary' not in self.tables:
             return
-        for ip_type in [key for key, val in opt.interpoint_relations.items()
-                        if 'simulated' in key and val]:
-            if ((dist_type == 'shortest' and not opt.interpoint_shortest_dist) or
-                    (dist_type == 'lateral' and not opt.interpoint_lateral_dist)):
-                return
-            if dist_type == 'lateral':
-                short_dist_type = 'lat'
-            else:
-                short_dist_type = ''
-            table = [["Run %d" % (n + 1) for n in range(0, opt.monte_carlo_runs)]]
-            for pro in eval_proli:
-                table.extend(itertools.zip_longest(*[m(p, pro.pixelwidth)
-                                                     for li in pro.mcli
-                                                     for p in li[ip_type]["%sdist"
-                                                                          % short_dist_type]]))
-            with file_io.FileWriter("%s.interpoint.%s.distances"
-                                    % (ip_type.replace(" ", ""), dist_type), opt) as f:
-                f.writerows(table)
-
-    def write_mc_cluster_summary():
-        if not (opt.determine_clusters and opt.run_monte_carlo):
+        self.tables['simulated.cluster.summary'].writerows([
+            [size, n + 1,
+             metric(dist_to_path, pro.pixelwidth),
+             metric(na(dist_to_nearest_cluster), pro.pixelwidth),
+             pro.id,
+             os.path.basename(pro.inputfn),
+             pro.comment]
+            for n in range(len(pro.mcruns))
+            for size, dist_to_path, dist_to_nearest_cluster in pro.mcruns.clusters(n)])
+
+    def __close_tables(self, numeric=None):
+        """ Finish the output tables, and write the NumericTables numeric if
+            given. As the files are independent of each other, they are
+            finished concurrently in a pool of threads (Excel files spend most
+            of that time compressing, which does not hold the interpreter
+            lock); the outcomes are then logged in order.
+        """
+        self.__finish_interpoint_summaries()
+        tables = list(self.tables.values())
+        self.tables = {}
+        tasks = [table.finish for table in tables]
+        if numeric is not None:
+            tasks.append(functools.partial(npzexport.write, numeric))
+        if not tasks:
             return
-        table = [["N particles in cluster", "Run",
-                  "Distance to profile border from centroid",
-                  "Distance to nearest cluster",
-                  "Profile ID",
-                  "Input file",
-                  "Comment"]]
-        for pro in eval_proli:
-            for n in range(0, opt.monte_carlo_runs):
-                for c in pro.mcli[n]["clusterli"]:
-                    table.append([len(c), n + 1,
-                                 m(c.dist_to_path, pro.pixelwidth),
-                                 m(na(c.dist_to_nearest_cluster),
-                                   pro.pixelwidth),
-                                 pro.id,
-                                 os.path.basename(pro.inputfn),
-                                 pro.comment])
-        with file_io.FileWriter("simulated.cluster.summary", opt) as f:
-            f.writerows(table)
-
-    sys.stdout.write("\nSaving summaries to %s:\n" % opt.output_dir)
-    opt.save_result = {'any_saved': False, 'any_err': False}
-    eval_proli = [profile for profile in profileli if not profile.errflag]
-    clean_fli = [profile.inputfn for profile in profileli
-                 if not (profile.errflag or profile.warnflag)]
-    warn_fli = [profile.inputfn for profile in profileli if profile.warnflag]
-    err_fli = [profile.inputfn for profile in profileli if profile.errflag]
-    nop_fli = [profile.inputfn for profile in profileli if not profile.pli]
-    write_session_summary()
-    write_profile_summary()
-    write_point_summary('particle')
-    write_point_summary('random')
-    write_interpoint_summaries()
-    write_cluster_summary()
-    write_mc_dist_to_path()
-    write_mc_ip_dists('shortest')
-    write_mc_ip_dists('lateral')
-    write_mc_cluster_summary()
-    if opt.save_result['any_err']:
-        sys.stdout.write("Note: One or more summaries could not be saved.\n")
-    if opt.save_result['any_saved']:
-        sys.stdout.write("Done.\n")
-    else:
-        sys.stdout.write("No summaries saved.\n")
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(tasks), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(task) for task in tasks]
+        results = [future.result() for future in futures]
+        for table in tables:
+            table.report()
+        if numeric is not None:
+            npzexport.report(self.opt, *results[-1])
+
+    def save(self):
+        """ Finish the output tables and save the session summary """
+        opt = self.opt
+        sys.stdout.write("\nSaving summaries to %s:\n" % opt.output_dir)
+        self.__close_tables(self.numeric)
+        self.numeric = None
+        # Last, so that it can record how large outputs were split
+        self.__write_session_summary()
+        if opt.save_result['any_err']:
+            sys.stdout.write("Note: One or more summaries could not be saved.\n")
+        if opt.save_result['any_saved']:
+            sys.stdout.write("Done.\n")
+        else:
+            sys.stdout.write("No summaries saved.\n")
+
+    def close(self):
+        """ Finish the output tables written so far, without saving the
+            session summary, e.g. if the session is aborted
+        """
+        if not self.tables:
+            return
+        sys.stdout.write("\nSaving summaries of the profiles processed so far to %s:\n"
+                         % self.opt.output_dir)
+        self.__close_tables()
+        self.numeric = None
+
+    def __write_session_summary(self):
+        opt = self.opt
+        if not opt.outputs['session summary']:
+            return
+        with file_io.FileWriter("session.summary", opt) as f:
+            f.writerow(["%s version:" % version.title,
+                        "%s (Last modified %s %s, %s)" % ((version.version,) + version.date)])
+            f.writerow(["Number of evaluated profiles:", self.n_evaluated])
+            if self.err_fli:
+                f.writerow(["Number of non-evaluated profiles:", len(self.err_fli)])
+            f.writerow(["Metric unit:", self.metric_unit])
+            f.writerow(["Spatial resolution:", opt.spatial_resolution, self.metric_unit])
+            if opt.distance_storage != 'double':
+                f.writerow(["Distance storage:", opt.distance_storage])
+                step = runstore.quantization_step(opt)
+                if step is not None:
+                    f.writerow(["Quantization step of stored distances:", step,
+                                self.metric_unit])
+                elif opt.distance_storage == 'single':
+                    f.writerow(["Quantization step of stored distances:",
+                                "%g (relative)" % runstore.single_precision_step])
+            f.writerow(["Shell width:", opt.shell_width, self.metric_unit])
+            f.writerow(["Interpoint distances calculated:",
+                        stringconv.yes_or_no(opt.determine_interpoint_dists)])
+            if opt.determine_interpoint_dists:
+                f.writerow(["Interpoint distance mode:", opt.interpoint_dist_mode])
+                f.writerow(["Shortest interpoint distances:",
+                            stringconv.yes_or_no(opt.interpoint_shortest_dist)])
+                f.writerow(["Lateral interpoint distances:",
+                            stringconv.yes_or_no(opt.interpoint_lateral_dist)])
+            f.writerow(["Monte Carlo simulations performed:",
+                        stringconv.yes_or_no(opt.run_monte_carlo)])
+            if opt.run_monte_carlo:
+                f.writerow(["Number of Monte Carlo runs:", opt.monte_carlo_runs])
+                f.writerow(["Monte Carlo simulation window:", opt.monte_carlo_simulation_window])
+                f.writerow(["Strict localization in simulation window:",
+                            stringconv.yes_or_no(opt.monte_carlo_strict_location)])
+                f.writerow(["Monte Carlo sampling mode:", opt.monte_carlo_sampling])
+                if opt.monte_carlo_seed is not None:
+                    f.writerow(["Monte Carlo random seed:", opt.monte_carlo_seed])
+            f.writerow(["Expected distances to profile border determined:",
+                        stringconv.yes_or_no(opt.determine_expected_border_dists)])
+            f.writerow(["Clusters determined:", stringconv.yes_or_no(opt.determine_clusters)])
+            if opt.determine_clusters:
+                f.writerow(["Within-cluster distance:",
+                            opt.within_cluster_dist,
+                            self.metric_unit])
+            if self.clean_fli:
+                f.writerow(["Input files processed cleanly:"])
+                f.writerows([[fn] for fn in self.clean_fli])
+            if self.nop_fli:
+                f.writerow(["Input files processed but which generated no particle distances:"])
+                f.writerows([[fn] for fn in self.nop_fli])
+            if self.warn_fli:
+                f.writerow(["Input files processed but which generated "
+                            "warnings (see log for details):"])
+                f.writerows([[fn] for fn in self.warn_fli])
+            if self.err_fli:
+                f.writerow(["Input files not processed or not included in "
+                            "summary (see log for details):"])
+                f.writerows([[fn] for fn in self.err_fli])
+            if opt.save_result['split_outputs']:
+                f.writerow(["Output tables split into parts (at most %d rows and %d columns "
+                            "each):" % (file_io.max_rows, file_io.max_cols)])
+                f.writerows([[fn, part, "Rows %d-%d" % (row1, row2),
+                              "Columns %d-%d" % (col1, col2)]
+                             for fn, layout in opt.save_result['split_outputs']
+                             for part, row1, row2, col1, col2 in layout])
 
 
 def reset_options(opt):
     """ Deletes certain options that should always be set anew for each run
         (each time the "Start" button is pressed)
     """
-    for optstr in ('metric_unit', 'use_random'):
+    for optstr in ('metric_unit', 'use_random', 'plan'):
         if hasattr(opt, optstr):
             delattr(opt, optstr)
 
 
+def check_distance_storage(opt):
+    """ Fall back to double precision storage of distances if fixed-point
+        storage cannot be used
+    """
+    if runstore.fixed_point_unavailable(opt):
+        sys.stdout.write("Warning: Fixed-point storage of distances requires a spatial "
+                         "resolution greater than 0: storing distances in double "
+                         "precision.\n")
+        opt.distance_storage = 'double'
+
+
 def show_options(opt):
     sys.stdout.write("{} version: {} (Last modified {} {}, {})\n".format(
                      version.title, version.version, *version.date))
@@ -329,9 +598,49 @@ def show_options(opt):
         if opt.monte_carlo_simulation_window == "profile":
             sys.stdout.write("Strict localization in simulation window: %s\n"
                              % stringconv.yes_or_no(opt.monte_carlo_strict_location))
+        sys.stdout.write("Monte Carlo sampling mode: %s\n" % opt.monte_carlo_sampling)
+        if opt.monte_carlo_sampling != 'uniform':
+            sys.stdout.write("Warning: Simulated points are spread more evenly than under "
+                             "complete spatial randomness in %s sampling mode, so Monte Carlo "
+                             "envelopes of interpoint distances and clusters are too narrow. "
+                             "Use uniform sampling for these.\n" % opt.monte_carlo_sampling)
+        if opt.monte_carlo_seed is not None:
+            sys.stdout.write("Monte Carlo random seed: %d\n" % opt.monte_carlo_seed)
+        if opt.monte_carlo_checkpoint_dir:
+            sys.stdout.write("Monte Carlo checkpoint directory: %s\n"
+                             % opt.monte_carlo_checkpoint_dir)
+    sys.stdout.write("Expected distances to profile border determined: %s\n"
+                     % stringconv.yes_or_no(opt.determine_expected_border_dists))
     sys.stdout.write("Clusters determined: %s\n" % stringconv.yes_or_no(opt.determine_clusters))
     if opt.determine_clusters:
         sys.stdout.write("Within-cluster distance: %d\n" % opt.within_cluster_dist)
+    if opt.scratch_dir:
+        sys.stdout.write("Scratch directory for result arrays: %s\n" % opt.scratch_dir)
+    if opt.use_profile_cache:
+        sys.stdout.write("Profile cache used: yes\n")
+    if opt.processes != 1:
+        sys.stdout.write("Worker processes: %d\n" % parallel.process_count(opt))
+    elif opt.prefetch_depth > 0:
+        sys.stdout.write("Input files read ahead: %d\n" % opt.prefetch_depth)
+    if opt.block_processes != 1:
+        sys.stdout.write("Worker processes for large profiles: %d\n"
+                         % blocks.process_count(opt.block_processes))
+    if opt.output_database:
+        sys.stdout.write("Results database: %s\n" % opt.output_database)
+    if opt.export_npz:
+        sys.stdout.write("Numeric results exported to .npz: yes\n")
+    if opt.distance_storage == 'single':
+        sys.stdout.write("Distances stored in single precision\n")
+    elif runstore.quantization_step(opt) is not None:
+        sys.stdout.write("Distances stored as fixed-point numbers: quantization step %g metric "
+                         "units\n" % runstore.quantization_step(opt))
+    if opt.output_layout != 'wide':
+        sys.stdout.write("Distance table layout: %s\n" % opt.output_layout)
+    if opt.compress_simulated_outputs and opt.output_file_format == 'csv':
+        sys.stdout.write("Simulated distance outputs compressed: yes\n")
+    sys.stdout.write("Computation plan:\n")
+    for line in planner.get_plan(opt).describe():
+        sys.stdout.write("  %s\n" % line)
 
 
 def get_output_format(opt):
@@ -352,7 +661,32 @@ def get_output_format(opt):
     if opt.output_filename_other_suffix != '':
         opt.output_filename_suffix += "." + opt.output_filename_other_suffix
 
-      
+
+def create_scratch_dir(opt):
+    """ Create a session scratch directory for file-backed result arrays,
+        if opt.scratch_dir is set
+    """
+    opt.scratch_session_dir = None
+    if not opt.scratch_dir:
+        return
+    try:
+        opt.scratch_session_dir = tempfile.mkdtemp(prefix="%s." % version.title.lower(),
+                                                   dir=opt.scratch_dir)
+    except OSError:
+        sys.stdout.write("Warning: Unable to create scratch directory in '%s': keeping all "
+                         "results in memory.\n" % opt.scratch_dir)
+
+
+def remove_scratch_dir(opt):
+    if getattr(opt, 'scratch_session_dir', None):
+        try:
+            shutil.rmtree(opt.scratch_session_dir)
+        except OSError:
+            sys.stdout.write("Warning: Unable to remove scratch directory '%s'.\n"
+                             % opt.scratch_session_dir)
+        opt.scratch_session_dir = None
+
+
 def main_proc(parent):
     """ Process profile data files
     """
@@ -361,42 +695,83 @@ def main_proc(parent):
     if not opt.input_file_list:
         sys.stdout.write("No input files.\n")
         return 0
-    i, n = 0, 0
-    profileli = []
     sys.stdout.write("--- Session started %s local time ---\n" % time.ctime())
-    for f in opt.input_file_list:
-        if opt.input_file_list.count(f) > 1:
-            sys.stdout.write("Duplicate input filename %s:\n   => removing first occurrence in "
-                             "list\n" % f)
-            opt.input_file_list.remove(f)
-    get_output_format(opt)
-    reset_options(opt)
-    show_options(opt)
-    while True:
-        if i < len(opt.input_file_list):
-            inputfn = opt.input_file_list[i]
-            i += 1
-        else: 
-            sys.stdout.write("\nNo more input files...\n")
-            break
-        parent.process_queue.put(("new_file", inputfn))
-        profileli.append(ProfileData(inputfn, opt))
-        profileli[-1].process(opt)
+    opt.input_file_list = ingest.expand_inputs(opt.input_file_list, opt.input_filename_ext)
+    # The scratch directory and archives are cleaned up even if the session
+    # fails unexpectedly
+    try:
+        if not opt.input_file_list:
+            sys.stdout.write("No input files.\n")
+            return 0
+        get_output_format(opt)
+        reset_options(opt)
+        check_distance_storage(opt)
+        show_options(opt)
+        create_scratch_dir(opt)
+        exitcode = process_files(parent)
+    finally:
+        remove_scratch_dir(opt)
+        ingest.close_archives()
+    if exitcode != 3:
+        opt.reset()
+    return exitcode
+
+
+def process_files(parent):
+    """ Process the input files of a session, after the options have been
+        set up, and return the exit code of the session
+    """
+    opt = parent.opt
+    n = 0
+    store = sqlitestore.open_store(opt)
+    output = SessionOutput(opt)
+    # Container files may hold several profiles, which are processed as if
+    # they were in separate files
+    if opt.processes != 1:
+        profiles = parallel.iter_profiles(opt)
+    else:
+        profiles = prefetch.iter_profiles(opt)
+    for pro, log in profiles:
+        if pro is not None:
+            parent.process_queue.put(("new_file", pro.inputfn))
+        sys.stdout.write(log)
+        if pro is None:
+            continue
+        if not pro.is_processed:
+            pro.process(opt)
         if opt.stop_requested:
-            sys.stdout.write("\n--- Session aborted by user %s local time ---\n" % time.ctime())
-            return 3
-        if not profileli[-1].errflag:
+            break
+        if store is not None:
+            try:
+                store.add_profile(pro)
+            except sqlite3.Error as err:
+                sys.stdout.write("Warning: Unable to write to results database '%s' (%s): "
+                                 "results will no longer be saved to it.\n" % (store.fn, err))
+                store.close()
+                store = None
+        output.add_profile(pro)
+        pro.release()
+        if not pro.errflag:
             n += 1
-            if profileli[-1].warnflag:
+            if pro.warnflag:
                 sys.stdout.write("Warning(s) found while processing input file.\n")
                 continue
         else:
             sys.stdout.write("Error(s) found while processing input file =>\n"
                              "  => No distances could be determined.\n")
             continue
+    # The profile iterators may also end early when a stop is requested
+    if opt.stop_requested:
+        profiles.close()
+        output.close()
+        sys.stdout.write("\n--- Session aborted by user %s local time ---\n" % time.ctime())
+        if store is not None:
+            store.close()
+        return 3
+    sys.stdout.write("\nNo more input files...\n")
     # no more input files
-    errfli = [pro.inputfn for pro in profileli if pro.errflag]
-    warnfli = [pro.inputfn for pro in profileli if pro.warnflag]
+    errfli = output.err_fli
+    warnfli = output.warn_fli
     if errfli:
         sys.stdout.write("\n%s input %s generated one or more errors:\n"
                          % (stringconv.plurality("This", len(errfli)),
@@ -409,12 +784,13 @@ def main_proc(parent):
         sys.stdout.write("%s\n" % "\n".join([fn for fn in warnfli]))
     if n > 0:
         parent.process_queue.put(("saving_summaries", ""))
-        save_output(profileli, opt)
+        output.save()
     else:
         sys.stdout.write("\nNo files processed.\n")
     sys.stdout.write("--- Session ended %s local time ---\n" % time.ctime())
     parent.process_queue.put(("done", ""))
-    opt.reset()
+    if store is not None:
+        store.close()
     if errfli: 
         return 0
     elif warnfli: 
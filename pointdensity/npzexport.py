@@ -0,0 +1,287 @@
+import array
+import json
+import math
+import os.path
+import sys
+import zipfile
+from . import file_io
+from . import geometry
+from . import runstore
+from . import version
+
+
+#
+# Columnar export of numeric results to a NumPy .npz archive.
+#
+# Each numeric table is saved as one typed array per column, so that it can
+# be loaded with numpy.load() without parsing. Rows belong to the profile
+# given by the 'profile' column of the table, which indexes the profile
+# arrays. A JSON sidecar file describes the profiles, the session options
+# and the arrays. Lengths are in metric units; values shown as 'N/A' in the
+# summaries are NaN. Interpoint and simulated distances are saved in the
+# format they are stored in during the session (option distance_storage):
+# as single precision floats, or as integer multiples of the quantization
+# step given in the JSON file.
+#
+# NumPy is not needed for writing: an .npz file is a zip archive of .npy
+# files, each of which is a short header followed by the raw array data.
+#
+
+npz_ext = '.npz'
+metadata_ext = '.json'
+
+_npy_descr = {'d': 'f8', 'f': 'f4', 'q': 'i8', 'i': 'i4', 'b': 'b1'}
+
+
+def _npy_header(typecode, length):
+    """Return the .npy format 1.0 header of a one-dimensional array"""
+    byteorder = '<' if sys.byteorder == 'little' else '>'
+    descr = ('|' if typecode == 'b' else byteorder) + _npy_descr[typecode]
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, length)
+    # Pad so that the data starts at a multiple of 64 bytes
+    prefix_len = 10
+    header += ' ' * (63 - (prefix_len + len(header)) % 64) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+class _Table:
+    """Columns of a numeric table"""
+    def __init__(self, name, columns, description):
+        self.name = name
+        self.description = description
+        self.columns = dict((col, array.array(typecode)) for col, typecode in columns)
+
+    def append(self, *values):
+        for a, value in zip(self.columns.values(), values):
+            a.append(value)
+
+    def extend(self, profile, values, *constants):
+        """Append a row for each value in values, in the given profile, with
+        the other columns set to constants.
+        """
+        start = len(self.columns['profile'])
+        cols = list(self.columns.values())
+        cols[-1].extend(values)
+        n = len(cols[-1]) - start
+        cols[0].extend([profile] * n)
+        for a, value in zip(cols[1:-1], constants):
+            a.extend([value] * n)
+
+
+def _nan(x):
+    return math.nan if x is None else x
+
+
+def _m(x, pixelwidth):
+    return geometry.to_metric_units(_nan(x), pixelwidth)
+
+
+def _na(x, pixelwidth):
+    return math.nan if x == -1 else _m(x, pixelwidth)
+
+
+def _m_all(li, pixelwidth):
+    return [_m(x, pixelwidth) for x in li]
+
+
+def _relation_key(rel):
+    """Return e.g. 'pp' for 'particle - particle'"""
+    return rel[0] + rel[rel.index("- ") + 2]
+
+
+class NumericTables:
+    """Numeric tables of the evaluated profiles of a session, to which each
+    profile is added as soon as it has been processed.
+    """
+    def __init__(self, opt):
+        self.opt = opt
+        self.metric_unit = ''
+        self.dist_step = runstore.quantization_step(opt)
+        self.dist_code = runstore.distance_format(opt, 1)[0]
+        self.profile_info = []
+        self.profiles = _Table('profiles', [('profile_id', 'q'), ('perimeter', 'd'),
+                                            ('area', 'd'), ('feret', 'd')],
+                               "One row per profile; profile_id is -1 if not given")
+        self.points = dict((ptype, _Table(ptype + 's', [('profile', 'q'), ('dist_to_path', 'd'),
+                                                        ('within_profile', 'b'),
+                                                        ('border_associated', 'b')],
+                                          "Distance to profile border (negative outside the "
+                                          "profile) and location of each %s" % ptype))
+                           for ptype in ('particle', 'random'))
+        self.clusters = _Table('clusters', [('profile', 'q'), ('n_points', 'q'),
+                                            ('dist_to_path', 'd'),
+                                            ('dist_to_nearest_cluster', 'd')],
+                               "Size, distance to profile border of the centroid and distance "
+                               "to nearest cluster along the border of each cluster")
+        self.mc_border = _Table('simulated_border_distances', [('profile', 'q'), ('run', 'q'),
+                                                               ('distance', self.dist_code)],
+                                "Distance to profile border of each simulated point")
+        self.mc_clusters = _Table('simulated_clusters', [('profile', 'q'), ('run', 'q'),
+                                                         ('n_points', 'q'), ('dist_to_path', 'd'),
+                                                         ('dist_to_nearest_cluster', 'd')],
+                                  "Clusters of simulated points")
+        self.interpoint = {}
+        self.mc_interpoint = {}
+
+    def __interpoint_table(self, rel, dist_type, simulated):
+        tables = self.mc_interpoint if simulated else self.interpoint
+        if (rel, dist_type) not in tables:
+            cols = ([('profile', 'q')] + ([('run', 'q')] if simulated else []) +
+                    [('distance', self.dist_code)])
+            tables[rel, dist_type] = _Table(
+                "%sinterpoint_%s_%s" % ('simulated_' if simulated else '', _relation_key(rel),
+                                        dist_type),
+                cols, "%s %s interpoint distances (%s)"
+                      % (dist_type.capitalize(), rel, self.opt.interpoint_dist_mode))
+        return tables[rel, dist_type]
+
+    def add_profile(self, pro):
+        """Append the results of the evaluated profile pro"""
+        opt = self.opt
+        k = len(self.profile_info)
+        pw = pro.pixelwidth
+        if not self.profile_info:
+            self.metric_unit = pro.metric_unit
+        self.profile_info.append({'input_file': os.path.basename(pro.inputfn),
+                                  'profile_id': pro.id if isinstance(pro.id, int) else None,
+                                  'src_img': pro.src_img,
+                                  'comment': pro.comment})
+        self.profiles.append(pro.id if isinstance(pro.id, int) else -1, _m(pro.perimeter, pw),
+                             geometry.to_metric_units(pro.area, pw ** 2), _m(pro.feret, pw))
+        for ptype, pli in (('particle', pro.pli), ('random', pro.randomli)):
+            for p in pli:
+                self.points[ptype].append(k, _m(p.dist_to_path, pw), int(p.is_within_profile),
+                                          int(p.is_associated_with_path))
+        for c in pro.clusterli:
+            self.clusters.append(k, len(c), _m(c.dist_to_path, pw),
+                                 _na(c.dist_to_nearest_cluster, pw))
+        for rel, val in opt.interpoint_relations.items():
+            if not val or 'simulated' in rel:
+                continue
+            for dist_type, attr in (('shortest', 'distli'), ('lateral', 'latdistli')):
+                distli = getattr(pro, _relation_key(rel) + '_' + attr, None)
+                if distli:
+                    self.__interpoint_table(rel, dist_type, False).extend(
+                        k, self.__stored(_m_all(distli, pw)))
+        mcruns = pro.mcruns
+        for n in range(len(mcruns)):
+            self.mc_border.extend(k, self.__stored(_m_all(mcruns.border_distances(n), pw)), n + 1)
+            for rel in opt.interpoint_relations:
+                for dist_type, short_type in (('shortest', 'dist'), ('lateral', 'latdist')):
+                    if mcruns.has_interpoint_distances(rel, short_type):
+                        self.__interpoint_table(rel, dist_type, True).extend(
+                            k, self.__stored(_m_all(mcruns.interpoint_distances(rel, short_type,
+                                                                                n), pw)),
+                            n + 1)
+            for size, d, d_nearest in mcruns.clusters(n):
+                self.mc_clusters.append(k, n + 1, size, _m(d, pw), _na(d_nearest, pw))
+
+    def __stored(self, values):
+        """Return the distances in values as stored, i.e. as multiples of
+        the quantization step if fixed-point
+        """
+        if self.dist_step is None:
+            return values
+        return [round(x / self.dist_step) for x in values]
+
+    def tables(self):
+        """Return a list of the tables to be saved"""
+        opt = self.opt
+        tables = [self.profiles, self.points['particle']]
+        if opt.use_random:
+            tables.append(self.points['random'])
+        if opt.determine_clusters:
+            tables.append(self.clusters)
+        tables.extend(self.interpoint[key] for key in sorted(self.interpoint))
+        if opt.run_monte_carlo:
+            tables.append(self.mc_border)
+            if opt.determine_clusters:
+                tables.append(self.mc_clusters)
+        tables.extend(self.mc_interpoint[key] for key in sorted(self.mc_interpoint))
+        return tables
+
+
+def collect_tables(eval_proli, opt):
+    """Return a NumericTables object of the evaluated profiles in
+    eval_proli.
+    """
+    numeric = NumericTables(opt)
+    for pro in eval_proli:
+        numeric.add_profile(pro)
+    return numeric
+
+
+def write_npz(fn, tables):
+    """Write the columns of tables to the .npz archive fn, as arrays named
+    'table.column'.
+    """
+    with zipfile.ZipFile(fn, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for table in tables:
+            for col, a in table.columns.items():
+                with zf.open("%s.%s.npy" % (table.name, col), 'w', force_zip64=True) as f:
+                    f.write(_npy_header(a.typecode, len(a)))
+                    f.write(a.tobytes())
+
+
+def metadata(numeric, tables):
+    """Return a dict describing the session, the profiles and the arrays"""
+    opt = numeric.opt
+    return {
+        'program': version.title,
+        'version': version.version,
+        'metric_unit': numeric.metric_unit,
+        'options': {
+            'spatial_resolution': opt.spatial_resolution,
+            'shell_width': opt.shell_width,
+            'interpoint_dist_mode': opt.interpoint_dist_mode,
+            'monte_carlo_runs': opt.monte_carlo_runs if opt.run_monte_carlo else 0,
+            'monte_carlo_simulation_window': opt.monte_carlo_simulation_window,
+            'monte_carlo_seed': opt.monte_carlo_seed,
+            'within_cluster_dist': (opt.within_cluster_dist if opt.determine_clusters
+                                    else None),
+            'distance_storage': opt.distance_storage,
+        },
+        'distance_quantization_step': numeric.dist_step,
+        'profiles': numeric.profile_info,
+        'tables': [{'name': table.name,
+                    'description': table.description,
+                    'rows': len(next(iter(table.columns.values()))),
+                    'arrays': ["%s.%s" % (table.name, col) for col in table.columns]}
+                   for table in tables],
+    }
+
+
+def write(numeric):
+    """Write the NumericTables numeric to an .npz archive in the output
+    directory, with a JSON metadata sidecar file. Return the filename of the
+    archive and whether it was saved; nothing is logged.
+    """
+    opt = numeric.opt
+    fn = os.path.join(opt.output_dir, "numeric.results" + opt.output_filename_suffix + npz_ext)
+    if os.path.exists(fn) and opt.action_if_output_file_exists == 'enumerate':
+        fn = file_io.enum_filename(fn, 2)
+    tables = numeric.tables()
+    try:
+        write_npz(fn, tables)
+        with open(os.path.splitext(fn)[0] + metadata_ext, 'w') as f:
+            json.dump(metadata(numeric, tables), f, indent=1)
+    except (IOError, OSError):
+        return fn, False
+    return fn, True
+
+
+def report(opt, fn, saved):
+    """Log and record the outcome of write()"""
+    if saved:
+        sys.stdout.write("Saved '%s'.\n" % fn)
+        opt.save_result['any_saved'] = True
+    else:
+        sys.stdout.write("Error: Unable to save to file '%s'\n" % fn)
+        opt.save_result['any_err'] = True
+
+
+def save(numeric):
+    """Save the NumericTables numeric to an .npz archive in the output
+    directory, with a JSON metadata sidecar file.
+    """
+    report(numeric.opt, *write(numeric))
@@ -0,0 +1,206 @@
+import configparser
+import json
+import os.path
+from . import core
+from . import runstore
+from . import sampling
+from . import stringconv
+
+
+#
+# Session options in configuration files.
+#
+# Options are saved in the 'Options' section of an INI file, one key per
+# option; options that are dicts (e.g. outputs) have one key per item,
+# such as 'outputs.particle_summary'. The same keys can be given in a JSON
+# file, where dict options may also be nested objects. Used by both the
+# GUI and the command-line runner, so nothing here depends on wx.
+#
+
+config_section = 'Options'
+
+saved_options = ('output_file_format', 'csv_delimiter', 'action_if_output_file_exists',
+                 'output_filename_date_suffix', 'spatial_resolution', 'shell_width',
+                 'determine_clusters', 'within_cluster_dist', 'run_monte_carlo',
+                 'monte_carlo_runs', 'determine_interpoint_dists',
+                 'monte_carlo_simulation_window', 'monte_carlo_strict_location',
+                 'monte_carlo_sampling', 'determine_expected_border_dists',
+                 'monte_carlo_seed', 'monte_carlo_checkpoint_dir', 'scratch_dir',
+                 'use_profile_cache', 'prefetch_depth', 'processes', 'block_processes',
+                 'compress_simulated_outputs', 'output_database', 'export_npz',
+                 'distance_storage', 'output_layout', 'interpoint_dist_mode',
+                 'interpoint_shortest_dist', 'interpoint_lateral_dist')
+
+saved_dict_options = ('interpoint_relations', 'outputs')
+
+
+def option_key(option, key):
+    """Return the configuration key of item key of the dict option"""
+    return '.'.join([option, key.replace(' ', '_')])
+
+
+def write_config(opt, fn):
+    """Save the options in opt to the configuration file fn, keeping any
+    other sections of the file. Raise IOError if unable to.
+    """
+    config = configparser.ConfigParser()
+    try:
+        config.read(fn)
+    except (configparser.ParsingError, configparser.MissingSectionHeaderError):
+        pass  # Silently suppress parsing errors at this stage
+    if config_section not in config.sections():
+        config[config_section] = {}
+    for option in saved_options:
+        config[config_section][option] = str(getattr(opt, option))
+    for option in saved_dict_options:
+        for key, val in list(getattr(opt, option).items()):
+            config[config_section][option_key(option, key)] = str(val)
+    with open(fn, 'w') as f:
+        config.write(f)
+
+
+def read_config(fn):
+    """Return a list of (key, value) pairs of the options in the
+    configuration file fn; the list is empty if the file does not exist or
+    has no valid options section.
+    """
+    config = configparser.ConfigParser()
+    if not os.path.exists(fn):
+        return []
+    try:
+        config.read(fn)
+    except (configparser.ParsingError, configparser.MissingSectionHeaderError):
+        return []     # Silently suppress parsing errors at this stage
+    if config_section not in config.sections():
+        return []     # No options present in config file; silently use defaults
+    return [(option, config.get(config_section, option))
+            for option in config.options(config_section)]
+
+
+def read_json(fn):
+    """Return a list of (key, value) pairs of the options in the JSON file
+    fn, with values converted to strings as if read from a configuration
+    file. Raise ValueError if the file does not hold a JSON object.
+    """
+    with open(fn) as f:
+        data = json.load(f)
+    if isinstance(data, dict) and isinstance(data.get(config_section), dict):
+        data = data[config_section]
+    if not isinstance(data, dict):
+        raise ValueError("'%s' does not contain a JSON object" % fn)
+    items = []
+    for option, val in data.items():
+        if isinstance(val, dict):
+            items.extend((option_key(option, key), str(v)) for key, v in val.items())
+        else:
+            items.append((option, str(val)))
+    return items
+
+
+def is_valid_key(key):
+    """Return True if key is the configuration key of a saved option"""
+    defaults = core.OptionData()
+    if '.' in key:
+        option, item = key.split('.', 1)
+        return (option in saved_dict_options and
+                item.replace('_', ' ') in getattr(defaults, option))
+    return key in saved_options
+
+
+def apply_options(opt, items, source, warn):
+    """Set the options in opt from the (key, value) pairs in items, read
+    from source (e.g. "configuration file 'fn'"), and check them. Invalid
+    values are reported by calling warn with a message and replaced by
+    their defaults.
+    """
+
+    def show_invalid_option_warning(invalid_opt):
+        warn("Invalid value '%s' for option '%s' in %s.\n"
+             "Using default value." % (getattr(opt, invalid_opt), invalid_opt, source))
+
+    def check_str_option(option, valid_strings=()):
+        if getattr(opt, option) not in valid_strings:
+            show_invalid_option_warning(option)
+            setattr(opt, option, getattr(defaults, option))
+
+    def check_int_option(option, lower=None, upper=None):
+        try:
+            setattr(opt, option, stringconv.str_to_int(getattr(opt, option), lower, upper))
+        except ValueError:
+            show_invalid_option_warning(option)
+            setattr(opt, option, getattr(defaults, option))
+
+    def check_optional_int_option(option, lower=None, upper=None):
+        if getattr(opt, option) in (None, '', 'None'):
+            setattr(opt, option, None)
+        else:
+            check_int_option(option, lower, upper)
+
+    def check_bool_option(option):
+        try:
+            setattr(opt, option, stringconv.str_to_bool(getattr(opt, option)))
+        except ValueError:
+            show_invalid_option_warning(option)
+            setattr(opt, option, getattr(defaults, option))
+
+    def check_bool_dict_option(option):
+        optdict = getattr(opt, option)
+        defaultdict = getattr(defaults, option)
+        for key, val in list(optdict.items()):
+            optstr = option_key(option, key)
+            if key not in defaultdict:
+                warn("Invalid option '%s' in %s." % (optstr, source))
+                del optdict[key]
+                continue
+            try:
+                optdict[key] = stringconv.str_to_bool(val)
+            except ValueError:
+                warn("Invalid value '%s' for option '%s' in %s.\n"
+                     "Using default value." % (val, optstr, source))
+                optdict[key] = defaultdict[key]
+
+    if not items:
+        return
+    defaults = core.OptionData()
+    for option, val in items:
+        if '.' in option:
+            option_dict, item = option.split('.', 1)
+            try:
+                getattr(opt, option_dict)[item.replace("_", " ")] = val
+            except AttributeError:
+                pass   # So, attribute is invalid, but continue silently
+        else:
+            setattr(opt, option, val)
+    check_str_option('output_file_format', ('excel', 'csv'))
+    check_str_option('csv_delimiter', ('comma', 'tab'))
+    check_str_option('action_if_output_file_exists', ('enumerate', 'overwrite'))
+    check_bool_option('output_filename_date_suffix')
+    check_int_option('spatial_resolution', lower=0, upper=1000)
+    check_int_option('shell_width', lower=0, upper=1000)
+    check_bool_option('determine_clusters')
+    check_int_option('within_cluster_dist', lower=1, upper=1000)
+    check_bool_option('run_monte_carlo')
+    check_int_option('monte_carlo_runs', lower=1, upper=999)
+    check_bool_option('determine_interpoint_dists')
+    check_str_option('monte_carlo_simulation_window', ('profile', 'profile + shell'))
+    check_bool_option('monte_carlo_strict_location')
+    check_str_option('monte_carlo_sampling', sampling.sampling_modes)
+    check_bool_option('determine_expected_border_dists')
+    check_optional_int_option('monte_carlo_seed', lower=0)
+    check_bool_option('use_profile_cache')
+    check_int_option('prefetch_depth', lower=0)
+    check_int_option('processes', lower=0)
+    check_int_option('block_processes', lower=0)
+    check_bool_option('compress_simulated_outputs')
+    check_bool_option('export_npz')
+    check_str_option('distance_storage', runstore.distance_storage_modes)
+    if runstore.fixed_point_unavailable(opt):
+        warn("Fixed-point distance storage (option 'distance_storage' in %s) requires a "
+             "spatial resolution greater than 0.\nUsing default value." % source)
+        opt.distance_storage = defaults.distance_storage
+    check_str_option('output_layout', ('wide', 'long'))
+    check_str_option('interpoint_dist_mode', ('nearest neighbour', 'all'))
+    check_bool_option('interpoint_shortest_dist')
+    check_bool_option('interpoint_lateral_dist')
+    check_bool_dict_option('interpoint_relations')
+    check_bool_dict_option('outputs')
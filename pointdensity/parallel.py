@@ -0,0 +1,224 @@
+import array
+import collections
+import io
+import math
+import multiprocessing
+import os
+import random
+import sys
+from . import checkpoint
+from . import file_io
+from . import ingest
+from . import payload
+from . import runstore
+from .core import ProfileData
+
+
+#
+# Processing of input files in a pool of worker processes.
+#
+# Profiles are independent of each other, except that the first profile(s)
+# determine the metric unit and whether random points are used, which all
+# other profiles are checked against. The input files are therefore processed
+# in this process until these are known (usually after the first file), and
+# the remaining files are then dispatched to the pool, one input file per
+# task. The output written while processing each profile is returned with
+# the profile and written out in input order, so the log is not interleaved.
+#
+# Workers do not return the processed ProfileData objects, which would be
+# pickled with every point and its attributes, but only what main_proc() and
+# the outputs use of them (ProfileResults). The points and clusters are sent
+# as an array payload (see payload.py).
+#
+
+_worker_opt = None
+
+# Attributes of a processed profile that are saved, apart from its points
+# and clusters
+_result_attrs = ('id', 'inputfn', 'src_img', 'comment', 'pixelwidth', 'metric_unit',
+                 'perimeter', 'feret', 'warnflag', 'errflag', 'pp_distli', 'pp_latdistli',
+                 'rp_distli', 'rp_latdistli', 'expected_border_dist_cdf',
+                 'expected_border_dist_quantiles', 'expected_border_dist_mean', 'mcruns',
+                 'mc_checkpoint_fn')
+
+PointResult = collections.namedtuple('PointResult', ['dist_to_path', 'is_within_profile',
+                                                     'is_associated_with_path'])
+
+
+class ClusterResult:
+    """Size and distances of a cluster of a processed profile"""
+    __slots__ = ('size', 'dist_to_path', 'dist_to_nearest_cluster')
+
+    def __init__(self, size, dist_to_path, dist_to_nearest_cluster):
+        self.size = size
+        self.dist_to_path = dist_to_path
+        self.dist_to_nearest_cluster = dist_to_nearest_cluster
+
+    def __len__(self):
+        return self.size
+
+
+class ProfileResults:
+    """What main_proc() and the outputs use of a profile processed in a
+    worker process. Point properties that were not determined (because no
+    output uses them) are None.
+    """
+    is_processed = True
+
+    def __init__(self, pro):
+        for attr in _result_attrs:
+            setattr(self, attr, getattr(pro, attr))
+        self.area = _lazy_value(pro, 'area')
+        self.opt = None
+        self.pli, self.randomli, self.clusterli = [], [], []
+        arrays = {}
+        for ptype, pli in (('particle', pro.pli), ('random', pro.randomli)):
+            arrays[ptype + '.dist_to_path'] = array.array(
+                'd', [_nan(_lazy_value(p, 'dist_to_path')) for p in pli])
+            for attr in ('is_within_profile', 'is_associated_with_path'):
+                arrays[ptype + '.' + attr] = array.array(
+                    'b', [_flag(_lazy_value(p, attr)) for p in pli])
+        arrays['cluster.size'] = array.array('q', [len(c) for c in pro.clusterli])
+        for attr in ('dist_to_path', 'dist_to_nearest_cluster'):
+            arrays['cluster.' + attr] = array.array(
+                'd', [_nan(getattr(c, attr, None)) for c in pro.clusterli])
+        self.arrays = bytes(payload.pack(arrays))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        data = payload.ArrayPayload(self.arrays)
+        try:
+            self.pli, self.randomli = [
+                [PointResult(_none(d), _bool(within), _bool(associated))
+                 for d, within, associated in zip(data[ptype + '.dist_to_path'],
+                                                  data[ptype + '.is_within_profile'],
+                                                  data[ptype + '.is_associated_with_path'])]
+                for ptype in ('particle', 'random')]
+            self.clusterli = [ClusterResult(size, _none(d), _none(d_nearest))
+                              for size, d, d_nearest in zip(
+                                  data['cluster.size'], data['cluster.dist_to_path'],
+                                  data['cluster.dist_to_nearest_cluster'])]
+        finally:
+            data.close()
+        self.arrays = None
+
+    def release(self):
+        """Free the points, distances and Monte Carlo runs, as
+        ProfileData.release()
+        """
+        for a in (self.pp_distli, self.pp_latdistli, self.rp_distli, self.rp_latdistli):
+            runstore.remove_array(a)
+        self.mcruns.remove()
+        checkpoint.remove(self.mc_checkpoint_fn)
+        self.mcruns = runstore.SimulatedRuns()
+        self.pli, self.randomli, self.clusterli = [], [], []
+        self.pp_distli, self.pp_latdistli = [], []
+        self.rp_distli, self.rp_latdistli = [], []
+        self.expected_border_dist_cdf = []
+        self.expected_border_dist_quantiles = []
+
+
+def _lazy_value(obj, name):
+    """Return the value of the lazy property name of obj if it has been
+    determined, else None
+    """
+    return obj.__dict__.get('_lazy_' + name)
+
+
+def _nan(x):
+    return math.nan if x is None else x
+
+
+def _none(x):
+    return None if math.isnan(x) else x
+
+
+def _flag(x):
+    return -1 if x is None else int(x)
+
+
+def _bool(x):
+    return None if x == -1 else bool(x)
+
+
+def process_count(opt):
+    """Return the number of worker processes to use (0 means one per CPU)"""
+    if opt.processes <= 0:
+        return os.cpu_count() or 1
+    return opt.processes
+
+
+def iter_profiles(opt):
+    """Yield a (ProfileData, output) tuple for each profile of the input
+    files in opt.input_file_list, in order, where profiles processed in a
+    worker process are ProfileResults objects. The profiles have been
+    processed, and output is the output written while processing them (or ''
+    if already written); a tuple of None and output may also be yielded.
+    """
+    fli = opt.input_file_list
+    i = 0
+    while i < len(fli) and not (hasattr(opt, 'metric_unit') and hasattr(opt, 'use_random')):
+        for inputfn, lines in file_io.iter_profiles(fli[i]):
+            pro = ProfileData(inputfn, opt, lines)
+            pro.process(opt)
+            yield pro, ''
+            if opt.stop_requested:
+                return
+        i += 1
+    if i == len(fli):
+        return
+    pool = multiprocessing.Pool(min(process_count(opt), len(fli) - i),
+                                initializer=_init_worker, initargs=(opt,))
+    try:
+        results = pool.imap(_process_file, fli[i:])
+        while True:
+            try:
+                # Wake up now and then to see if the user wants to stop
+                processed = results.next(timeout=0.2)
+            except multiprocessing.TimeoutError:
+                if opt.stop_requested:
+                    return
+                continue
+            except StopIteration:
+                break
+            for pro, output in processed:
+                if pro is not None:
+                    pro.opt = opt
+                yield pro, output
+                if opt.stop_requested:
+                    return
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _init_worker(opt):
+    global _worker_opt
+    _worker_opt = opt
+    _worker_opt.stop_requested = False
+    # Pool workers cannot start pools of their own
+    _worker_opt.block_processes = 1
+    ingest.discard_archives()
+    random.seed()  # do not share the random state of the parent process
+
+
+def _process_file(fn):
+    """Process the profiles in the input file fn, and return a list of
+    (ProfileResults, output) tuples.
+    """
+    processed = []
+    stdout = sys.stdout
+    try:
+        sys.stdout = io.StringIO()
+        for inputfn, lines in file_io.iter_profiles(fn):
+            pro = ProfileData(inputfn, _worker_opt, lines)
+            pro.process(_worker_opt)
+            processed.append((ProfileResults(pro), sys.stdout.getvalue()))
+            sys.stdout = io.StringIO()
+        output = sys.stdout.getvalue()
+        if output:
+            processed.append((None, output))
+    finally:
+        sys.stdout = stdout
+    return processed
@@ -0,0 +1,132 @@
+import array
+import struct
+from multiprocessing import shared_memory
+
+
+#
+# Array-only payloads for sharing data between processes.
+#
+# Pickling a ProfileData object pickles every point with its back-references
+# to the profile and the session options. Instead, point coordinates and
+# properties are laid out as contiguous typed arrays in a single buffer, which
+# may be placed in shared memory. Another process attaches to the shared
+# memory by name and reads the arrays through memoryviews, without copying.
+# This is used to share coordinates with the workers of block-partitioned
+# distance computations (blocks.py), and to return the results of profiles
+# processed in worker processes (parallel.py).
+#
+# Buffer layout (native byte order, as the buffer is shared between
+# processes on the same machine): the magic bytes, the number of arrays, and
+# for each array its name (length-prefixed UTF-8), typecode, length and byte
+# offset; followed by the array data, each array aligned to 8 bytes.
+#
+
+_magic = b'PDAP'
+_alignment = 8
+
+
+class ArrayPayload:
+    """Named typed arrays in one contiguous buffer"""
+    def __init__(self, buf):
+        self.shm = None
+        self.buf = memoryview(buf)
+        self.arrays = {}
+        if bytes(self.buf[:len(_magic)]) != _magic:
+            raise ValueError("not an array payload")
+        pos = len(_magic)
+        count, = struct.unpack_from('=I', self.buf, pos)
+        pos += 4
+        for __ in range(count):
+            namelen, = struct.unpack_from('=B', self.buf, pos)
+            pos += 1
+            name = bytes(self.buf[pos:pos + namelen]).decode('utf-8')
+            pos += namelen
+            typecode, length, offset = struct.unpack_from('=cqq', self.buf, pos)
+            pos += struct.calcsize('=cqq')
+            typecode = typecode.decode('ascii')
+            size = array.array(typecode).itemsize * length
+            self.arrays[name] = self.buf[offset:offset + size].cast(typecode)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Return a payload of the dict arrays of names and array.array
+        objects.
+        """
+        return cls(pack(arrays))
+
+    @classmethod
+    def attach(cls, name):
+        """Return the payload in the shared memory block named name, without
+        copying it. The payload must be closed when no longer used.
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            payload = cls(shm.buf)
+        except ValueError:
+            shm.close()
+            raise
+        payload.shm = shm
+        return payload
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    @property
+    def nbytes(self):
+        return self.buf.nbytes
+
+    def share(self):
+        """Copy the payload to a new shared memory block and return it. The
+        caller must close and unlink the block when done.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(1, self.nbytes))
+        shm.buf[:self.nbytes] = self.buf
+        return shm
+
+    def close(self):
+        """Release the arrays, and detach from the shared memory block if
+        attached.
+        """
+        for a in self.arrays.values():
+            a.release()
+        self.arrays = {}
+        self.buf.release()
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+
+def pack(arrays):
+    """Return a bytearray with the dict arrays of names and array.array
+    objects laid out as an array payload.
+    """
+    entries = []
+    header_size = len(_magic) + 4 + sum(1 + len(name.encode('utf-8')) + struct.calcsize('=cqq')
+                                        for name in arrays)
+    offset = _aligned(header_size)
+    for name, a in arrays.items():
+        entries.append((name, a, offset))
+        offset = _aligned(offset + a.itemsize * len(a))
+    buf = bytearray(offset)
+    buf[:len(_magic)] = _magic
+    pos = len(_magic)
+    struct.pack_into('=I', buf, pos, len(arrays))
+    pos += 4
+    for name, a, offset in entries:
+        encoded = name.encode('utf-8')
+        struct.pack_into('=B', buf, pos, len(encoded))
+        pos += 1
+        buf[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+        struct.pack_into('=cqq', buf, pos, a.typecode.encode('ascii'), len(a), offset)
+        pos += struct.calcsize('=cqq')
+        data = a.tobytes()
+        buf[offset:offset + len(data)] = data
+    return buf
+
+
+def _aligned(n):
+    return -(-n // _alignment) * _alignment
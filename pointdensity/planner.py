@@ -0,0 +1,80 @@
+#
+# Demand-driven planning of the computations of a session.
+#
+# What is determined for each point, profile and Monte Carlo run is derived
+# from the outputs that are enabled and the options, so that quantities
+# that no output uses are neither computed nor kept. The plan does not
+# depend on the input files (e.g. on whether there are random points), so
+# it can be shown before the session starts.
+#
+
+
+class ComputationPlan:
+    """Quantities to determine in a session with the options opt"""
+    def __init__(self, opt):
+        if opt.determine_interpoint_dists:
+            self.interpoint_dist_types = [dist_type for dist_type, selected in
+                                          (('shortest', opt.interpoint_shortest_dist),
+                                           ('lateral', opt.interpoint_lateral_dist))
+                                          if selected]
+        else:
+            self.interpoint_dist_types = []
+        relations = [rel for rel, val in opt.interpoint_relations.items()
+                     if val and self.interpoint_dist_types]
+        self.interpoint_relations = [rel for rel in relations if 'simulated' not in rel]
+        self.clusters = opt.determine_clusters
+        self.expected_border_dists = opt.determine_expected_border_dists
+        self.monte_carlo_runs = opt.monte_carlo_runs if opt.run_monte_carlo else 0
+        if self.monte_carlo_runs:
+            self.simulated_relations = [rel for rel in relations if 'simulated' in rel]
+        else:
+            self.simulated_relations = []
+        self.simulated_clusters = bool(self.monte_carlo_runs) and opt.determine_clusters
+        # Random points are reported in the random point summary and in the
+        # results database and .npz export; else, they are only needed for
+        # random - particle interpoint distances, for which it suffices to
+        # know which points are within the profile or its shell
+        self.random_summary = opt.outputs['random summary']
+        self.random_point_association = (self.random_summary or bool(opt.output_database) or
+                                         opt.export_npz)
+        self.locate_random_points = (self.random_point_association or
+                                     'random - particle' in self.interpoint_relations)
+
+    def describe(self):
+        """Return a list of lines describing the plan"""
+        lines = ["Particles: location and distance to profile border"]
+        if self.random_point_association:
+            lines.append("Random points: location and distance to profile border")
+        elif self.locate_random_points:
+            lines.append("Random points: location only (for interpoint distances)")
+        else:
+            lines.append("Random points: not analyzed")
+        if self.interpoint_relations:
+            lines.append("Interpoint distances: %s (%s)"
+                         % (", ".join(self.interpoint_relations),
+                            ", ".join(self.interpoint_dist_types)))
+        if self.clusters:
+            lines.append("Clusters")
+        if self.expected_border_dists:
+            lines.append("Expected distances to profile border")
+        if self.monte_carlo_runs:
+            quantities = ["distances to profile border"]
+            if self.simulated_relations:
+                quantities.append("interpoint distances: %s (%s)"
+                                  % (", ".join(self.simulated_relations),
+                                     ", ".join(self.interpoint_dist_types)))
+            if self.simulated_clusters:
+                quantities.append("clusters")
+            lines.append("Monte Carlo runs: %d; %s" % (self.monte_carlo_runs,
+                                                       "; ".join(quantities)))
+        return lines
+
+
+def get_plan(opt):
+    """Return the ComputationPlan of the options opt, which is kept in
+    opt.plan.
+    """
+    plan = getattr(opt, 'plan', None)
+    if plan is None:
+        plan = opt.plan = ComputationPlan(opt)
+    return plan
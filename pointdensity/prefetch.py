@@ -0,0 +1,164 @@
+import collections
+import concurrent.futures
+import io
+import itertools
+import queue
+import sys
+import threading
+from . import file_io
+from .core import ProfileData
+
+
+#
+# Read-ahead of input files.
+#
+# While a profile is being analyzed, the next input files are read and
+# parsed in background threads. Each thread handles one input file at a
+# time, and the profiles of an input file (there may be several if it is a
+# container file) are passed to the main thread through a bounded queue.
+# Profiles are handed out in input order, and the output written by the
+# background threads while reading a profile is kept and handed out with
+# the profile, so that the log reads as if the files were processed in
+# sequence. Checks that depend on earlier profiles are left to
+# ProfileData.process().
+#
+
+
+class ThreadOutputRouter:
+    """Stand-in for sys.stdout that redirects output written by a thread to
+    a buffer of that thread, if it has one, and else to stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, s):
+        buf = getattr(self.local, 'buf', None)
+        if buf is not None:
+            buf.write(s)
+        else:
+            self.stream.write(s)
+
+    def flush(self):
+        if getattr(self.local, 'buf', None) is None and hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    def capture(self):
+        """Start buffering the output of the current thread"""
+        self.local.buf = io.StringIO()
+
+    def release(self):
+        """Stop buffering the output of the current thread, and return the
+        buffered output.
+        """
+        buf, self.local.buf = self.local.buf, None
+        return buf.getvalue()
+
+
+def iter_profiles(opt):
+    """Yield a (ProfileData, output) tuple for each profile of the input
+    files in opt.input_file_list, in order, where output is the output
+    written when the profile was read ahead, if so. If opt.prefetch_depth is
+    greater than 0, that many input files are read ahead.
+    """
+    if opt.prefetch_depth <= 0:
+        for inputfn, lines in itertools.chain.from_iterable(
+                file_io.iter_profiles(fn) for fn in opt.input_file_list):
+            yield ProfileData(inputfn, opt, lines), ''
+        return
+    stdout = sys.stdout
+    router = ThreadOutputRouter(stdout)
+    sys.stdout = router
+    reader = _ReadAhead(opt, router)
+    try:
+        for item in reader:
+            yield item
+    finally:
+        reader.stop()
+        sys.stdout = stdout
+
+
+class _ReadAhead:
+    _sentinel = object()
+
+    def __init__(self, opt, router):
+        self.opt = opt
+        self.router = router
+        self.depth = opt.prefetch_depth
+        self.stopped = False
+        self.pending = collections.deque()
+        self.executor = None
+
+    def __iter__(self):
+        fli = iter(self.opt.input_file_list)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.depth)
+        while True:
+            while len(self.pending) < self.depth:
+                fn = next(fli, None)
+                if fn is None:
+                    break
+                q = queue.Queue(self.depth)
+                self.pending.append(q)
+                self.executor.submit(self.__read_file, fn, q)
+            if not self.pending:
+                return
+            q = self.pending[0]
+            while True:
+                try:
+                    # Wake up now and then to see if the user wants to stop
+                    item = q.get(timeout=0.1)
+                except queue.Empty:
+                    if self.stopped or self.opt.stop_requested:
+                        return
+                    continue
+                if item is self._sentinel:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+            self.pending.popleft()
+
+    def stop(self):
+        """Stop reading ahead and wait for the background threads to finish"""
+        self.stopped = True
+        for q in self.pending:
+            # Unblock threads waiting for room in the queue
+            while not q.empty():
+                q.get_nowait()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def __put(self, q, item, final=False):
+        """Put item in q, waiting for room unless stopped. Return False if
+        stopped. Unless final, a stop request by the user also counts as
+        stopped; the final item of a file (the sentinel or an exception) is
+        always delivered if the main thread may still be waiting for it.
+        """
+        while not (self.stopped or (self.opt.stop_requested and not final)):
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # noinspection PyBroadException
+    def __read_file(self, fn, q):
+        self.router.capture()
+        try:
+            for inputfn, lines in file_io.iter_profiles(fn):
+                pro = ProfileData(inputfn, self.opt, lines)
+                pro.read_input()
+                if not self.__put(q, (pro, self.router.release())):
+                    break
+                self.router.capture()
+            else:
+                output = self.router.release()
+                if output:
+                    # Output after the last profile of the input file
+                    self.__put(q, (None, output))
+            self.__put(q, self._sentinel, final=True)
+        except BaseException as err:  # passed on to the main thread
+            if getattr(self.router.local, 'buf', None) is not None:
+                self.router.release()
+            self.__put(q, err, final=True)
@@ -0,0 +1,169 @@
+import array
+import math
+import os
+import struct
+from . import ingest
+
+
+#
+# Binary sidecar cache of parsed profiles.
+#
+# The parsed contents of an input file, the messages issued while parsing it
+# and the verdict of the path validation are stored in a file next to the
+# input file, with the extension given by cache_ext. The cache is valid only
+# if the stored SHA-256 digest of the input file contents and the parser
+# version both match; otherwise the input file is parsed anew. Archive
+# members are not cached.
+#
+
+cache_ext = '.pdc'
+
+_magic = b'PDPC'
+_format_version = 1
+
+
+def cache_filename(inputfn):
+    if ingest.is_archive_member(inputfn):
+        return None
+    return inputfn + cache_ext
+
+
+def load(inputfn, content_digest, parser_version):
+    """Return a dict of the cached data of the input file inputfn (see
+    save()), or None if there is no valid cache.
+    """
+    fn = cache_filename(inputfn)
+    if fn is None:
+        return None
+    try:
+        with open(fn, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    header = _header(content_digest, parser_version)
+    if not content_digest or not data.startswith(header):
+        return None
+    try:
+        return _Reader(data, len(header)).read_profile()
+    except (struct.error, ValueError, UnicodeDecodeError):
+        return None
+
+
+def save(inputfn, content_digest, parser_version, d):
+    """Save the dict d to the cache of the input file inputfn. d has the
+    keys 'src_img', 'id', 'comment', 'pixelwidth', 'metric_unit', 'path',
+    'holes', 'particles', 'random', 'messages', 'warnflag' and 'path_error'.
+    Coordinates are given as lists of (x, y) tuples, and path_error is None
+    if the paths are valid. An id that is not an integer is saved as None.
+    Return True if the cache was saved.
+    """
+    fn = cache_filename(inputfn)
+    if not content_digest or fn is None:
+        return False
+    w = _Writer()
+    try:
+        _write_profile(w, d)
+    except struct.error:
+        return False
+    tmpfn = fn + '.tmp'
+    try:
+        with open(tmpfn, 'wb') as f:
+            f.write(_header(content_digest, parser_version))
+            f.write(b''.join(w.parts))
+        os.replace(tmpfn, fn)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _write_profile(w, d):
+    for key in ('src_img', 'comment', 'metric_unit'):
+        w.string(d[key])
+    has_id = isinstance(d['id'], int)
+    w.parts.append(struct.pack('<?qd', has_id, d['id'] if has_id else 0,
+                               d['pixelwidth'] if d['pixelwidth'] is not None
+                               else float('nan')))
+    w.coords(d['path'])
+    w.count(len(d['holes']))
+    for hole in d['holes']:
+        w.coords(hole)
+    w.coords(d['particles'])
+    w.coords(d['random'])
+    w.count(len(d['messages']))
+    for msg in d['messages']:
+        w.string(msg)
+    w.parts.append(struct.pack('<??', d['warnflag'], d['path_error'] is not None))
+    w.string(d['path_error'] or '')
+
+
+def _header(content_digest, parser_version):
+    return (struct.pack('<4sII', _magic, _format_version, parser_version) +
+            (content_digest or '').encode())
+
+
+class _Writer:
+    def __init__(self):
+        self.parts = []
+
+    def count(self, n):
+        self.parts.append(struct.pack('<I', n))
+
+    def string(self, s):
+        b = (s or '').encode('utf-8', 'surrogateescape')
+        self.count(len(b))
+        self.parts.append(b)
+
+    def coords(self, li):
+        self.count(len(li))
+        self.parts.append(array.array('d', [c for xy in li for c in xy]).tobytes())
+
+
+class _Reader:
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def count(self):
+        return self.unpack('<I')[0]
+
+    def string(self):
+        n = self.count()
+        b = self.data[self.pos:self.pos + n]
+        if len(b) != n:
+            raise ValueError("truncated cache")
+        self.pos += n
+        return b.decode('utf-8', 'surrogateescape')
+
+    def coords(self):
+        n = self.count()
+        a = array.array('d')
+        b = self.data[self.pos:self.pos + 16 * n]
+        if len(b) != 16 * n:
+            raise ValueError("truncated cache")
+        a.frombytes(b)
+        self.pos += 16 * n
+        return list(zip(a[0::2], a[1::2]))
+
+    def read_profile(self):
+        d = {}
+        for key in ('src_img', 'comment', 'metric_unit'):
+            d[key] = self.string()
+        has_id, profile_id, pixelwidth = self.unpack('<?qd')
+        d['id'] = profile_id if has_id else None
+        d['pixelwidth'] = None if math.isnan(pixelwidth) else pixelwidth
+        d['path'] = self.coords()
+        d['holes'] = [self.coords() for __ in range(self.count())]
+        d['particles'] = self.coords()
+        d['random'] = self.coords()
+        d['messages'] = [self.string() for __ in range(self.count())]
+        d['warnflag'], has_path_error = self.unpack('<??')
+        path_error = self.string()
+        d['path_error'] = path_error if has_path_error else None
+        if self.pos != len(self.data):
+            raise ValueError("trailing data in cache")
+        return d
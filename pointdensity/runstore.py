@@ -0,0 +1,326 @@
+import array
+import itertools
+import math
+import mmap
+import operator
+import os
+import tempfile
+
+
+#
+# Compact storage of Monte Carlo runs.
+#
+# Rather than keeping a core.Point object for every simulated point, and
+# nested lists of Python floats for every interpoint distance, all runs of a
+# profile are stored in flat typed arrays. Each quantity is stored in one
+# array for all runs, together with an array of offsets such that the
+# values of run n are found at [offsets[n]:offsets[n + 1]].
+#
+
+relations = ('simulated - simulated', 'simulated - particle', 'particle - simulated')
+dist_types = ('dist', 'latdist')
+
+# Storage of distances (option distance_storage): as double precision
+# floats; as single precision floats; or as 32-bit integer multiples of a
+# quantization step of 1/fixed_point_steps of the spatial resolution. The
+# two latter halve the memory and scratch space used by distances, at a
+# precision far below the spatial resolution.
+distance_storage_modes = ('double', 'single', 'fixed')
+fixed_point_steps = 100
+# Relative quantization step of distances stored in single precision
+single_precision_step = 2 ** -24
+
+
+class FileArray:
+    """A typed array backed by a file in the directory dirname, which is
+    memory-mapped when read, so that the operating system can page it in and
+    out as needed. Values can only be appended; reading the array ends
+    writing to the file until more values are appended.
+    """
+    def __init__(self, typecode, dirname):
+        self.typecode = typecode
+        self.itemsize = array.array(typecode).itemsize
+        fd, self.fn = tempfile.mkstemp(suffix='.' + typecode, dir=dirname)
+        os.close(fd)
+        self.f = None
+        self.length = 0
+        self.mm = None
+        self.view = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.__view())
+
+    def __getitem__(self, key):
+        return self.__view()[key]
+
+    def extend(self, values):
+        data = array.array(self.typecode, values)
+        if not data:
+            return
+        if self.f is None:
+            self.f = open(self.fn, 'ab')
+        self.f.write(data.tobytes())
+        self.length += len(data)
+        self.__unmap()
+
+    def append(self, value):
+        self.extend([value])
+
+    def close(self):
+        """Stop writing to the file and unmap it (but keep it for reading,
+        when it is mapped again)
+        """
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        self.__unmap()
+
+    def remove(self):
+        """Delete the file; the array can no longer be used. If the file
+        cannot be deleted, it is left to be removed with the scratch
+        directory.
+        """
+        self.close()
+        try:
+            os.remove(self.fn)
+        except OSError:
+            pass  # e.g. still mapped by a view handed out
+
+    def __getstate__(self):
+        # The file is reopened and mapped when read after unpickling
+        self.close()
+        return self.__dict__.copy()
+
+    def __view(self):
+        if self.view is None:
+            self.close()
+            if self.length == 0:
+                self.view = memoryview(array.array(self.typecode))
+            else:
+                with open(self.fn, 'rb') as f:
+                    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mm).cast(self.typecode)
+        return self.view
+
+    def __unmap(self):
+        """Release the view and close the memory map of the file, if
+        mapped. A map that is still used by views handed out (e.g. slices)
+        is closed when these are freed.
+        """
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                pass
+            self.mm = None
+
+
+class ScaledArray:
+    """A sequence of numbers stored as integer multiples of scale in a typed
+    array, which is backed by a file in the directory dirname if given.
+    """
+    def __init__(self, typecode, scale, dirname=None):
+        self.scale = scale
+        self.values = new_array(typecode, dirname)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return map(operator.mul, self.values, itertools.repeat(self.scale))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(map(operator.mul, self.values[key], itertools.repeat(self.scale)))
+        return self.values[key] * self.scale
+
+    def extend(self, values):
+        scale = self.scale
+        self.values.extend([round(x / scale) for x in values])
+
+    def append(self, value):
+        self.extend([value])
+
+    def close(self):
+        if isinstance(self.values, FileArray):
+            self.values.close()
+
+    def remove(self):
+        if isinstance(self.values, FileArray):
+            self.values.remove()
+
+
+def quantization_step(opt):
+    """Return the quantization step of stored distances in metric units if
+    they are stored as fixed-point numbers, else None.
+    """
+    if opt.distance_storage == 'fixed' and opt.spatial_resolution > 0:
+        return opt.spatial_resolution / fixed_point_steps
+    return None
+
+
+def fixed_point_unavailable(opt):
+    """Return True if fixed-point storage of distances is selected but
+    cannot be used, as the spatial resolution, from which the quantization
+    step is derived, is 0.
+    """
+    return opt.distance_storage == 'fixed' and opt.spatial_resolution <= 0
+
+
+def distance_format(opt, pixelwidth):
+    """Return the typecode and scale (None unless fixed-point) of arrays
+    of distances in pixel units, for a profile with the given pixel width.
+    """
+    step = quantization_step(opt)
+    if step is not None:
+        return 'i', step / pixelwidth
+    if opt.distance_storage == 'single':
+        return 'f', None
+    return 'd', None
+
+
+def new_array(typecode, dirname=None, values=(), scale=None):
+    """Return a new typed array containing values; the array is backed by a
+    file in the scratch directory dirname if given, else kept in memory. If
+    scale is given, values are stored as integer multiples of scale.
+    """
+    if scale is not None:
+        a = ScaledArray(typecode, scale, dirname)
+        a.extend(values)
+        a.close()
+        return a
+    if dirname:
+        a = FileArray(typecode, dirname)
+        a.extend(values)
+        a.close()
+        return a
+    return array.array(typecode, values)
+
+
+class RaggedArray:
+    """A sequence of variable-length rows of numbers of the same type,
+    stored in a single typed array.
+    """
+    def __init__(self, typecode='d', dirname=None, scale=None):
+        self.values = new_array(typecode, dirname, scale=scale)
+        self.offsets = array.array('q', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        return self.values[self.offsets[n]:self.offsets[n + 1]]
+
+    def append(self, row):
+        self.values.extend(row)
+        self.offsets.append(len(self.values))
+
+    def close(self):
+        if not isinstance(self.values, array.array):
+            self.values.close()
+
+    def remove(self):
+        """Delete the backing file, if any; the array can no longer be used"""
+        remove_array(self.values)
+
+
+class SimulatedRuns:
+    """Distances to the profile border of the simulated points, interpoint
+    distances and clusters of all Monte Carlo runs of a profile. The
+    coordinates and locations of the simulated points are not kept, as no
+    output uses them. Distances are stored in pixel units, in arrays of the
+    typecode and scale given by dist_format (see distance_format()). If
+    scratch_dir is given, the arrays are backed by files in that directory.
+    """
+    def __init__(self, scratch_dir=None, dist_format=('d', None)):
+        self.scratch_dir = scratch_dir
+        self.dist_format = dist_format
+        self.dist_to_path = RaggedArray(dist_format[0], scratch_dir, dist_format[1])
+        self.distances = {}
+        self.cluster_size = RaggedArray('l', scratch_dir)
+        self.cluster_dist_to_path = RaggedArray('d', scratch_dir)
+        self.cluster_dist_to_nearest_cluster = RaggedArray('d', scratch_dir)
+
+    def __len__(self):
+        return len(self.dist_to_path)
+
+    def append_run(self, pli, rund):
+        """Append a run with the simulated points in pli and the interpoint
+        distances and clusters in rund, which has the same layout as an
+        element of the former ProfileData.mcli list.
+        """
+        self.dist_to_path.append([p.dist_to_path for p in pli])
+        for rel in relations:
+            for dist_type in dist_types:
+                # Only relations that were determined are stored; these
+                # are the same for all runs
+                for distli in rund[rel][dist_type]:
+                    if (rel, dist_type) not in self.distances:
+                        self.distances[rel, dist_type] = RaggedArray(
+                            self.dist_format[0], self.scratch_dir, self.dist_format[1])
+                    self.distances[rel, dist_type].append(distli)
+        clusterli = rund['clusterli'] or []
+        self.cluster_size.append([len(c) for c in clusterli])
+        self.cluster_dist_to_path.append([_to_float(c.dist_to_path) for c in clusterli])
+        self.cluster_dist_to_nearest_cluster.append([_to_float(c.dist_to_nearest_cluster)
+                                                     for c in clusterli])
+
+    def close(self):
+        """Finish appending runs"""
+        for ragged in self.__arrays():
+            ragged.close()
+
+    def remove(self):
+        """Delete any files backing the runs, which can no longer be used"""
+        for ragged in self.__arrays():
+            ragged.remove()
+
+    def __arrays(self):
+        return ([self.dist_to_path, self.cluster_size, self.cluster_dist_to_path,
+                 self.cluster_dist_to_nearest_cluster] + list(self.distances.values()))
+
+    def border_distances(self, n):
+        """Return the distances to the profile border of the simulated
+        points in run n (negative if outside the profile).
+        """
+        return self.dist_to_path[n]
+
+    def has_interpoint_distances(self, rel, dist_type):
+        return (rel, dist_type) in self.distances
+
+    def interpoint_distances(self, rel, dist_type, n):
+        """Return the interpoint distances of type dist_type ('dist' or
+        'latdist') for the relation rel in run n.
+        """
+        return self.distances[rel, dist_type][n]
+
+    def clusters(self, n):
+        """Return a list of (number of points, distance to profile border,
+        distance to nearest cluster) tuples of the clusters in run n.
+        """
+        return [(size, _from_float(d), _from_float(d_nearest))
+                for size, d, d_nearest in zip(self.cluster_size[n],
+                                              self.cluster_dist_to_path[n],
+                                              self.cluster_dist_to_nearest_cluster[n])]
+
+
+def remove_array(a):
+    """Delete the file backing the array a, if any"""
+    if isinstance(a, (FileArray, ScaledArray)):
+        a.remove()
+
+
+def _to_float(x):
+    """Return x as a float, representing None as NaN"""
+    return float('nan') if x is None else x
+
+
+def _from_float(x):
+    """Return x, or None if x is NaN"""
+    return None if math.isnan(x) else x
@@ -0,0 +1,108 @@
+import math
+import random
+
+
+#
+# Candidate point generators for Monte Carlo simulations.
+#
+# Each generator yields an endless sequence of (x, y) candidate coordinates
+# within the rectangle (lox, loy)-(hix, hiy). Candidates falling outside the
+# simulation window are rejected by the caller, so any generator that covers
+# the rectangle uniformly yields uniformly distributed simulated points.
+#
+# Only the 'uniform' mode yields independent points, i.e. complete spatial
+# randomness (CSR). In the 'halton' and 'stratified' modes, the points of a
+# run are deliberately spread more evenly than independent points. This
+# reduces the variance of averages over the points of a run (such as the
+# mean distance to the profile border), but the runs are not realizations of
+# the CSR null model: envelopes of interpoint distances, nearest neighbour
+# statistics and clusters obtained from them are too narrow.
+#
+
+sampling_modes = ('uniform', 'halton', 'stratified')
+
+
+def uniform_candidates(lox, loy, hix, hiy, rng=random):
+    """Yield independent, uniformly distributed candidates on the integer
+    pixel grid (the original sampler).
+    """
+    lox, loy, hix, hiy = int(lox), int(loy), int(hix) + 1, int(hiy) + 1
+    while True:
+        yield rng.randint(lox, hix), rng.randint(loy, hiy)
+
+
+def _digit_permutations(base, ndigits, rng):
+    """Return one random permutation of the digits 0..base-1 per digit
+    position, with 0 mapped to 0 so that the sequence remains in [0, 1).
+    """
+    perms = []
+    for __ in range(ndigits):
+        perm = list(range(1, base))
+        rng.shuffle(perm)
+        perms.append([0] + perm)
+    return perms
+
+
+def _scrambled_radical_inverse(i, base, perms):
+    """Return the radical inverse of i in the given base, permuting each
+    digit by the corresponding permutation in perms.
+    """
+    r = 0.0
+    f = 1.0 / base
+    k = 0
+    while i > 0:
+        i, d = divmod(i, base)
+        r += perms[k][d] * f
+        f /= base
+        k += 1
+    return r
+
+
+def halton_candidates(lox, loy, hix, hiy, rng=random):
+    """Yield candidates from a two-dimensional Halton sequence (bases 2
+    and 3), scrambled with random digit permutations and started at a
+    random index so that successive runs are mutually independent.
+    """
+    ndigits = 64
+    perms2 = _digit_permutations(2, ndigits, rng)
+    perms3 = _digit_permutations(3, ndigits, rng)
+    i = rng.randint(1, 2 ** 20)
+    w, h = hix - lox, hiy - loy
+    while True:
+        yield (lox + w * _scrambled_radical_inverse(i, 2, perms2),
+               loy + h * _scrambled_radical_inverse(i, 3, perms3))
+        i += 1
+
+
+def stratified_candidates(lox, loy, hix, hiy, n, rng=random):
+    """Yield candidates stratified over a grid of roughly n equal-area cells
+    covering the rectangle. Each pass visits all cells once in random order
+    and draws one uniform point per cell.
+    """
+    w, h = hix - lox, hiy - loy
+    n = max(n, 1)
+    if w <= 0 or h <= 0:
+        nx = ny = 1
+    else:
+        nx = max(1, int(round(math.sqrt(n * w / h))))
+        ny = max(1, int(math.ceil(n / nx)))
+    cw, ch = w / nx, h / ny
+    cells = [(i, j) for i in range(nx) for j in range(ny)]
+    while True:
+        rng.shuffle(cells)
+        for i, j in cells:
+            yield (lox + (i + rng.random()) * cw,
+                   loy + (j + rng.random()) * ch)
+
+
+def candidates(mode, lox, loy, hix, hiy, n, rng=random):
+    """Return a candidate generator for the sampling mode mode; n is the
+    number of points that will be accepted in the run.
+    """
+    if mode == 'halton':
+        return halton_candidates(lox, loy, hix, hiy, rng)
+    elif mode == 'stratified':
+        return stratified_candidates(lox, loy, hix, hiy, n, rng)
+    elif mode == 'uniform':
+        return uniform_candidates(lox, loy, hix, hiy, rng)
+    raise ValueError("unknown sampling mode '%s'" % mode)
@@ -0,0 +1,237 @@
+import json
+import os.path
+import sqlite3
+import sys
+import time
+from . import geometry
+from . import version
+
+
+#
+# SQLite results database.
+#
+# The results of each profile are written to an SQLite database as soon as
+# the profile has been processed, one transaction per profile, so that the
+# database can be queried while the session is running. A database may be
+# reused across sessions, which are told apart by the session_id column;
+# results from many sessions can thus be pooled with SQL. All lengths are in
+# metric units; values shown as 'N/A' in the summaries are NULL.
+#
+
+_schema = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id INTEGER PRIMARY KEY,
+    started TEXT,
+    program_version TEXT,
+    options TEXT
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    profile_key INTEGER PRIMARY KEY,
+    session_id INTEGER REFERENCES sessions,
+    profile_id INTEGER,
+    input_file TEXT,
+    src_img TEXT,
+    comment TEXT,
+    pixelwidth REAL,
+    metric_unit TEXT,
+    perimeter REAL,
+    area REAL,
+    feret REAL,
+    warnings INTEGER,
+    errors INTEGER
+);
+CREATE TABLE IF NOT EXISTS points (
+    profile_key INTEGER REFERENCES profiles,
+    ptype TEXT,
+    number INTEGER,
+    dist_to_path REAL,
+    within_profile INTEGER,
+    border_associated INTEGER,
+    profile_associated INTEGER
+);
+CREATE TABLE IF NOT EXISTS clusters (
+    profile_key INTEGER REFERENCES profiles,
+    number INTEGER,
+    n_points INTEGER,
+    dist_to_path REAL,
+    dist_to_nearest_cluster REAL
+);
+CREATE TABLE IF NOT EXISTS interpoint_distances (
+    profile_key INTEGER REFERENCES profiles,
+    relation TEXT,
+    dist_type TEXT,
+    distance REAL
+);
+CREATE TABLE IF NOT EXISTS simulated_border_distances (
+    profile_key INTEGER REFERENCES profiles,
+    run INTEGER,
+    distance REAL
+);
+CREATE TABLE IF NOT EXISTS simulated_interpoint_distances (
+    profile_key INTEGER REFERENCES profiles,
+    relation TEXT,
+    dist_type TEXT,
+    run INTEGER,
+    distance REAL
+);
+CREATE TABLE IF NOT EXISTS simulated_clusters (
+    profile_key INTEGER REFERENCES profiles,
+    run INTEGER,
+    n_points INTEGER,
+    dist_to_path REAL,
+    dist_to_nearest_cluster REAL
+);
+CREATE INDEX IF NOT EXISTS profiles_profile_id ON profiles (profile_id);
+CREATE INDEX IF NOT EXISTS profiles_input_file ON profiles (input_file);
+CREATE INDEX IF NOT EXISTS profiles_session_id ON profiles (session_id);
+CREATE INDEX IF NOT EXISTS points_profile_key ON points (profile_key);
+CREATE INDEX IF NOT EXISTS clusters_profile_key ON clusters (profile_key);
+CREATE INDEX IF NOT EXISTS interpoint_distances_profile_key
+    ON interpoint_distances (profile_key);
+CREATE INDEX IF NOT EXISTS simulated_border_distances_profile_key
+    ON simulated_border_distances (profile_key);
+CREATE INDEX IF NOT EXISTS simulated_interpoint_distances_profile_key
+    ON simulated_interpoint_distances (profile_key);
+CREATE INDEX IF NOT EXISTS simulated_clusters_profile_key ON simulated_clusters (profile_key);
+"""
+
+# Options recorded with each session
+_session_options = ('spatial_resolution', 'shell_width', 'determine_interpoint_dists',
+                    'interpoint_dist_mode', 'interpoint_shortest_dist',
+                    'interpoint_lateral_dist', 'interpoint_relations', 'run_monte_carlo',
+                    'monte_carlo_runs', 'monte_carlo_simulation_window',
+                    'monte_carlo_strict_location', 'monte_carlo_sampling',
+                    'monte_carlo_seed', 'determine_clusters', 'within_cluster_dist')
+
+
+def _m(x, pixelwidth):
+    if x is None:
+        return None
+    return geometry.to_metric_units(x, pixelwidth)
+
+
+def _na(x, pixelwidth):
+    # Distances to nearest cluster are -1 if there is only one cluster
+    if x == -1:
+        return None
+    return _m(x, pixelwidth)
+
+
+def _relation_prefix(rel):
+    """Return the prefix of the ProfileData attributes holding the
+    interpoint distances of relation rel (e.g. 'pp_' for 'particle -
+    particle').
+    """
+    return rel[0] + rel[rel.index("- ") + 2] + "_"
+
+
+class ResultStore:
+    """Results database of a session"""
+    def __init__(self, fn, opt):
+        self.fn = fn
+        self.opt = opt
+        self.db = sqlite3.connect(fn)
+        try:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            with self.db:
+                self.db.executescript(_schema)
+                options = dict((name, getattr(opt, name)) for name in _session_options)
+                self.session_id = self.db.execute(
+                    "INSERT INTO sessions (started, program_version, options) VALUES (?, ?, ?)",
+                    (time.strftime("%Y-%m-%d %H:%M:%S"), version.version,
+                     json.dumps(options))).lastrowid
+        except sqlite3.Error:
+            self.db.close()
+            raise
+
+    def add_profile(self, pro):
+        """Write the results of the processed profile pro. Raise
+        sqlite3.Error if unable to.
+        """
+        with self.db:
+            key = self.db.execute(
+                "INSERT INTO profiles (session_id, profile_id, input_file, src_img, comment, "
+                "pixelwidth, metric_unit, perimeter, area, feret, warnings, errors) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.session_id, pro.id if isinstance(pro.id, int) else None,
+                 os.path.basename(pro.inputfn), pro.src_img, pro.comment, pro.pixelwidth,
+                 pro.metric_unit,
+                 None if pro.errflag else _m(pro.perimeter, pro.pixelwidth),
+                 None if pro.errflag else geometry.to_metric_units(pro.area,
+                                                                   pro.pixelwidth ** 2),
+                 None if pro.errflag else _m(pro.feret, pro.pixelwidth),
+                 int(pro.warnflag), int(pro.errflag))).lastrowid
+            if pro.errflag:
+                return
+            self.__add_points(key, pro)
+            self.__add_clusters(key, pro)
+            self.__add_interpoint_distances(key, pro)
+            self.__add_simulations(key, pro)
+
+    def __add_points(self, key, pro):
+        for ptype, pli in (('particle', pro.pli), ('random', pro.randomli)):
+            self.db.executemany(
+                "INSERT INTO points VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((key, ptype, n + 1, _m(p.dist_to_path, pro.pixelwidth),
+                  int(p.is_within_profile), int(p.is_associated_with_path),
+                  int(p.is_within_profile or p.is_associated_with_path))
+                 for n, p in enumerate(pli)))
+
+    def __add_clusters(self, key, pro):
+        self.db.executemany(
+            "INSERT INTO clusters VALUES (?, ?, ?, ?, ?)",
+            ((key, n + 1, len(c), _m(c.dist_to_path, pro.pixelwidth),
+              _na(c.dist_to_nearest_cluster, pro.pixelwidth))
+             for n, c in enumerate(pro.clusterli)))
+
+    def __add_interpoint_distances(self, key, pro):
+        for rel, val in self.opt.interpoint_relations.items():
+            if not val or 'simulated' in rel:
+                continue
+            prefix = _relation_prefix(rel)
+            for dist_type, attr in (('shortest', 'distli'), ('lateral', 'latdistli')):
+                distli = getattr(pro, prefix + attr, None)
+                if distli:
+                    self.db.executemany(
+                        "INSERT INTO interpoint_distances VALUES (?, ?, ?, ?)",
+                        ((key, rel, dist_type, _m(d, pro.pixelwidth)) for d in distli))
+
+    def __add_simulations(self, key, pro):
+        mcruns = pro.mcruns
+        for n in range(len(mcruns)):
+            self.db.executemany(
+                "INSERT INTO simulated_border_distances VALUES (?, ?, ?)",
+                ((key, n + 1, _m(d, pro.pixelwidth)) for d in mcruns.border_distances(n)))
+            for rel in self.opt.interpoint_relations:
+                for dist_type, short_type in (('shortest', 'dist'), ('lateral', 'latdist')):
+                    if not mcruns.has_interpoint_distances(rel, short_type):
+                        continue
+                    self.db.executemany(
+                        "INSERT INTO simulated_interpoint_distances VALUES (?, ?, ?, ?, ?)",
+                        ((key, rel, dist_type, n + 1, _m(d, pro.pixelwidth))
+                         for d in mcruns.interpoint_distances(rel, short_type, n)))
+            self.db.executemany(
+                "INSERT INTO simulated_clusters VALUES (?, ?, ?, ?, ?)",
+                ((key, n + 1, size, _m(d, pro.pixelwidth), _na(d_nearest, pro.pixelwidth))
+                 for size, d, d_nearest in mcruns.clusters(n)))
+
+    def close(self):
+        self.db.close()
+
+
+def open_store(opt):
+    """Open the results database opt.output_database, if set, and return a
+    ResultStore, or None if not set or if it cannot be opened.
+    """
+    if not opt.output_database:
+        return None
+    fn = opt.output_database
+    if not os.path.isabs(fn):
+        fn = os.path.join(opt.output_dir, fn)
+    try:
+        return ResultStore(fn, opt)
+    except sqlite3.Error as err:
+        sys.stdout.write("Warning: Unable to open results database '%s' (%s): results will "
+                         "not be saved to it.\n" % (fn, err))
+        return None
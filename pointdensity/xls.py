@@ -4,33 +4,46 @@
 #    Uses the openpyxl module to write to Excel sheets,
 #    in a manner similar to the csv module
 #
+#    The workbook is opened in write-only mode, so that rows are
+#    streamed to a temporary file as they are written instead of being
+#    kept in memory; memory use is thus independent of the number of rows.
+#
 #    N.B. The writer object needs to be explicitly closed.
 
 from openpyxl import Workbook
 
 
-class Writer(object):
-    def __init__(self, filename, sheetname="Sheet1"):
-        self.wb = Workbook()
-        self.sheet = self.wb.active
-        self.sheet.title = sheetname
-        self.filename = filename
+def _cell_value(element):
+    if isinstance(element, int):
+        return element
+    elif isinstance(element, float):
+        return float(element)
+    return str(element) if element is not None else "None"
+
+
+class SheetWriter(object):
+    def __init__(self, sheet):
+        self.sheet = sheet
         self.curr_row = 1
 
     def writerow(self, row):
-        for col, element in enumerate(row):
-            c = self.sheet.cell(row=self.curr_row, column=col+1)
-            if isinstance(element, int):
-                c.value = element
-            elif isinstance(element, float):
-                c.value = float(element)
-            else:
-                c.value = str(element) if element is not None else "None"
+        self.sheet.append([_cell_value(element) for element in row])
         self.curr_row += 1
 
     def writerows(self, rows):
         for r in rows:
             self.writerow(r)
 
+
+class Writer(SheetWriter):
+    def __init__(self, filename, sheetname="Sheet1"):
+        self.wb = Workbook(write_only=True)
+        SheetWriter.__init__(self, self.wb.create_sheet(title=sheetname))
+        self.filename = filename
+
+    def add_sheet(self, sheetname):
+        """Add a sheet to the workbook, and return a writer for it"""
+        return SheetWriter(self.wb.create_sheet(title=sheetname))
+
     def close(self):
-        self.wb.save(self.filename)
\ No newline at end of file
+        self.wb.save(self.filename)
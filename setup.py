@@ -21,7 +21,8 @@ setup(
     packages=find_packages(),
     entry_points={
     'console_scripts':
-        ['PointDensity = PointDensity:main'],
+        ['PointDensity = PointDensity:main',
+         'PointDensity-batch = pointdensity.cli:main'],
     'gui_scripts':
         ['PointDensity = PointDensity:main']        
     },